@@ -16,6 +16,7 @@
 #
 
 __all__ = [
+    "batch",
     "gui",
     "ps2icon",
     "lzari",
@@ -0,0 +1,175 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Run a mymc command over many memory card images in parallel."""
+
+import sys
+import os
+import io
+import glob
+import json
+import time
+import optparse
+import contextlib
+from concurrent import futures
+
+from . import mymc
+from . import verbuild
+
+# Commands that can be run in batch mode, and whether they need
+# mymc's debug command table.
+batch_commands = {
+    "check": False,
+    "df": False,
+    "dir": False,
+    "ecc_check": True,
+    "export": False,
+}
+
+def expand_cards(patterns):
+    """Expand a list of file names and glob patterns to card images.
+
+    Patterns that match nothing are passed through unchanged so
+    the missing file gets reported for that card."""
+
+    cards = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            matches = [pattern]
+        for fn in matches:
+            if fn not in seen:
+                seen.add(fn)
+                cards.append(fn)
+    return cards
+
+def run_card(card, cmd, args, ignore_ecc = False):
+    """Run a single mymc command on a card image.
+
+    Any "{card}" in the arguments is replaced with the card's file
+    name without its extension.  Returns a dict describing the
+    result that can be serialized as JSON."""
+
+    name = os.path.splitext(os.path.basename(card))[0]
+    argv = ["mymcplus"]
+    if batch_commands[cmd]:
+        argv.append("-D")
+    if ignore_ecc:
+        argv.append("-i")
+    argv += [card, cmd] + [arg.replace("{card}", name) for arg in args]
+
+    out = io.StringIO()
+    err = io.StringIO()
+    # export -d changes the working directory, which must not carry
+    # over to the next card
+    cwd = os.getcwd()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            ret = mymc.main(argv)
+        except SystemExit as value:
+            # optparse reports bad arguments this way
+            ret = value.code
+            if not isinstance(ret, int):
+                ret = 1
+        except Exception as value:
+            sys.stderr.write("%s: %s: %s\n"
+                     % (card, type(value).__name__, value))
+            ret = 1
+        finally:
+            os.chdir(cwd)
+    seconds = time.perf_counter() - start
+
+    return {"card": card,
+        "command": cmd,
+        "returncode": ret,
+        "stdout": out.getvalue(),
+        "stderr": err.getvalue(),
+        "seconds": round(seconds, 6)}
+
+def write_result(out, result):
+    out.write(json.dumps(result, sort_keys = True) + "\n")
+    out.flush()
+
+def main(argv = sys.argv):
+    prog = argv[0]
+    usage = ("usage: %prog [-j N] [-i] command card.ps2 [...]"
+         " [-- command-options]")
+    description = ("Run a mymc command on many memory card images,"
+               " writing one JSON result per card as each"
+               " finishes.  Card names may be glob patterns."
+               "  Any {card} in the command options is replaced"
+               " with the card's name.\n\n"
+               "Supported commands: "
+               + ", ".join(sorted(batch_commands.keys())))
+    version = ("mymc+ "
+           + verbuild.MYMC_VERSION_MAJOR
+           + "." + verbuild.MYMC_VERSION_BUILD)
+
+    optparser = optparse.OptionParser(prog = prog, usage = usage,
+                      description = description,
+                      version = version,
+                      formatter = mymc.my_help_formatter())
+    optparser.add_option("-j", "--jobs", type = "int",
+                 default = os.cpu_count() or 1, metavar = "N",
+                 help = "Number of cards to process at once.")
+    optparser.add_option("-i", "--ignore-ecc", action = "store_true",
+                 default = False,
+                 help = "Ignore ECC errors while reading.")
+    optparser.disable_interspersed_args()
+
+    argv = list(argv[1:])
+    cmd_args = []
+    if "--" in argv:
+        i = argv.index("--")
+        cmd_args = argv[i + 1:]
+        argv = argv[:i]
+    (opts, args) = optparser.parse_args(args = argv)
+
+    if len(args) < 2:
+        optparser.error("Incorrect number of arguments.")
+    cmd = args[0]
+    if cmd not in batch_commands:
+        optparser.error('Command "%s" not supported in batch mode.'
+                % cmd)
+    if opts.jobs < 1:
+        optparser.error("Number of jobs must be at least 1.")
+
+    cards = expand_cards(args[1:])
+    out = sys.stdout
+    ret = 0
+    if opts.jobs == 1 or len(cards) == 1:
+        for card in cards:
+            result = run_card(card, cmd, cmd_args, opts.ignore_ecc)
+            write_result(out, result)
+            ret = ret or result["returncode"]
+        return ret
+
+    with futures.ProcessPoolExecutor(
+            max_workers = min(opts.jobs, len(cards))) as pool:
+        pending = [pool.submit(run_card, card, cmd, cmd_args,
+                       opts.ignore_ecc)
+               for card in cards]
+        for future in futures.as_completed(pending):
+            result = future.result()
+            write_result(out, result)
+            ret = ret or result["returncode"]
+    return ret
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -54,6 +54,7 @@ class DirListControl(wx.ListCtrl):
         self.config = config
         self.selected = set()
         self.dirtable = []
+        self.summary = None
 
         self.evt_select = evt_select
         wx.ListCtrl.__init__(self, parent, wx.ID_ANY,
@@ -64,43 +65,34 @@ class DirListControl(wx.ListCtrl):
         self.Bind(wx.EVT_LIST_ITEM_DESELECTED, self.evt_item_deselected)
 
 
-    def _update_dirtable(self, mc, dir):
+    def _update_dirtable(self, summary):
         self.dirtable = table = []
         enc = "unicode"
         if self.config.get_ascii():
             enc = "ascii"
-        for ent in dir:
-            if not ps2mc.mode_is_dir(ent[0]):
-                continue
-
-            dirname = ent[8].decode("ascii")
-            dirpath = "/" + dirname
-
-            if ps2mc.mode_is_psx_dir(ent[0]):
+        for save in summary.saves:
+            if ps2mc.mode_is_psx_dir(save.mode):
                 type = self.TableEntry.Type.PS1
-                title = (dirname, "")
+                title = (save.name, "")
                 icon_sys = None
             else:
                 type = self.TableEntry.Type.PS2
-                icon_sys_data = mc.get_icon_sys(dirpath)
-                if icon_sys_data is None:
+                if save.icon_sys is None:
                     continue
-                icon_sys = ps2iconsys.IconSys(icon_sys_data)
+                icon_sys = ps2iconsys.IconSys(save.icon_sys)
                 title = icon_sys.get_title(enc)
 
-            size = mc.dir_size(dirpath)
-            table.append(self.TableEntry(type, ent, icon_sys, size, title))
+            table.append(self.TableEntry(type, save.dirent, icon_sys,
+                                         save.size, title))
 
 
     def update_dirtable(self, mc):
         self.dirtable = []
+        self.summary = None
         if mc is None:
             return
-        dir = mc.dir_open("/")
-        try:
-            self._update_dirtable(mc, dir)
-        finally:
-            dir.close()
+        self.summary = mc.summarize()
+        self._update_dirtable(self.summary)
 
 
     def cmp_dir_name(self, i1, i2):
@@ -256,8 +256,11 @@ class GuiFrame(wx.Frame):
         if mc == None:
             status = "No memory card image"
         else:
-            free = mc.get_free_space() // 1024
-            limit = mc.get_allocatable_space() // 1024
+            summary = self.dirlist.summary
+            if summary is None:
+                summary = mc.summarize()
+            free = summary.free_space // 1024
+            limit = summary.allocatable_space // 1024
             status = "%dK of %dK free" % (free, limit)
         self.statusbar.SetStatusText(status, 1)
 
@@ -270,7 +273,7 @@ class GuiFrame(wx.Frame):
         f = None
         try:
             f = open(filename, "r+b")
-            mc = ps2mc.ps2mc(f)
+            mc = ps2mc.ps2mc(f, fat_in_memory = True)
         except EnvironmentError as value:
             if f != None:
                 f.close()
@@ -372,7 +375,9 @@ class GuiFrame(wx.Frame):
                          dir, longname, "psu",
                          "EMS save file (.psu)|*.psu"
                          "|MAXDrive save file (.max)"
-                         "|*.max",
+                         "|*.max"
+                         "|Codebreaker save file (.cbs)"
+                         "|*.cbs",
                          (wx.FD_OVERWRITE_PROMPT
                           | wx.FD_SAVE),
                          self)
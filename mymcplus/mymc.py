@@ -19,8 +19,11 @@
 
 import sys
 import os
+import struct
+import json
 import optparse
 import textwrap
+from concurrent import futures
 from errno import EEXIST, EIO
 
 from . import ps2mc
@@ -29,6 +32,7 @@ from .ps2mc_dir import *
 from .save import format_codebreaker, format_ems, format_max_drive, format_sharkport, format_psv
 from . import verbuild
 from . import ps2iconsys
+from .utils import zero_terminate
 
 class subopt_error(Exception):
     pass
@@ -91,7 +95,7 @@ def _copy(fout, fin):
     """copy the contents of one file to another"""
     
     while True:
-        s = fin.read(1024)
+        s = fin.read(65536)
         if not s:
             break
         fout.write(s)
@@ -197,43 +201,99 @@ def do_remove(cmd, mc, opts, args, opterr):
     for filename in args:
         mc.remove(filename)
 
+def _load_save_file(filename):
+    sf = ps2save.PS2SaveFile()
+    f = open(filename, "rb")
+    try:
+        format = ps2save.poll_format(f)
+        f.seek(0)
+        if format is not None:
+            format.load(sf, f)
+        else:
+            raise io_error(EIO, "Save file format not recognized", filename)
+    finally:
+        f.close()
+    return sf
+
+def _import_worker(filename):
+    """Load and fully decode a save file in a worker process."""
+    
+    sf = _load_save_file(filename)
+    sf.load_deferred()
+    return sf
+
 def do_import(cmd, mc, opts, args, opterr):
     if len(args) < 1:
         opterr("Filename required.")
+    if opts.jobs < 1:
+        opterr("Number of jobs must be at least 1.")
 
     args = glob_args(args, glob)
     if opts.directory != None and len(args) > 1:
         opterr("The -d option can only be used with a"
                "single savefile.")
+
+    if opts.jobs == 1 or len(args) < 2:
+        saves = map(_load_save_file, args)
+        progress = ""
+        pool = None
+    else:
+        # Save files are decoded by the pool in parallel, but
+        # imported here one at a time in the order given.
+        pool = futures.ProcessPoolExecutor(max_workers = opts.jobs)
+        saves = pool.map(_import_worker, args)
+        progress = "[%d/%d] "
         
-    for filename in args:
-        sf = ps2save.PS2SaveFile()
-        f = open(filename, "rb")
-        try:
-            format = ps2save.poll_format(f)
-            f.seek(0)
-            if format is not None:
-                format.load(sf, f)
-            else:
-                raise io_error(EIO, "Save file format not recognized", filename)
-        finally:
-            f.close()
-        dirname = opts.directory
-        if dirname == None:
-            dirname = sf.get_directory()[8].decode("ascii")
-        print("Importing", filename, "to", dirname)
-        if not mc.import_save_file(sf, opts.ignore_existing, opts.directory):
-            print (filename + ": already in memory card image,"
-                   " ignored.")
+    try:
+        for (i, (filename, sf)) in enumerate(zip(args, saves)):
+            dirname = opts.directory
+            if dirname == None:
+                dirname = sf.get_directory()[8].decode("ascii")
+            if progress:
+                sys.stdout.write(progress % (i + 1, len(args)))
+            print("Importing", filename, "to", dirname)
+            if not mc.import_save_file(sf, opts.ignore_existing,
+                           opts.directory):
+                print (filename + ": already in memory card image,"
+                       " ignored.")
+    finally:
+        if pool != None:
+            # cancels anything not yet decoded
+            saves.close()
+            pool.shutdown()
 
 #re_num = re.compile("[0-9]+")
 
+def _save_export(sf, f, type, level):
+    if type == "max":
+        format_max_drive.save(sf, f)
+    elif type == "cbs":
+        format_codebreaker.save(sf, f, level)
+    elif type == "psv":
+        format_psv.save(sf, f)
+    else:
+        format_ems.save(sf, f)
+
+def _export_worker(sf, filename, type, level):
+    """Write an exported save file in a worker process."""
+    
+    f = open(filename, "wb")
+    try:
+        _save_export(sf, f, type, level)
+    finally:
+        f.close()
+    return filename
+
 def do_export(cmd, mc, opts, args, opterr):
     if len(args) < 1:
         opterr("Directory name required")
 
     if opts.overwrite_existing and opts.ignore_existing:
         opterr("The -i and -f options are mutually exclusive.")
+    if opts.jobs < 1:
+        opterr("Number of jobs must be at least 1.")
+    if opts.level < 0 or opts.level > 9:
+        opterr("Compression level must be between 0 and 9.")
         
     args = glob_args(args, mc.glob)
     if opts.output_file is not None:
@@ -244,38 +304,55 @@ def do_export(cmd, mc, opts, args, opterr):
 
     if opts.directory is not None:
         os.chdir(opts.directory)
+
+    pool = None
+    pending = []
+    if opts.jobs > 1 and len(args) > 1:
+        pool = futures.ProcessPoolExecutor(max_workers = opts.jobs)
         
-    for dirname in args:
-        sf = mc.export_save_file(dirname)
-        filename = opts.output_file
-        if opts.longnames:
-            filename = (ps2save.make_longname(dirname, sf) + "." + opts.type)
-        if filename == None:
-            filename = dirname + "." + opts.type
+    try:
+        for dirname in args:
+            sf = mc.export_save_file(dirname)
+            filename = opts.output_file
+            if opts.longnames:
+                filename = (ps2save.make_longname(dirname, sf) + "." + opts.type)
+            if filename == None:
+                filename = dirname + "." + opts.type
                 
-        if not opts.overwrite_existing:
-            exists = True
-            try:
-                open(filename, "rb").close()
-            except EnvironmentError:
-                exists = False
-            if exists:
-                if opts.ignore_existing:
-                    continue
-                raise io_error(EEXIST, "File exists", filename)
-            
-        f = open(filename, "wb")
-        try:
-            print("Exporing", dirname, "to", filename)
+            if not opts.overwrite_existing:
+                exists = True
+                try:
+                    open(filename, "rb").close()
+                except EnvironmentError:
+                    exists = False
+                if exists:
+                    if opts.ignore_existing:
+                        continue
+                    raise io_error(EEXIST, "File exists", filename)
+
+            if pool != None:
+                # The card is read here, the compression and
+                # writing is done by the pool.
+                print("Exporing", dirname, "to", filename)
+                pending.append(pool.submit(_export_worker, sf,
+                               os.path.abspath(filename),
+                               opts.type, opts.level))
+                continue
             
-            if opts.type == "max":
-                format_max_drive.save(sf, f)
-            elif opts.type == "psv":
-                format_psv.save(sf, f)
-            else:
-                format_ems.save(sf, f)
-        finally:
-            f.close()
+            f = open(filename, "wb")
+            try:
+                print("Exporing", dirname, "to", filename)
+                _save_export(sf, f, opts.type, opts.level)
+            finally:
+                f.close()
+
+        for future in futures.as_completed(pending):
+            future.result()
+    finally:
+        if pool != None:
+            for future in pending:
+                future.cancel()
+            pool.shutdown()
 
 def do_delete(cmd, mc, opts, args, opterr):
     if len(args) < 1:
@@ -322,81 +399,64 @@ def do_setmode(cmd, mc, opts, args, opterr):
             ent[0] = value
         mc.set_dirent(arg, ent)
 
-def _get_ps2_title(mc, encoding):
-    s = mc.get_icon_sys(".")
-    if s is None:
+def _get_ps2_title(icon_sys, encoding):
+    if icon_sys is None:
         return None
     try:
-        icon_sys = ps2iconsys.IconSys(s)
+        icon_sys = ps2iconsys.IconSys(icon_sys)
     except ps2iconsys.Error:
         return None
 
     return icon_sys.get_title(encoding)
 
-def _get_psx_title(mc, savename, enc):
-    mode = mc.get_mode(savename)
-    if mode == None or not mode_is_file(mode):
-        return None
-    f = mc.open(savename)
-    s = f.read(128)
-    if len(s) != 128:
+def _get_psx_title(header, enc):
+    if header is None:
         return None
-    (magic, icon, blocks, title) = struct.unpack("<2sBB64s28x32x", s)
-    if magic != "SC":
+    (magic, icon, blocks, title) = struct.unpack("<2sBB64s28x32x", header)
+    if magic != b"SC":
         return None
-    return [ps2save.shift_jis_conv(zero_terminate(title), enc).decode(enc), ""]
+    return [ps2iconsys.shift_jis_conv(zero_terminate(title), enc), ""]
 
 def do_dir(cmd, mc, opts, args, opterr):
     if len(args) != 0:
         opterr("Incorrect number of arguments.")
-    f = None
-    dir = mc.dir_open("/")
-    try:
-        for ent in list(dir)[2:]:
-            dirmode = ent[0]
-            if not mode_is_dir(dirmode):
-                continue
-            dirname = "/" + ent[8].decode("ascii")
-            mc.chdir(dirname)
-            length = mc.dir_size(".");
-            if opts.ascii:
-                enc = "ascii"
-            else:
-                enc = getattr(sys.stdout, "encoding", None)
-            if dirmode & DF_PSX:
-                title = _get_psx_title(mc, ent[8], enc)
-            else:
-                title = _get_ps2_title(mc, enc)
-            if title == None:
-                title = ["Corrupt", ""]
-            protection = dirmode & (DF_PROTECTED | DF_WRITE)
-            if protection == 0:
-                protection = "Delete Protected"
-            elif protection == DF_WRITE:
-                protection = "Not Protected"
-            elif protection == DF_PROTECTED:
-                protection = "Copy & Delete Protected"
-            else:
-                protection = "Copy Protected"
-
-            type = None
-            if dirmode & DF_PSX:
-                type = "PlayStation"
-                if dirmode & DF_POCKETSTN:
-                    type = "PocketStation"
-            if type != None:
-                protection = type
-                
-            print("%-32s %s" % (ent[8].decode("ascii"), title[0]))
-            print ("%4dKB %-25s %s"
-                   % (length // 1024, protection, title[1]))
-            print()
-    finally:
-        if f != None:
-            f.close()
-        dir.close()
+    summary = mc.summarize()
+    if opts.ascii:
+        enc = "ascii"
+    else:
+        enc = getattr(sys.stdout, "encoding", None)
+    for save in summary.saves:
+        dirmode = save.mode
+        if dirmode & DF_PSX:
+            title = _get_psx_title(save.psx_header, enc)
+        else:
+            title = _get_ps2_title(save.icon_sys, enc)
+        if title == None:
+            title = ["Corrupt", ""]
+        protection = dirmode & (DF_PROTECTED | DF_WRITE)
+        if protection == 0:
+            protection = "Delete Protected"
+        elif protection == DF_WRITE:
+            protection = "Not Protected"
+        elif protection == DF_PROTECTED:
+            protection = "Copy & Delete Protected"
+        else:
+            protection = "Copy Protected"
+
+        type = None
+        if dirmode & DF_PSX:
+            type = "PlayStation"
+            if dirmode & DF_POCKETSTN:
+                type = "PocketStation"
+        if type != None:
+            protection = type
+            
+        print("%-32s %s" % (save.name, title[0]))
+        print ("%4dKB %-25s %s"
+               % (save.size // 1024, protection, title[1]))
+        print()
         
-    free = mc.get_free_space() // 1024
+    free = summary.free_space // 1024
     if free > 999999:
         free = "%d,%03d,%03d" % (free // 1000000, free // 1000 % 1000, free % 1000)
     elif free > 999:
@@ -419,6 +479,52 @@ def do_check(cmd, mc, opts, args, opterr):
         return 0
     return 1
     
+def do_defrag(cmd, mc, opts, args, opterr):
+    if len(args) != 0:
+        opterr("Incorrect number of arguments.")
+    st = mc.defragment(opts.reclaim_lost)
+    if st["lost_clusters"] > 0:
+        print("%d lost clusters freed." % st["lost_clusters"])
+    print("%d files and directories in %d clusters."
+          % (st["chains"], st["clusters"]))
+    print("Extents before: %d, after: %d."
+          % (st["extents_before"], st["extents_after"]))
+    print("%d clusters moved, %d clusters written."
+          % (st["clusters_moved"], st["clusters_written"]))
+    
+def do_layout(cmd, mc, opts, args, opterr):
+    if len(args) != 0:
+        opterr("Incorrect number of arguments.")
+    report = mc.layout_report()
+    if opts.json:
+        json.dump(report, sys.stdout, indent = 1, sort_keys = True)
+        print()
+        return
+
+    def summary(a):
+        return ("%d files, %d clusters in %d extents"
+            " (average %.1f), %d fragmented, %d bytes slack"
+            % (a["files"], a["clusters"], a["extents"],
+               a["average_extent_length"], a["fragmented_files"],
+               a["slack"]))
+    
+    print("Card:", summary(report["card"]))
+    print("FAT clusters used by chains:", report["card"]["fat_clusters"])
+    free = report["free"]
+    print("Free: %d clusters in %d extents, largest %d"
+          % (free["clusters"], free["extents"], free["largest_extent"]))
+    for key in sorted(free["histogram"].keys(),
+              key = lambda k: int(k.split("-")[0])):
+        print("  %11s clusters: %d" % (key, free["histogram"][key]))
+    print()
+    for save in report["saves"]:
+        print("%-32s %s" % (save["name"], summary(save)))
+        if opts.verbose:
+            for f in save["file_list"]:
+                print("    %-40s %8d bytes %5d clusters %4d extents"
+                      % (f["name"], f["length"], f["clusters"],
+                     f["extents"]))
+
 def do_format(cmd, mcname, opts, args, opterr):
     if len(args) != 0:
         opterr("Incorrect number of arguments.")
@@ -550,7 +656,10 @@ cmd_table = {
             help = ("Ignore files that already exist"
                 "on the image.")),
             opt("-d", "--directory", metavar="DEST",
-            help = 'Import to "DEST".')]),
+            help = 'Import to "DEST".'),
+            opt("-j", "--jobs", type = "int", default = 1,
+            metavar = "N",
+            help = "Decode up to N save files at once.")]),
     "export": (do_export, "rb",
            "directory ...",
            "Export save files from the memory card.",
@@ -571,6 +680,17 @@ cmd_table = {
             opt("-m", "--max-drive", action = "store_const",
             dest = "type", const = "max",
             help = "Use the MAX Drive save file format."),
+            opt("-c", "--codebreaker", action = "store_const",
+            dest = "type", const = "cbs",
+            help = "Use the Codebreaker .cbs save file format."),
+            opt("-z", "--level", type = "int", default = 9,
+            metavar = "N",
+            help = ("Compress Codebreaker save files at zlib"
+                " level N. [default: 9]")),
+            opt("-j", "--jobs", type = "int", default = 1,
+            metavar = "N",
+            help = ("Compress and write up to N save files"
+                " at once.")),
             #opt("-s", "--psv", action="store_const",
             #dest="type", const="psv",
             #help="Use the PSV (PlayStation 3) save file format.")
@@ -630,6 +750,21 @@ cmd_table = {
           "",
           "Check for file system errors.",
           []),
+    "defrag": (do_defrag, "r+b",
+           "",
+           ("Make every file contiguous and the free space one"
+            " block.  Interrupting it corrupts the image, so back"
+            " the image up first."),
+           [opt("-r", "--reclaim-lost", action = "store_true",
+            help = ("Free lost clusters instead of refusing"
+                " to defragment."))]),
+    "layout": (do_layout, "rb",
+           "",
+           "Report fragmentation and free space layout.",
+           [opt("-j", "--json", action="store_true",
+            help = "Output the report as JSON."),
+            opt("-v", "--verbose", action="store_true",
+            help = "List every file.")]),
     "format": (do_format, None,
            "",
            "Creates a new memory card image.",
@@ -704,6 +839,18 @@ class my_help_formatter(optparse.IndentedHelpFormatter):
             lines.append(line)
         return "\n".join(lines) + "\n"
 
+def write_cache_stats(stats):
+    for name in sorted(stats.keys()):
+        st = stats[name]
+        length = st["length"]
+        if length == None:
+            length = "unlimited"
+        sys.stderr.write("%s cache: %s/%s entries, %d hits, %d misses,"
+                 " %d evictions, %d writebacks\n"
+                 % (name, st["entries"], length, st["hits"],
+                    st["misses"], st["evictions"],
+                    st["writebacks"]))
+
 def main(argv=sys.argv):
     prog = argv[0]
     usage = "usage: %prog [-ih] memcard.ps2 command [...]"
@@ -724,6 +871,20 @@ def main(argv=sys.argv):
                  default = False, help = optparse.SUPPRESS_HELP)
     optparser.add_option("-i", "--ignore-ecc", action = "store_true",
                  help = "Ignore ECC errors while reading.")
+    optparser.add_option("--mmap", action = "store_true",
+                 default = False,
+                 help = "Access the image through a memory map.")
+    optparser.add_option("--fat-cache-size", type = "int",
+                 default = 12, metavar = "N",
+                 help = "Number of FAT clusters to cache,"
+                 " 0 for no limit.")
+    optparser.add_option("--cluster-cache-size", type = "int",
+                 default = 64, metavar = "N",
+                 help = "Number of data clusters to cache,"
+                 " 0 for no limit.")
+    optparser.add_option("--stats", action = "store_true",
+                 default = False,
+                 help = "Print cache statistics when done.")
                  
     optparser.disable_interspersed_args()
     (opts, args) = optparser.parse_args(args=argv[1:])
@@ -739,6 +900,8 @@ def main(argv=sys.argv):
 
     if len(args) < 2:
         optparser.error("Incorrect number of arguments.")
+    if opts.fat_cache_size < 0 or opts.cluster_cache_size < 0:
+        optparser.error("Cache sizes can't be negative.")
 
     if opts.debug:
         cmd_table.update(debug_cmd_table)
@@ -771,9 +934,19 @@ def main(argv=sys.argv):
                      subopt_parser.error)
             else:
                 f = open(mcname, mode)
-                mc = ps2mc.ps2mc(f, opts.ignore_ecc)
+                mc = ps2mc.ps2mc(f, opts.ignore_ecc,
+                         use_mmap = opts.mmap,
+                         fat_in_memory = True,
+                         fat_cache_size
+                         = opts.fat_cache_size or None,
+                         alloc_cluster_cache_size
+                         = opts.cluster_cache_size or None)
                 ret = fn(cmd, mc, subopts, subargs,
                      subopt_parser.error)
+                if opts.stats:
+                    # flush first so the writebacks are counted
+                    mc.flush()
+                    write_cache_stats(mc.cache_stats())
         finally:
             if mc != None:
                 mc.close()
@@ -20,6 +20,11 @@
 import sys
 import array
 import struct
+import io
+import mmap
+import bisect
+import collections
+import contextlib
 from errno import EACCES, ENOENT, EEXIST, ENOTDIR, EISDIR, EROFS, ENOTEMPTY,\
      ENOSPC, EIO, EBUSY
 import fnmatch
@@ -29,6 +34,7 @@ from .round import *
 from .ps2mc_ecc import *
 from .ps2mc_dir import *
 from .save import ps2save
+from . import utils
 
 PS2MC_MAGIC = b"Sony PS2 Memory Card Format "
 PS2MC_FAT_ALLOCATED_BIT = 0x80000000
@@ -90,6 +96,7 @@ if sys.byteorder == "big":
     def unpack_32bit_array(s):
         a = array.array('I', s)
         a.byteswap()
+        return a
 
     def pack_32bit_array(a):
         a = a[:]
@@ -122,149 +129,350 @@ def pack_superblock(sb):
 unpack_fat = unpack_32bit_array
 pack_fat = pack_32bit_array
 
+# Maps the most significant byte of a little endian FAT entry to 1 if
+# the entry is free, otherwise 0.
+_fat_free_trans = bytes([(b & 0x80) == 0 for b in range(256)])
+
+def _runs(clusters):
+    """Split a list of cluster numbers into (start, count) tuples of
+    consecutive clusters, keeping the order of the list."""
+
+    runs = []
+    for c in clusters:
+        if len(runs) > 0 and runs[-1][0] + runs[-1][1] == c:
+            runs[-1][1] += 1
+        else:
+            runs.append([c, 1])
+    return [tuple(a) for a in runs]
+
+def _buffer_runs(clusters):
+    """Sort a list of (cluster, buffer) pairs and group them into
+    (start, buffers) tuples of consecutive clusters."""
+
+    clusters = sorted(clusters, key = lambda a: a[0])
+    ret = []
+    i = 0
+    for (start, count) in _runs([n for (n, _) in clusters]):
+        ret.append((start, [buf for (_, buf) in clusters[i : i + count]]))
+        i += count
+    return ret
+
 class lru_cache(object):
-    def __init__(self, length):
-        self._lru_list = [[i - 1, None, None, i + 1]
-                  for i in range(length + 1)]
-        self._index_map = {}
+    """A least recently used cache.
+
+    If length is None the cache is unbounded, otherwise it must be
+    at least 1.  The hits, misses and
+    evictions counters are maintained by the cache, writebacks is
+    incremented by the cache's user when it writes back an entry."""
+    
+    def __init__(self, length = None):
+        if length != None and length < 1:
+            raise ValueError("cache length must be at least 1")
+        self.length = length
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
 
     def dump(self):
-        lru_list = self._lru_list
-        i = 0
-        while i != len(self._lru_list):
-            print("%d: %s, " % (i, str(lru_list[i][1])), end=' ') 
-            i = lru_list[i][3]
+        for (key, value) in reversed(self._entries.items()):
+            print("%s, " % str(key), end=' ') 
         print()
-        print(self._index_map)
             
-    def _move_to_front(self, i):
-        lru_list = self._lru_list
-        first = lru_list[0]
-        i2 = first[3]
-        if i != i2:
-            elt = lru_list[i]
-            prev = lru_list[elt[0]]
-            next = lru_list[elt[3]]
-            prev[3] = elt[3]
-            next[0] = elt[0]
-            elt[0] = 0
-            elt[3] = i2
-            lru_list[i2][0] = i
-            first[3] = i
-        
     def add(self, key, value):
-        lru_list = self._lru_list
-        index_map = self._index_map
-        ret = None
-        if key in index_map:
-            i = index_map[key]
-            # print "add hit ", key, i
-            elt = lru_list[i]
-        else:
-            # print "add miss", key
-            i = lru_list[-1][0]
-            elt = lru_list[i]
-            old_key = elt[1]
-            if old_key != None:
-                del index_map[old_key]
-                ret = (old_key, elt[2])
-            index_map[key] = i
-            elt[1] = key
-        elt[2] = value
-        self._move_to_front(i)
+        """Add or replace an entry, making it the most recently used.
 
+        Returns the evicted (key, value) pair or None."""
+        
+        entries = self._entries
+        ret = None
+        if key in entries:
+            entries.move_to_end(key)
+        elif self.length != None and len(entries) >= self.length:
+            ret = entries.popitem(last = False)
+            self.evictions += 1
+        entries[key] = value
         return ret
         
+    def peek(self, key, default = None):
+        """Like get(), but doesn't count as a use of the entry."""
+        return self._entries.get(key, default)
+        
     def get(self, key, default = None):
-        i = self._index_map.get(key)
-        if i == None:
-            # print "get miss", key
+        entries = self._entries
+        if key not in entries:
+            self.misses += 1
             return default
-        # print "get hit ", key, i
-        ret = self._lru_list[i][2]
-        self._move_to_front(i)
-        return ret
+        self.hits += 1
+        entries.move_to_end(key)
+        return entries[key]
 
     def items(self):
-        return [(elt[1], elt[2])
-            for elt in self._lru_list[1 : -1]
-            if elt[2] != None]
+        return list(self._entries.items())
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return a dictionary of the cache's counters."""
+        
+        return {"length": self.length,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "writebacks": self.writebacks}
         
 class fat_chain(object):
-    """A class for accessing a file's FAT entries as a simple sequence."""
+    """A class for accessing a file's FAT entries as a simple sequence.
+
+    The chain is resolved lazily into a list of extents, runs of
+    physically contiguous clusters, so random access only needs a
+    binary search."""
+
+    detached = False
     
-    def __init__(self, lookup_fat, first):
+    def __init__(self, lookup_fat, first, owners = None):
         self.lookup_fat = lookup_fat
         self._first = first
-        self.offset = 0
-        self._prev = None
-        self._cur = first
-
-    def __getitem__(self, i):
-        # not iterable
-        offset = self.offset
-        if i == offset:
-            # print "@@@ fat_chain[] cur:", i, self._cur
-            return self._cur
-        elif i == offset - 1:
-            assert self._prev != None
-            # print "@@@ fat_chain[] prev:", i, self._prev
-            return self._prev
-        if i < offset:
-            if i == 0:
-                # print "@@@ fat_chain[] first", i, self._first
-                return self._first
-            offset = 0
-            prev = None
-            cur = self._first
-        else:
-            prev = self._prev
-            cur = self._cur
-        # print "@@@ fat_chain[] distance", i - offset
-        while offset != i:
-            next = self.lookup_fat(cur)
-            if next == PS2MC_FAT_CHAIN_END:
-                break;
-            if next & PS2MC_FAT_ALLOCATED_BIT:
-                next &= ~PS2MC_FAT_ALLOCATED_BIT
+        self._owners = owners
+        self._offsets = []
+        self._starts = []
+        self._lengths = []
+        self._count = 0
+        self._complete = True
+        if first != PS2MC_FAT_CHAIN_END:
+            self._offsets.append(0)
+            self._starts.append(first)
+            self._lengths.append(1)
+            self._count = 1
+            self._complete = False
+            self._register(first)
+
+    def _register(self, n):
+        """Record that cluster n is part of this chain."""
+        
+        owners = self._owners
+        if owners != None:
+            heads = owners.get(n)
+            if heads == None:
+                owners[n] = set([self._first])
             else:
+                heads.add(self._first)
+
+    def _unregister(self, start, length):
+        owners = self._owners
+        if owners == None:
+            return
+        first = self._first
+        for n in range(start, start + length):
+            heads = owners.get(n)
+            if heads != None:
+                heads.discard(first)
+                if len(heads) == 0:
+                    del owners[n]
+
+    def _resolve(self, i):
+        """Follow the chain until entry i is known or the chain ends."""
+        
+        lookup_fat = self.lookup_fat
+        register = self._register
+        offsets = self._offsets
+        starts = self._starts
+        lengths = self._lengths
+        count = self._count
+        cur = starts[-1] + lengths[-1] - 1
+        while count <= i:
+            next = lookup_fat(cur)
+            if (next & PS2MC_FAT_ALLOCATED_BIT) == 0:
                 # corrupt
-                next = PS2MC_FAT_CHAIN_END
+                self._complete = True
                 break
-
-            offset += 1
-            prev = cur
+            if next == PS2MC_FAT_CHAIN_END:
+                self._complete = True
+                break
+            next &= ~PS2MC_FAT_ALLOCATED_BIT
+            if next == cur + 1:
+                lengths[-1] += 1
+            else:
+                offsets.append(count)
+                starts.append(next)
+                lengths.append(1)
+            register(next)
+            count += 1
             cur = next
-        self.offset = offset
-        self._prev = prev
-        self._cur = cur
-        # print "@@@ offset, prev, cur:", offset, prev, cur
-        # print "@@@ fat_chain[]", i, next
-        return next
+        self._count = count
+
+    def __getitem__(self, i):
+        # not iterable
+        if i >= self._count:
+            if self._complete:
+                return PS2MC_FAT_CHAIN_END
+            self._resolve(i)
+            if i >= self._count:
+                return PS2MC_FAT_CHAIN_END
+        k = bisect.bisect_right(self._offsets, i) - 1
+        return self._starts[k] + i - self._offsets[k]
 
     def __len__(self):
-        old_prev = self._prev
-        old_cur = self._cur
-        old_offset = self.offset
-        i = self.offset
-        while self[i] != PS2MC_FAT_CHAIN_END:
-            i += 1
-        self._prev = old_prev
-        self._cur = old_cur
-        self.offset = old_offset
-        return i
+        if not self._complete:
+            self._resolve(sys.maxsize)
+        return self._count
+
+    def run(self, i, count):
+        """Return the cluster of entry i and the number of physically
+        contiguous clusters following it, up to count."""
+
+        if self[i] == PS2MC_FAT_CHAIN_END:
+            return (PS2MC_FAT_CHAIN_END, 0)
+        self[i + count - 1]
+        k = bisect.bisect_right(self._offsets, i) - 1
+        n = i - self._offsets[k]
+        return (self._starts[k] + n, min(self._lengths[k] - n, count))
+
+    def extents(self):
+        """Return the entire chain as a list of (start, length) tuples."""
+        
+        len(self)
+        return list(zip(self._starts, self._lengths))
+
+    def invalidate(self, n):
+        """Forget the part of the chain after cluster n.
+
+        Called when the FAT entry of cluster n is changed."""
+        
+        starts = self._starts
+        lengths = self._lengths
+        for k in range(len(starts)):
+            off = n - starts[k]
+            if off >= 0 and off < lengths[k]:
+                self._unregister(n + 1, lengths[k] - off - 1)
+                for j in range(k + 1, len(starts)):
+                    self._unregister(starts[j], lengths[j])
+                lengths[k] = off + 1
+                self._count = self._offsets[k] + off + 1
+                del self._offsets[k + 1:]
+                del starts[k + 1:]
+                del lengths[k + 1:]
+                self._complete = False
+                return
+
+    def forget(self):
+        """Remove the chain from the map of clusters to chains.
+
+        Called when the chain is evicted from the cache, after which
+        it's no longer kept up to date."""
+        
+        for (start, length) in zip(self._starts, self._lengths):
+            self._unregister(start, length)
+        self.detached = True
+        
+class free_extent_index(object):
+    """The runs of free allocatable clusters.
+
+    The extents attribute is a list of (length, start) tuples sorted
+    by length for best fit allocation.  The index is kept up to date
+    one cluster at a time as clusters are allocated and freed."""
+
+    def __init__(self, free, limit):
+        self.extents = []
+        self._starts = []
+        self._lengths = {}
+        i = free.find(1, 0, limit)
+        while i != -1:
+            j = free.find(0, i, limit)
+            if j == -1:
+                j = limit
+            self.extents.append((j - i, i))
+            self._starts.append(i)
+            self._lengths[i] = j - i
+            i = free.find(1, j, limit)
+        self.extents.sort()
+
+    def _add(self, start, length):
+        bisect.insort(self.extents, (length, start))
+        bisect.insort(self._starts, start)
+        self._lengths[start] = length
+
+    def _remove(self, start):
+        length = self._lengths.pop(start)
+        extents = self.extents
+        del extents[bisect.bisect_left(extents, (length, start))]
+        del self._starts[bisect.bisect_left(self._starts, start)]
+        return length
+
+    def _find(self, n):
+        """Return the start of the extent containing cluster n."""
+        
+        starts = self._starts
+        k = bisect.bisect_right(starts, n) - 1
+        if k >= 0 and starts[k] + self._lengths[starts[k]] > n:
+            return starts[k]
+        return None
+
+    def allocated(self, n):
+        """Remove cluster n from the index."""
         
-class ps2mc_file(object):
+        start = self._find(n)
+        if start == None:
+            return
+        length = self._remove(start)
+        if n > start:
+            self._add(start, n - start)
+        if n + 1 < start + length:
+            self._add(n + 1, start + length - n - 1)
+
+    def freed(self, n):
+        """Add cluster n to the index, merging it with its neighbours."""
+        
+        if self._find(n) != None:
+            return
+        start = n
+        length = 1
+        prev = self._find(n - 1)
+        if prev != None:
+            length += self._remove(prev)
+            start = prev
+        if n + 1 in self._lengths:
+            length += self._remove(n + 1)
+        self._add(start, length)
+
+    def best_fit(self, count):
+        """Return the smallest (length, start) extent of at least
+        count clusters or None."""
+        
+        extents = self.extents
+        k = bisect.bisect_left(extents, (count, -1))
+        if k == len(extents):
+            return None
+        return extents[k]
+
+    def __len__(self):
+        return len(self.extents)
+
+    def __iter__(self):
+        return iter(self.extents)
+
+class ps2mc_file(io.RawIOBase):
     """A file-like object for accessing a file in memory card image."""
     
     def __init__(self, mc, dirloc, first_cluster, length, mode,
-             name = None):
+             name = None, defer_dirent = True):
         # print "ps2mc_file.__init__", name, self
+        io.RawIOBase.__init__(self)
         self.mc = mc
         self.length = length
         self.first_cluster = first_cluster
         self.dirloc = dirloc
         self.fat_chain = None
+        self.defer_dirent = defer_dirent
+        self._dirent_first = False
+        self._dirent_length = False
+        self._dirent_modified = False
         self._pos = 0
         self.buffer = None
         self.buffer_cluster = None
@@ -273,7 +481,6 @@ class ps2mc_file(object):
             self.name = "<ps2mc_file>"
         else:
             self.name = name
-        self.closed = False
 
         if mode == None or len(mode) == 0:
             mode = "rb"
@@ -285,10 +492,13 @@ class ps2mc_file(object):
         elif mode[0] != "w" or ("+" not in self.mode):
             self._write = True
 
-    def _find_file_cluster(self, n):
-        if self.fat_chain == None:
+    def _file_chain(self):
+        if self.fat_chain == None or self.fat_chain.detached:
             self.fat_chain = self.mc.fat_chain(self.first_cluster)
-        return self.fat_chain[n]
+        return self.fat_chain
+
+    def _find_file_cluster(self, n):
+        return self._file_chain()[n]
         
     def read_file_cluster(self, n):
         if n == self.buffer_cluster:
@@ -301,61 +511,69 @@ class ps2mc_file(object):
         self.buffer_cluster = n
         return self.buffer 
 
-    def _extend_file(self, n):
-        mc = self.mc
-        cluster = mc.allocate_cluster()
-        # print "@@@ extending file", n, cluster
-        if cluster == None:
+    def _read_run(self, n, off, size):
+        """Read as much of size bytes, starting at offset off of file
+        cluster n, as is stored in physically contiguous clusters.
+
+        Returns None if there's no run of at least two clusters to
+        read, otherwise a tuple of the number of bytes read and a
+        memoryview of the data."""
+        
+        cluster_size = self.mc.cluster_size
+        want = div_round_up(off + size, cluster_size)
+        (first, count) = self._file_chain().run(n, want)
+        if count < 2:
             return None
+        buf = self.mc.read_allocatable_clusters(first, count)
+        l = min(count * cluster_size - off, size)
+        return (l, memoryview(buf)[off : off + l])
+
+    def _extend_file(self, n, count):
+        """Add count newly allocated clusters to the end of the file's
+        n cluster long chain.  Returns the number of clusters added."""
+        
+        mc = self.mc
+        clusters = mc.allocate_extent(count)
+        # print "@@@ extending file", n, clusters
+        if len(clusters) == 0:
+            return 0
         if n == 0:
-            self.first_cluster = cluster
+            self.first_cluster = clusters[0]
             self.fat_chain = None
-            # print "@@@ linking", self.dirloc, "->", cluster
-            mc.update_dirent(self.dirloc, self, cluster,
-                     None, False)
+            self._dirent_first = True
         else:
-            prev = self.fat_chain[n - 1]
-            # print "@@@ linking", prev, "->", cluster
-            mc.set_fat(prev, cluster | PS2MC_FAT_ALLOCATED_BIT)
-        return cluster
-    
-    def write_file_cluster(self, n, buf):
-        mc = self.mc
-        cluster = self._find_file_cluster(n)
-        if cluster != PS2MC_FAT_CHAIN_END:
-            mc.write_allocatable_cluster(cluster, buf)
-            self.buffer = buf
-            self.buffer_cluster = n
-            return True
-
-        cluster_size = mc.cluster_size
-        file_cluster_end = div_round_up(self.length, cluster_size)
-
-        if (cluster < file_cluster_end
-            or len(self.fat_chain) != file_cluster_end):
-            raise corrupt("file length doesn't match cluster"
-                    " chain length", mc.f)
-
-        for i in range(file_cluster_end, n):
-            cluster = self._extend_file(i)
-            if cluster == None:
-                if i != file_cluster_end:
-                    self.length = (i - 1) * cluster_size
-                    mc.update_dirent(self.dirloc, self,
-                             None, self.length,
-                             True)
-                return False
-            mc.write_allocatable_cluster(cluster,
-                             [b"\0"] * cluster_size)
+            prev = self._find_file_cluster(n - 1)
+            # print "@@@ linking", prev, "->", clusters[0]
+            mc.set_fat(prev, clusters[0] | PS2MC_FAT_ALLOCATED_BIT)
+        return len(clusters)
+
+    def _update_dirent(self):
+        first_cluster = length = None
+        if self._dirent_first:
+            first_cluster = self.first_cluster
+        if self._dirent_length:
+            length = self.length
+        modified = self._dirent_modified
+        self._dirent_first = False
+        self._dirent_length = False
+        self._dirent_modified = False
+        self.mc.update_dirent(self.dirloc, self, first_cluster, length,
+                      modified)
+
+    def _dirent_pending(self):
+        return (self._dirent_first or self._dirent_length
+            or self._dirent_modified)
+
+    def _notify_others(self):
+        """Give the other open handles of the file the new first
+        cluster and length without writing the directory entry."""
         
-        cluster = self._extend_file(n)
-        if cluster == None:
-            return False
-
-        mc.write_allocatable_cluster(cluster, buf)
-        self.buffer = buf
-        self.buffer_cluster = n
-        return True
+        opened = self.mc.open_files.get(self.dirloc)
+        if opened == None:
+            return
+        for f in opened[1]:
+            if f != self:
+                f.update_notify(self.first_cluster, self.length)
     
     def update_notify(self, first_cluster, length):
         if self.first_cluster != first_cluster:
@@ -365,38 +583,74 @@ class ps2mc_file(object):
         self.buffer = None
         self.buffer_cluster = None
         
-    def read(self, size = None, eol = None):
+    def readable(self):
+        return True
+
+    def writable(self):
+        return self._write or self._append
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
         if self.closed:
             raise ValueError("file is closed")
 
+        out = memoryview(b).cast("B")
         pos = self._pos
         cluster_size = self.mc.cluster_size
-        if size == None:
-            size = self.length
-        size = max(min(self.length - pos, size), 0)
-        ret = b""
+        size = max(min(self.length - pos, len(out)), 0)
+        i = 0
         while size > 0:
             off = pos % cluster_size
+            if off + size > cluster_size:
+                l = self._read_run(pos // cluster_size, off, size)
+                if l != None:
+                    (l, buf) = l
+                    out[i : i + l] = buf
+                    pos += l
+                    i += l
+                    size -= l
+                    continue
             l = min(cluster_size - off, size)
             buf = self.read_file_cluster(pos // cluster_size)
             if buf == None:
                 break
-            if eol != None:
-                i = buf.find(eol, off, off + l)
-                if i != -1:
-                    l = off - i + 1
-                    size = l
+            out[i : i + l] = memoryview(buf)[off : off + l]
             pos += l
-            self._pos = pos
-            ret += buf[off : off + l]
+            i += l
             size -= l
-        return ret
+        self._pos = pos
+        return i
+        
+    def read(self, size = -1):
+        if self.closed:
+            raise ValueError("file is closed")
+
+        if size == None or size < 0:
+            size = self.length
+        size = max(min(self.length - self._pos, size), 0)
+        buf = bytearray(size)
+        l = self.readinto(buf)
+        if l != size:
+            del buf[l:]
+        return bytes(buf)
+
+    readall = read
 
     def write(self, out, _set_modified = True):
+        """Write out to the file.
+
+        Newly needed clusters are allocated all at once and whole
+        clusters are written directly to the image.  Unless the file
+        is a directory its directory entry is only updated by flush()
+        or close()."""
+        
         if self.closed:
             raise ValueError("file is closed")
     
-        cluster_size = self.mc.cluster_size
+        mc = self.mc
+        cluster_size = mc.cluster_size
         pos = self._pos
         if self._append: 
             pos = self.length
@@ -404,56 +658,89 @@ class ps2mc_file(object):
             raise io_error(EACCES, "file not opened for writing",
                      self.name)
 
+        out = memoryview(out).cast("B")
         size = len(out)
+        if size == 0:
+            return 0
         # print "@@@ write", pos, size
+
+        need = div_round_up(pos + size, cluster_size)
+        avail = new = need
+        if self._find_file_cluster(need - 1) == PS2MC_FAT_CHAIN_END:
+            file_cluster_end = div_round_up(self.length, cluster_size)
+            if len(self._file_chain()) != file_cluster_end:
+                raise corrupt("file length doesn't match cluster"
+                        " chain length", mc.f)
+            new = file_cluster_end
+            avail = new + self._extend_file(new, need - new)
+            for n in range(new, min(pos // cluster_size, avail)):
+                cluster = self._find_file_cluster(n)
+                mc.write_allocatable_cluster(cluster,
+                                 b"\0" * cluster_size)
+        end = min(pos + size, avail * cluster_size)
+        
         i = 0
-        while size > 0:
-            cluster = pos // cluster_size
+        while pos < end:
+            n = pos // cluster_size
             off = pos % cluster_size
-            l = min(cluster_size - off, size)
-            s = out[i : i + l]
-            pos += l
+            l = min(cluster_size - off, end - pos)
             if l == cluster_size:
-                buf = s
+                (cluster, count) = self._file_chain().run(
+                    n, (end - pos) // cluster_size)
+                l = count * cluster_size
+                mc.write_allocatable_clusters(
+                    cluster,
+                    [out[j : j + cluster_size]
+                     for j in range(i, i + l, cluster_size)])
+                if (self.buffer_cluster != None
+                    and n <= self.buffer_cluster < n + count):
+                    self.buffer = None
+                    self.buffer_cluster = None
             else:
-                buf = self.read_file_cluster(cluster)
-                if buf == None:
-                    buf = b"\0" * cluster_size
-                buf = buf[:off] + s + buf[off + l:]
-            if not self.write_file_cluster(cluster, buf):
-                raise io_error(ENOSPC,
-                         "out of space on image",
-                         self.name)
-            self._pos = pos
-            # print "@@@ pos", pos
-            new_length = None
-            if pos > self.length:
-                new_length = self.length = pos
-            self.mc.update_dirent(self.dirloc, self, None,
-                          new_length, _set_modified)
-
+                if n >= new:
+                    buf = bytearray(cluster_size)
+                else:
+                    buf = bytearray(self.read_file_cluster(n))
+                buf[off : off + l] = out[i : i + l]
+                buf = bytes(buf)
+                mc.write_allocatable_cluster(
+                    self._find_file_cluster(n), buf)
+                self.buffer = buf
+                self.buffer_cluster = n
+            pos += l
             i += l
-            size -= l
+
+        self._pos = pos
+        # print "@@@ pos", pos
+        if pos > self.length:
+            self.length = pos
+            self._dirent_length = True
+        if _set_modified:
+            self._dirent_modified = True
+        if not self.defer_dirent or avail < need:
+            self._update_dirent()
+        elif self._dirent_first or self._dirent_length:
+            self._notify_others()
+        if avail < need:
+            raise io_error(ENOSPC, "out of space on image",
+                     self.name)
+        return size
+
+    def flush(self):
+        if self.mc != None and self._dirent_pending():
+            self._update_dirent()
+        io.RawIOBase.flush(self)
 
     def close(self):
         # print "ps2mc_file.close", self.name, self
         if self.mc != None:
+            if not self.closed:
+                self.flush()
             self.mc.notify_closed(self.dirloc, self)
             self.mc = None
         self.fat_chain = None
         self.buffer = None
-
-    def __next__(self):
-        r = self.readline()
-        if r == "":
-            raise StopIteration
-        return r
-
-    def readline(self, size = None):
-        return self.read(size, "\n")
-        
-    def readlines(self, sizehint):
-        return [line for line in self]
+        io.RawIOBase.close(self)
 
     def seek(self, offset, whence = 0):
         if self.closed:
@@ -467,25 +754,18 @@ class ps2mc_file(object):
             base = 0
         pos = max(base + offset, 0)
         self._pos = pos
+        return pos
 
     def tell(self):
         if self.closed:
             raise ValueError("file is closed")
         return self._pos
 
-    def __enter__(self):
-        return
-
-    def __exit__(self, a, b, c):
-        self.close()
-        return
-    
-    # def __del__(self):
-    #    # print "ps2mc_file.__del__", self
-    #    if self.mc != None:
-    #        self.mc.notify_closed(self.dirloc, self)
-    #        self.mc = None
-    #    self.fat_chain = None
+    def __del__(self):
+        # Replaces IOBase.__del__, which would call close() and write
+        # the directory entry with any errors ignored.  Open files are
+        # closed by ps2mc.close().
+        pass
         
 class ps2mc_directory(object):
     """A sequence and iterator object for directories."""
@@ -493,7 +773,8 @@ class ps2mc_directory(object):
     def __init__(self, mc, dirloc, first_cluster, length,
              mode = "rb", name = None):
         self.f = ps2mc_file(mc, dirloc, first_cluster,
-                    length * PS2MC_DIRENT_LENGTH, mode, name)
+                    length * PS2MC_DIRENT_LENGTH, mode, name,
+                    defer_dirent = False)
 
     def __iter__(self):
         start = self.tell()
@@ -508,18 +789,19 @@ class ps2mc_directory(object):
         self.seek(index)
         self.f.write(pack_dirent(ent),
                  _set_modified = set_modified)
+        self.f.mc._update_dir_index(self.f.first_cluster, index, ent)
 
     def __next__(self):
         # print "@@@ next", self.tell(), self.f.name
-        dirent = self.f.read(PS2MC_DIRENT_LENGTH)
-        if dirent == b"":
+        buf = self.f.read(PS2MC_DIRENT_LENGTH)
+        if buf == b"":
             if 0 == self._iter_end:
                 raise StopIteration
             self.seek(0)
-            dirent = self.f.read(PS2MC_DIRENT_LENGTH)
+            buf = self.f.read(PS2MC_DIRENT_LENGTH)
         elif self.tell() == self._iter_end:
             raise StopIteration
-        return unpack_dirent(dirent)
+        return dirent(buf)
 
     def seek(self, offset, whence = 0):
         self.f.seek(offset * PS2MC_DIRENT_LENGTH, whence)
@@ -533,10 +815,10 @@ class ps2mc_directory(object):
     def __getitem__(self, index):
         # print "@@@ getitem", index, self.f.name
         self.seek(index)
-        dirent = self.f.read(PS2MC_DIRENT_LENGTH)
-        if len(dirent) != PS2MC_DIRENT_LENGTH:
+        buf = self.f.read(PS2MC_DIRENT_LENGTH)
+        if len(buf) != PS2MC_DIRENT_LENGTH:
             raise dir_index_not_found(self.f.name, index)
-        return unpack_dirent(dirent)
+        return dirent(buf)
 
     def __setitem__(self, index, new_ent):
         ent = self[index]
@@ -584,15 +866,52 @@ class _root_directory(ps2mc_directory):
     def real_close(self):
         ps2mc_directory.close(self)
         
+class save_summary(object):
+    """A save directory as described by ps2mc.summarize().
+
+    icon_sys is the contents of the save's icon.sys file and
+    psx_header the first 128 bytes of a PlayStation save's file, or
+    None if they don't exist or aren't valid."""
+    
+    def __init__(self, dirloc, ent, size, icon_sys, psx_header):
+        self.dirloc = dirloc
+        self.dirent = ent
+        self.name = ent[8].decode("ascii")
+        self.mode = ent[0]
+        self.created = ent[3]
+        self.modified = ent[6]
+        self.size = size
+        self.icon_sys = icon_sys
+        self.psx_header = psx_header
+
+class card_summary(object):
+    """The save directories and space usage of a memory card as
+    returned by ps2mc.summarize()."""
+    
+    def __init__(self, saves, free_space, allocatable_space):
+        self.saves = saves
+        self.free_space = free_space
+        self.allocatable_space = allocatable_space
+
 class ps2mc(object):
     """A PlayStation 2 memory card filesystem implementation.
 
     The close() method must be called when the object is no longer needed,
     otherwise cycles that can't be collected by the garbage collector
-    will remain."""
+    will remain.
+
+    The fat_cache_size and alloc_cluster_cache_size arguments give the
+    number of clusters cached, None meaning no limit.  The caches are
+    instances of cache_class, lru_cache by default."""
     
+    cache_class = lru_cache
     open_files = None
     fat_cache = None
+    fat_chain_cache = None
+    fat_chain_owners = None
+    mmap = None
+    fat = None
+    free_extents = None
     
     def _calculate_derived(self):
         self.spare_size = div_round_up(self.page_size, 128) * 4
@@ -606,12 +925,25 @@ class ps2mc(object):
              - self.allocatable_cluster_offset)
         self.allocatable_cluster_limit = limit
 
-    def __init__(self, f, ignore_ecc = False, params = None):
+    def __init__(self, f, ignore_ecc = False, params = None,
+             use_mmap = False, fat_in_memory = False,
+             fat_cache_size = 12, alloc_cluster_cache_size = 64,
+             cache_class = None):
+        if cache_class == None:
+            cache_class = self.cache_class
         self.open_files = {}
-        self.fat_cache = lru_cache(12)
-        self.alloc_cluster_cache = lru_cache(64)
+        self.fat_cache = cache_class(fat_cache_size)
+        self.alloc_cluster_cache = cache_class(alloc_cluster_cache_size)
+        self.fat_chain_cache = cache_class(64)
+        self.fat_chain_owners = {}
+        self.dir_index = {}
         self.modified = False
+        self._batch_depth = 0
         self.f = None
+        self.mmap = None
+        self._mmap_view = None
+        self.fat = None
+        self.free_extents = None
         self.rootdir = None
         
         f.seek(0)
@@ -622,6 +954,8 @@ class ps2mc(object):
                         f)
             self.f = f
             self.format(params)
+            if use_mmap:
+                self._open_mmap()
         else:
             sb = unpack_superblock(s)
             self.version = sb[1]
@@ -640,6 +974,8 @@ class ps2mc(object):
             self._calculate_derived()
 
             self.f = f
+            if use_mmap:
+                self._open_mmap()
             self.ignore_ecc = False
 
             try:
@@ -661,9 +997,63 @@ class ps2mc(object):
             or not mode_is_dir(dot[0]) or not mode_is_dir(dotdot[0])):
             raise corrupt("Root directory damaged.")
         
+        if fat_in_memory:
+            self._load_fat()
         self.fat_cursor = 0
         self.curdir = (0, 0)
 
+    def _open_mmap(self):
+        """Map the image into memory.
+
+        Once mapped all page and cluster I/O goes through the
+        mapping instead of seeking and reading the file object."""
+        
+        f = self.f
+        f.flush()
+        mode = getattr(f, "mode", "rb")
+        if "+" in mode or "w" in mode or "a" in mode:
+            access = mmap.ACCESS_WRITE
+        else:
+            access = mmap.ACCESS_READ
+        self.mmap = mmap.mmap(f.fileno(), 0, access = access)
+        self._mmap_view = memoryview(self.mmap)
+
+    def _close_mmap(self):
+        if self._mmap_view != None:
+            self._mmap_view.release()
+            self._mmap_view = None
+        if self.mmap != None:
+            self.mmap.close()
+            self.mmap = None
+
+    def _read_raw(self, offset, size):
+        """Read size bytes of the raw image starting at offset.
+
+        When the image is memory mapped a memoryview of the mapping
+        is returned instead of a copy.  Callers must not hold on to
+        it past the current operation."""
+        
+        if self._mmap_view != None:
+            return self._mmap_view[offset : offset + size]
+        f = self.f
+        f.seek(offset)
+        return f.read(size)
+
+    def _write_raw(self, offset, buf):
+        """Write buf to the raw image starting at offset."""
+        
+        view = self._mmap_view
+        if view != None:
+            end = offset + len(buf)
+            if end > len(view):
+                raise corrupt("attempted to write past EOF"
+                        " (offset %08X)" % offset, self.f)
+            view[offset : end] = buf
+            return
+        f = self.f
+        f.seek(offset)
+        f.write(buf)
+
     def write_superblock(self):
         s = pack_superblock((PS2MC_MAGIC,
                      self.version,
@@ -685,10 +1075,9 @@ class ps2mc(object):
         self.write_page(0, s)
 
         page = b"\xFF" * self.raw_page_size
-        self.f.seek(self.good_block2 * self.pages_per_erase_block
-                * self.raw_page_size)
-        for i in range(self.pages_per_erase_block):
-            self.f.write(page)
+        self._write_raw(self.good_block2 * self.pages_per_erase_block
+                * self.raw_page_size,
+                page * self.pages_per_erase_block)
 
         self.modified = False
         return
@@ -766,11 +1155,13 @@ class ps2mc(object):
         if not with_ecc:
             self.spare_size = 0
         else:
-            ecc = b"".join([bytes(s) for s in ecc_calculate_page(erased)])
-            erased += ecc + b"\0" * (self.spare_size - len(ecc))
+            erased = ecc_encode_pages(erased, page_size,
+                          self.spare_size)
+        self.raw_page_size = len(erased)
 
+        erased *= pages_per_erase_block
         self.f.seek(0)
-        for page in range(pages_per_card):
+        for block in range(erase_blocks_per_card):
             self.f.write(erased)
 
         self.modified = True
@@ -814,66 +1205,111 @@ class ps2mc(object):
 
     def read_page(self, n):
         # print "@@@ page", n
-        f = self.f
-        f.seek(self.raw_page_size * n)
-        page = f.read(self.page_size)
-        if len(page) != self.page_size:
-            raise corrupt("attempted to read past EOF"
-                    " (page %05X)" % n, f)
+        page_size = self.page_size
         if self.ignore_ecc:
-            return page
-        spare = f.read(self.spare_size)
-        if len(spare) != self.spare_size:
+            raw = self._read_raw(self.raw_page_size * n, page_size)
+            if len(raw) != page_size:
+                raise corrupt("attempted to read past EOF"
+                        " (page %05X)" % n, self.f)
+            return bytes(raw)
+        return self._read_pages_ecc(n, 1)
+
+    def _read_pages_ecc(self, n, count):
+        """Read count consecutive pages starting at page n and check
+        them against their ECC codes."""
+        
+        size = self.raw_page_size * count
+        raw = self._read_raw(self.raw_page_size * n, size)
+        if len(raw) != size:
             raise corrupt("attempted to read past EOF"
-                    " (page %05X)" % n, f)
-        (status, page, spare) = ecc_check_page(page, spare)
+                    " (page %05X)" % n, self.f)
+        (status, data, failed) = ecc_check_pages(raw, self.page_size,
+                                 self.spare_size)
         if status == ECC_CHECK_FAILED:
             raise ecc_error("Unrecoverable ECC error (page %d)"
-                      % n)
-        return page
+                      % (n + failed[0]))
+        return data
 
-    def write_page(self, n, buf):
-        f = self.f
-        f.seek(self.raw_page_size * n)
+    def _write_pages(self, n, buf):
+        """Write buf, which must be a whole number of pages long,
+        starting at page n."""
+        
         self.modified = True
+        if self.spare_size != 0:
+            buf = ecc_encode_pages(buf, self.page_size,
+                           self.spare_size)
+        self._write_raw(self.raw_page_size * n, buf)
+
+    def write_page(self, n, buf):
         if len(buf) != self.page_size:
             raise error("internal error: write_page:"
                       " %d != %d" % (len(buf), self.page_size))
-        f.write(buf)
-        if self.spare_size != 0:
-            a = array.array('B')
-            for s in ecc_calculate_page(buf):
-                a.fromlist(s)
-            a.tofile(f)
-            f.write(b"\0" * (self.spare_size - len(a)))
+        self._write_pages(n, buf)
             
     def read_cluster(self, n):
-        pages_per_cluster = self.pages_per_cluster
         cluster_size = self.cluster_size
         if self.spare_size == 0:
-            self.f.seek(cluster_size * n)
-            return self.f.read(cluster_size)
+            return bytes(self._read_raw(cluster_size * n,
+                            cluster_size))
+        pages_per_cluster = self.pages_per_cluster
         n *= pages_per_cluster
-        if pages_per_cluster == 2:
-            return self.read_page(n) + self.read_page(n + 1)
-        return "".join(map(self.read_page,
-                   list(range(n, n + pages_per_cluster))))
+        if self.ignore_ecc:
+            return b"".join(map(self.read_page,
+                        range(n, n + pages_per_cluster)))
+        return self._read_pages_ecc(n, pages_per_cluster)
 
     def write_cluster(self, n, buf):
-        pages_per_cluster = self.pages_per_cluster
         cluster_size = self.cluster_size
+        if len(buf) != cluster_size:
+            raise error("internal error: write_cluster:"
+                      " %d != %d" % (len(buf), cluster_size))
         if self.spare_size == 0:
-            self.f.seek(cluster_size * n)
+            return self._write_raw(cluster_size * n, buf)
+        self._write_pages(n * self.pages_per_cluster, buf)
+
+    def read_clusters(self, n, count):
+        """Read count consecutive clusters starting at cluster n.
+
+        The clusters are read with a single I/O operation and
+        returned concatenated together."""
+        
+        cluster_size = self.cluster_size
+        if self.spare_size == 0:
+            size = cluster_size * count
+            buf = self._read_raw(cluster_size * n, size)
+            if len(buf) != size:
+                raise corrupt("attempted to read past EOF"
+                        " (cluster %05X)" % n, self.f)
+            return bytes(buf)
+        pages_per_cluster = self.pages_per_cluster
+        n *= pages_per_cluster
+        count *= pages_per_cluster
+        if not self.ignore_ecc:
+            return self._read_pages_ecc(n, count)
+        page_size = self.page_size
+        raw_page_size = self.raw_page_size
+        size = raw_page_size * count
+        raw = self._read_raw(raw_page_size * n, size)
+        if len(raw) != size:
+            raise corrupt("attempted to read past EOF"
+                    " (page %05X)" % n, self.f)
+        return b"".join([raw[i : i + page_size]
+                 for i in range(0, size, raw_page_size)])
+
+    def write_clusters(self, n, bufs):
+        """Write the list of cluster buffers bufs to consecutive
+        clusters starting at cluster n with a single I/O operation."""
+        
+        cluster_size = self.cluster_size
+        for buf in bufs:
             if len(buf) != cluster_size:
-                raise error("internal error: write_cluster:"
+                raise error("internal error: write_clusters:"
                           " %d != %d" % (len(buf),
                                  cluster_size))
-            return self.f.write(buf)
-        n *= pages_per_cluster
-        pgsize = self.page_size
-        for i in range(pages_per_cluster):
-            self.write_page(n + i, buf[i * pgsize
-                           : i * pgsize + pgsize])
+        buf = b"".join(bufs)
+        if self.spare_size == 0:
+            return self._write_raw(cluster_size * n, buf)
+        self._write_pages(n * self.pages_per_cluster, buf)
 
 
     def _add_fat_cluster_to_cache(self, n, fat, dirty):
@@ -881,6 +1317,7 @@ class ps2mc(object):
         if old != None:
             (n, [fat, dirty]) = old
             if dirty:
+                self.fat_cache.writebacks += 1
                 self.write_cluster(n, pack_fat(fat))
 
     def _read_fat_cluster(self, n):
@@ -896,20 +1333,31 @@ class ps2mc(object):
     def _write_fat_cluster(self, n, fat):
         self._add_fat_cluster_to_cache(n, fat, True)
 
+    def _write_cluster_runs(self, clusters):
+        """Write a list of (cluster, buffer) pairs to the image.
+
+        The clusters are written in order of their position in the
+        image, with consecutive clusters merged into single writes."""
+        
+        for (n, bufs) in _buffer_runs(clusters):
+            self.write_clusters(n, bufs)
+
     def flush_fat_cache(self):
         if self.fat_cache == None:
             return
-        for (n, v) in list(self.fat_cache.items()):
-            [fat, dirty] = v
-            if dirty:
-                self.write_cluster(n, pack_fat(fat))
-                v[1] = False
+        dirty = [(n, v) for (n, v) in self.fat_cache.items() if v[1]]
+        self.fat_cache.writebacks += len(dirty)
+        self._write_cluster_runs([(n, pack_fat(v[0]))
+                      for (n, v) in dirty])
+        for (n, v) in dirty:
+            v[1] = False
 
     def _add_alloc_cluster_to_cache(self, n, buf, dirty):
         old = self.alloc_cluster_cache.add(n, [buf, dirty])
         if old != None:
             (n, [buf, dirty]) = old
             if dirty:
+                self.alloc_cluster_cache.writebacks += 1
                 n += self.allocatable_cluster_offset
                 self.write_cluster(n, buf)
         
@@ -926,15 +1374,54 @@ class ps2mc(object):
     def write_allocatable_cluster(self, n, buf):
         self._add_alloc_cluster_to_cache(n, buf, True)
 
+    def read_allocatable_clusters(self, n, count):
+        """Read count consecutive allocatable clusters starting at n.
+
+        Clusters in the cache, which might have been modified, are
+        taken from it, the rest are read from the image at once."""
+        
+        cache = self.alloc_cluster_cache
+        cached = [(i, cache.peek(n + i)) for i in range(count)]
+        cached = [(i, a[0]) for (i, a) in cached if a != None]
+        buf = self.read_clusters(n + self.allocatable_cluster_offset,
+                     count)
+        if len(cached) == 0:
+            return buf
+        cluster_size = self.cluster_size
+        buf = bytearray(buf)
+        for (i, a) in cached:
+            buf[i * cluster_size : (i + 1) * cluster_size] = a
+        return bytes(buf)
+
+    def write_allocatable_clusters(self, n, bufs):
+        """Write the list of buffers bufs to consecutive allocatable
+        clusters starting at n, bypassing the cache."""
+        
+        cache = self.alloc_cluster_cache
+        for (i, buf) in enumerate(bufs):
+            a = cache.peek(n + i)
+            if a != None:
+                a[0] = bytes(buf)
+                a[1] = False
+        self.write_clusters(n + self.allocatable_cluster_offset, bufs)
+
+    def _write_allocatable_cluster_runs(self, clusters):
+        """Like _write_cluster_runs() but for allocatable clusters."""
+        
+        for (n, bufs) in _buffer_runs(clusters):
+            self.write_allocatable_clusters(n, bufs)
+
     def flush_alloc_cluster_cache(self):
         if self.alloc_cluster_cache == None:
             return
-        for (n, a) in list(self.alloc_cluster_cache.items()):
-            [buf, dirty] = a
-            if dirty:
-                n += self.allocatable_cluster_offset
-                self.write_cluster(n, buf)
-                a[1] = False
+        dirty = [(n, a) for (n, a) in self.alloc_cluster_cache.items()
+             if a[1]]
+        self.alloc_cluster_cache.writebacks += len(dirty)
+        offset = self.allocatable_cluster_offset
+        self._write_cluster_runs([(n + offset, a[0])
+                      for (n, a) in dirty])
+        for (n, a) in dirty:
+            a[1] = False
 
     def read_fat_cluster(self, n):
         indirect_offset = n % self.entries_per_cluster
@@ -954,16 +1441,112 @@ class ps2mc(object):
         (fat, cluster) = self.read_fat_cluster(fat_cluster)
         return (fat, offset, cluster)
 
+    def _load_fat(self):
+        """Read the entire FAT into memory.
+
+        The FAT is kept in the flat array self.fat along with a
+        bitmap of the free allocatable clusters and a count of them.
+        Modified FAT clusters are written back by flush()."""
+        
+        self.flush_fat_cache()
+        epc = self.entries_per_cluster
+        fat_len = self.allocatable_cluster_end
+        clusters = []
+        for i in range(div_round_up(fat_len, epc)):
+            ifc = self.indirect_fat_cluster_list[i // epc]
+            clusters.append(self._read_fat_cluster(ifc)[i % epc])
+        
+        raw = b"".join([self.read_clusters(start, count)
+                for (start, count) in _runs(clusters)])
+
+        limit = min(self.allocatable_cluster_limit, fat_len)
+        free = bytearray(raw[3::4].translate(_fat_free_trans))
+        free[limit:] = b"\0" * (len(free) - limit)
+
+        self.fat = unpack_fat(raw)
+        self.fat_clusters = clusters
+        self.fat_free = free
+        self.fat_free_count = raw[3 : fat_len * 4 : 4].translate(
+            _fat_free_trans).count(1)
+        self.fat_dirty = set()
+
+    def _flush_fat(self):
+        """Write modified clusters of the in memory FAT back."""
+        
+        epc = self.entries_per_cluster
+        fat = self.fat
+        self._write_cluster_runs([(self.fat_clusters[k],
+                       pack_fat(fat[k * epc : (k + 1) * epc]))
+                      for k in self.fat_dirty])
+        self.fat_dirty = set()
+        
     def lookup_fat(self, n):
+        fat = self.fat
+        if fat != None:
+            if n < 0 or n >= self.allocatable_cluster_end:
+                raise io_error(EIO,
+                         "FAT cluster index out of range"
+                         " (%d)" % n)
+            return fat[n]
         (fat, offset, cluster) = self.read_fat(n)
         return fat[offset]
 
+    def _update_free_extents(self, n, free):
+        if self.free_extents != None and n < self.allocatable_cluster_limit:
+            if free:
+                self.free_extents.freed(n)
+            else:
+                self.free_extents.allocated(n)
+
     def set_fat(self, n, value):
-        (fat, offset, cluster) = self.read_fat(n)
-        fat[offset] = value
-        self._write_fat_cluster(cluster, fat)
+        self._invalidate_fat_chains(n)
+        free = (value & PS2MC_FAT_ALLOCATED_BIT) == 0
+        fat = self.fat
+        if fat == None:
+            (fat, offset, cluster) = self.read_fat(n)
+            old = fat[offset]
+            fat[offset] = value
+            self._write_fat_cluster(cluster, fat)
+            if free != ((old & PS2MC_FAT_ALLOCATED_BIT) == 0):
+                self._update_free_extents(n, free)
+            return
+        if n < 0 or n >= self.allocatable_cluster_end:
+            raise io_error(EIO,
+                     "FAT cluster index out of range"
+                     " (%d)" % n)
+        old = fat[n]
+        fat[n] = value
+        self.fat_dirty.add(n // self.entries_per_cluster)
+        if free != ((old & PS2MC_FAT_ALLOCATED_BIT) == 0):
+            if free:
+                self.fat_free_count += 1
+            else:
+                self.fat_free_count -= 1
+            if n < self.allocatable_cluster_limit:
+                self.fat_free[n] = free
+            self._update_free_extents(n, free)
+
+    def _allocate_cluster_in_memory(self):
+        epc = self.entries_per_cluster
+        i = self.fat_free.find(1, self.fat_cursor * epc)
+        if i == -1:
+            self.fat_cursor = div_round_up(self.allocatable_cluster_limit,
+                               epc)
+            return None
+        self.fat_cursor = i // epc
+
+        # Like allocate_cluster(), use the free entry with the
+        # lowest value in the FAT cluster.
+        start = self.fat_cursor * epc
+        end = min(start + epc, self.allocatable_cluster_limit)
+        fat = self.fat[start : end]
+        ret = start + fat.index(min(fat))
+        self.set_fat(ret, PS2MC_FAT_CHAIN_END)
+        return ret
         
     def allocate_cluster(self):
+        if self.fat != None:
+            return self._allocate_cluster_in_memory()
         epc = self.entries_per_cluster
         allocatable_cluster_limit = self.allocatable_cluster_limit
         
@@ -982,13 +1565,100 @@ class ps2mc(object):
                 fat[offset] = PS2MC_FAT_CHAIN_END
                 self._write_fat_cluster(cluster, fat)
                 ret = self.fat_cursor * epc + offset
+                self._invalidate_fat_chains(ret)
+                self._update_free_extents(ret, False)
                 # print "@@@ allocated", ret
                 return ret
             self.fat_cursor += 1
         return None
     
+    def allocate_clusters(self, count):
+        """Allocate up to count clusters linked together as a chain.
+
+        Returns the list of clusters allocated, which is shorter than
+        count if the memory card is full."""
+
+        clusters = []
+        while len(clusters) < count:
+            cluster = self.allocate_cluster()
+            if cluster == None:
+                break
+            if len(clusters) > 0:
+                self.set_fat(clusters[-1],
+                         cluster | PS2MC_FAT_ALLOCATED_BIT)
+            clusters.append(cluster)
+        return clusters
+
+    def _free_extents(self):
+        """Return the free_extent_index of the card.
+
+        It's built the first time it's needed, and after that
+        set_fat() keeps it up to date."""
+
+        if self.free_extents != None:
+            return self.free_extents
+        limit = self.allocatable_cluster_limit
+        if self.fat != None:
+            free = self.fat_free
+        else:
+            epc = self.entries_per_cluster
+            free = bytearray()
+            for i in range(div_round_up(limit, epc)):
+                (fat, cluster) = self.read_fat_cluster(i)
+                free += pack_fat(fat)[3::4].translate(_fat_free_trans)
+        self.free_extents = free_extent_index(free, limit)
+        return self.free_extents
+
+    def allocate_extent(self, count):
+        """Allocate count physically contiguous clusters linked
+        together as a chain.
+
+        The smallest run of free clusters that's big enough is used.
+        If there isn't one the clusters are allocated as with
+        allocate_clusters().  Returns the list of clusters
+        allocated."""
+
+        if count <= 0:
+            return []
+        extent = self._free_extents().best_fit(count)
+        if extent == None:
+            return self.allocate_clusters(count)
+        start = extent[1]
+        end = start + count
+        for cluster in range(start, end - 1):
+            self.set_fat(cluster,
+                     (cluster + 1) | PS2MC_FAT_ALLOCATED_BIT)
+        self.set_fat(end - 1, PS2MC_FAT_CHAIN_END)
+        return list(range(start, end))
+
     def fat_chain(self, first_cluster):
-        return fat_chain(self.lookup_fat, first_cluster)
+        """Return the fat_chain object for a file's cluster chain.
+
+        The objects are cached and shared between files, and kept up
+        to date as the FAT is changed."""
+        
+        if first_cluster == PS2MC_FAT_CHAIN_END:
+            return fat_chain(self.lookup_fat, first_cluster)
+        chain = self.fat_chain_cache.get(first_cluster)
+        if chain == None:
+            chain = fat_chain(self.lookup_fat, first_cluster,
+                      self.fat_chain_owners)
+            evicted = self.fat_chain_cache.add(first_cluster, chain)
+            if evicted != None:
+                evicted[1].forget()
+        return chain
+
+    def _invalidate_fat_chains(self, n):
+        """Tell the cached chains that contain cluster n that its
+        FAT entry has changed."""
+        
+        heads = self.fat_chain_owners.get(n)
+        if heads == None:
+            return
+        for first in list(heads):
+            chain = self.fat_chain_cache.peek(first)
+            if chain != None:
+                chain.invalidate(n)
 
     def file(self, dirloc, first_cluster, length, mode, name = None):
         """Create a new file-like object for a file."""
@@ -1108,7 +1778,7 @@ class ps2mc(object):
         if notify:
             for f in files:
                 if f != thisf:
-                    f.update_notfiy(ent[4], ent[2])
+                    f.update_notify(ent[4], ent[2])
         if opened == None:
             dir.close()
 
@@ -1131,7 +1801,7 @@ class ps2mc(object):
         a  = self.open_files.get(dirloc, None)
         if a == None:
             return
-        self.flush()
+        self._auto_flush()
         dir, files = a
         files.discard(thisf)
         if len(files) == 0:
@@ -1140,9 +1810,69 @@ class ps2mc(object):
                 dir.close()
             del self.open_files[dirloc]
             
+    def _build_dir_index(self, dir):
+        """Scan a directory and create a name to index mapping for it."""
+        
+        f = dir.f
+        l = len(dir)
+        f.seek(0)
+        data = f.read(l * PS2MC_DIRENT_LENGTH)
+        if len(data) != l * PS2MC_DIRENT_LENGTH:
+            raise corrupt("Corrupt directory", f)
+        names = [None] * l
+        index = {}
+        for i in range(l):
+            off = i * PS2MC_DIRENT_LENGTH
+            (mode,) = struct.unpack_from("<H", data, off)
+            if mode & DF_EXISTS:
+                name = utils.zero_terminate(
+                    data[off + 64 : off + PS2MC_DIRENT_LENGTH])
+                names[i] = name
+                index.setdefault(name, i)
+        a = (names, index)
+        self.dir_index[f.first_cluster] = a
+        return a
+
+    def _update_dir_index(self, dir_cluster, i, ent):
+        """Update the index of the directory starting at dir_cluster
+        after entry i was written."""
+
+        a = self.dir_index.get(dir_cluster)
+        if a == None:
+            return
+        (names, index) = a
+        if i >= len(names):
+            names.extend([None] * (i + 1 - len(names)))
+        old = names[i]
+        if old != None and index.get(old) == i:
+            del index[old]
+        if ent[0] & DF_EXISTS:
+            names[i] = ent[8]
+            index.setdefault(ent[8], i)
+        else:
+            names[i] = None
+
     def search_directory(self, dir, name):
         """Search dir for name."""
 
+        try:
+            key = name.encode("ascii")
+        except UnicodeEncodeError:
+            return (None, None)
+        a = self.dir_index.get(dir.f.first_cluster)
+        if a == None or len(a[0]) != len(dir):
+            a = self._build_dir_index(dir)
+        i = a[1].get(key)
+        if i == None:
+            return (None, None)
+        ent = dir[i]
+        if ent[8] == key and (ent[0] & DF_EXISTS):
+            return (i, ent)
+
+        # The index is out of date, fall back on searching the
+        # directory.
+        del self.dir_index[dir.f.first_cluster]
+
         # start the search where the last search ended.
         start = dir.tell() - 1
         if start == -1:
@@ -1180,6 +1910,7 @@ class ps2mc(object):
         if mode & DF_DIR:
             mode &= ~DF_FILE
             cluster = self.allocate_cluster()
+            self.dir_index.pop(cluster, None)
             length = 1
         else:
             mode |= DF_FILE
@@ -1238,6 +1969,8 @@ class ps2mc(object):
 
         ent = self._dirloc_to_ent(dirloc)
         cluster = ent[4]
+        if ent[0] & DF_DIR:
+            self.dir_index.pop(cluster, None)
         if truncate:
             ent[2] = 0
             ent[4] = PS2MC_FAT_CHAIN_END
@@ -1259,6 +1992,14 @@ class ps2mc(object):
                 break
             cluster = next_cluster
             
+    def _flush_dirents(self):
+        """Write the pending directory entries of all open files."""
+        
+        for (dir, files) in list(self.open_files.values()):
+            for f in list(files):
+                if f._dirent_pending():
+                    f._update_dirent()
+
     def path_search(self, pathname):
         """Parse and resolve a pathname.
 
@@ -1276,6 +2017,9 @@ class ps2mc(object):
             # could return curdir
             return (None, None, False)
 
+        # make sure the entries read are up to date
+        self._flush_dirents()
+
         dirloc = self.curdir
         if components[0] == "":
             dirloc = (0, 0)
@@ -1348,7 +2092,7 @@ class ps2mc(object):
             (dirloc, ent) = self.create_dir_entry(dirloc, name,
                                   DF_FILE | DF_RWX
                                   | DF_0400);
-            self.flush()
+            self._auto_flush()
         elif mode[0] == "w":
             self.delete_dirloc(dirloc, True, filename)
             ent[4] = PS2MC_FAT_CHAIN_END
@@ -1376,7 +2120,7 @@ class ps2mc(object):
         while name == "":
             name = a.pop()
         self.create_dir_entry(dirloc, name, DF_DIR | DF_RWX | DF_0400)
-        self.flush()
+        self._auto_flush()
 
     def _is_empty(self, dirloc, ent, filename):
         """Check if a directory is empty."""
@@ -1409,7 +2153,7 @@ class ps2mc(object):
                          "directory not empty",
                          filename)
         self.delete_dirloc(dirloc, False, filename)
-        self.flush()
+        self._auto_flush()
 
     def chdir(self, filename):
         (dirloc, ent, is_dir) = self.path_search(filename)
@@ -1458,7 +2202,7 @@ class ps2mc(object):
             dir[dirloc[1]] = new_ent
         finally:
             dir.close()
-        self.flush()
+        self._auto_flush()
         return ent
 
     def import_save_file(self, sf, ignore_existing, dirname = None):
@@ -1470,7 +2214,12 @@ class ps2mc(object):
         to that directory instead of the directory specified by
         the save file.
         """
-        
+
+        with self.batch():
+            return self._import_save_file(sf, ignore_existing,
+                              dirname)
+
+    def _import_save_file(self, sf, ignore_existing, dirname):
         dir_ent = sf.get_directory()
         if dirname == None:
             dir_ent_name = dir_ent[8].decode("ascii")
@@ -1517,7 +2266,8 @@ class ps2mc(object):
                     for i in range(dir_ent[2]):
                         (ent, data) = sf.get_file(i)
                         # print "@@@ remove", ent[8]
-                        self.remove(dirname + ent[8])
+                        self.remove(dirname
+                                + ent[8].decode("ascii"))
                 except EnvironmentError as why:
                     # print "@@@ failed", why
                     pass
@@ -1528,7 +2278,7 @@ class ps2mc(object):
                 except EnvironmentError as why:
                     # print "@@@ failed", why
                     pass
-                raise type(what, where)
+                raise what.with_traceback(where)
             finally:
                 del where
 
@@ -1547,7 +2297,7 @@ class ps2mc(object):
         finally:
             dir.close()
 
-        self.flush()
+        self._auto_flush()
         return True
 
     def export_save_file(self, filename):
@@ -1628,9 +2378,18 @@ class ps2mc(object):
             dirname += "/"
         self._remove_dir(dirloc, ent, dirname)
 
+    def cache_stats(self):
+        """Return a dictionary of the statistics of each cache."""
+        
+        return {"fat": self.fat_cache.stats(),
+            "alloc_cluster": self.alloc_cluster_cache.stats(),
+            "fat_chain": self.fat_chain_cache.stats()}
+
     def get_free_space(self):
         """Returns the amount of free space in bytes."""
         
+        if self.fat != None:
+            return self.fat_free_count * self.cluster_size
         free = 0
         for i in range(self.allocatable_cluster_end):
             if (self.lookup_fat(i) & PS2MC_FAT_ALLOCATED_BIT) == 0:
@@ -1735,6 +2494,276 @@ class ps2mc(object):
             
         return ret
 
+    def _chain_clusters(self, used, first_cluster, name):
+        """Return the list of clusters in a chain, marking them as
+        used.  Raises corrupt if the chain is damaged or cross
+        linked."""
+
+        chain = []
+        cluster = first_cluster
+        while cluster != PS2MC_FAT_CHAIN_END:
+            if cluster < 0 or cluster >= len(used):
+                raise corrupt("%s: invalid cluster in chain" % name,
+                          self.f)
+            if used[cluster]:
+                raise corrupt("%s: cross linked chain" % name,
+                          self.f)
+            used[cluster] = 1
+            chain.append(cluster)
+            next = self.lookup_fat(cluster)
+            if next == PS2MC_FAT_CHAIN_END:
+                break
+            if (next & PS2MC_FAT_ALLOCATED_BIT) == 0:
+                raise corrupt("%s: unallocated cluster in chain"
+                          % name, self.f)
+            cluster = next & ~PS2MC_FAT_ALLOCATED_BIT
+        return chain
+
+    def _defrag_walk(self, used, chains, dirs, first_cluster, length,
+             name):
+        """Add the chains of a directory and everything in it to
+        chains, in the order they'll be laid out."""
+
+        chain = self._chain_clusters(used, first_cluster, name)
+        chains.append(chain)
+        ents = self._read_dirents(first_cluster, length)
+        dirs.append((chain, ents))
+        subdirs = []
+        for (i, ent) in enumerate(ents):
+            if i < 2 or not (ent[0] & DF_EXISTS):
+                continue
+            ent_name = name + ent[8].decode("ascii")
+            if ent[0] & DF_DIR:
+                subdirs.append((ent, ent_name + "/"))
+            elif ent[4] != PS2MC_FAT_CHAIN_END:
+                chains.append(self._chain_clusters(used, ent[4],
+                                 ent_name))
+        for (ent, ent_name) in subdirs:
+            self._defrag_walk(used, chains, dirs, ent[4], ent[2],
+                      ent_name)
+
+    def defragment(self, reclaim_lost = False):
+        """Rewrite the card so every file and directory is stored in
+        contiguous clusters and the free space is in one block.
+
+        Directories are laid out depth first, starting with the
+        root directory at cluster 0, with each directory followed by
+        its files.  Only clusters whose position or contents change
+        are written.  Returns a dictionary describing the
+        fragmentation before and after.
+
+        This isn't safe against interruption.  Moved clusters
+        overwrite clusters still in use before the FAT and the
+        directories are rewritten, so if it's stopped partway the
+        card is left corrupt with no way to recover it.  Make a
+        backup of the image first.
+
+        Allocated clusters that aren't part of any file or directory
+        ("lost" clusters, as reported by check()) cause a corrupt
+        exception unless reclaim_lost is true, in which case they're
+        freed."""
+
+        if self.open_files:
+            raise io_error(EBUSY, "cannot defragment with open files",
+                     self.f.name)
+        self.flush()
+
+        cluster_size = self.cluster_size
+        rootent = unpack_dirent(self.read_allocatable_cluster(0)
+                    [:PS2MC_DIRENT_LENGTH])
+        used = bytearray(self.allocatable_cluster_end)
+        chains = []
+        dirs = []
+        self._defrag_walk(used, chains, dirs, 0, rootent[2], "/")
+
+        lost = 0
+        for i in range(self.allocatable_cluster_limit):
+            if ((self.lookup_fat(i) & PS2MC_FAT_ALLOCATED_BIT)
+                and not used[i]):
+                lost += 1
+        if lost > 0 and not reclaim_lost:
+            raise corrupt("%d lost clusters found, run check" % lost,
+                      self.f)
+
+        new_cluster = {}
+        extents_before = 0
+        n = 0
+        for chain in chains:
+            for (i, cluster) in enumerate(chain):
+                if i == 0 or cluster != chain[i - 1] + 1:
+                    extents_before += 1
+                new_cluster[cluster] = n
+                n += 1
+        moved = [c for c in new_cluster if new_cluster[c] != c]
+
+        # Read everything that moves, then patch the cluster numbers
+        # in the directories.
+        
+        data = {}
+        for (start, count) in _runs(sorted(moved)):
+            buf = self.read_allocatable_clusters(start, count)
+            for i in range(count):
+                data[start + i] = buf[i * cluster_size
+                              : (i + 1) * cluster_size]
+        for (chain, ents) in dirs:
+            buf = bytearray(b"".join([data[c] if c in data
+                          else self.read_allocatable_cluster(c)
+                          for c in chain]))
+            old = bytes(buf)
+            for (i, ent) in enumerate(ents):
+                off = i * PS2MC_DIRENT_LENGTH
+                if i == 0:
+                    if chain[0] != 0:
+                        struct.pack_into("<L", buf, off + 16,
+                                 new_cluster.get(ent[4],
+                                         ent[4]))
+                elif (i >= 2 and (ent[0] & DF_EXISTS)
+                      and ent[4] != PS2MC_FAT_CHAIN_END):
+                    struct.pack_into("<L", buf, off + 16,
+                             new_cluster[ent[4]])
+            for (i, c) in enumerate(chain):
+                a = buf[i * cluster_size : (i + 1) * cluster_size]
+                if c in data or a != old[i * cluster_size
+                             : (i + 1) * cluster_size]:
+                    data[c] = bytes(a)
+
+        self.alloc_cluster_cache.clear()
+        self.fat_chain_cache.clear()
+        self.fat_chain_owners.clear()
+        self.dir_index = {}
+        if self.rootdir != None:
+            self.rootdir.real_close()
+            self.rootdir = None
+        
+        writes = [(new_cluster[c], data[c]) for c in data]
+        self._write_allocatable_cluster_runs(writes)
+
+        fat = [PS2MC_FAT_CLUSTER_MASK] * self.allocatable_cluster_limit
+        n = 0
+        for chain in chains:
+            for i in range(len(chain) - 1):
+                fat[n + i] = (n + i + 1) | PS2MC_FAT_ALLOCATED_BIT
+            n += len(chain)
+            fat[n - 1] = PS2MC_FAT_CHAIN_END
+        # cheaper to rebuild the free extent index afterwards
+        self.free_extents = None
+        for (i, value) in enumerate(fat):
+            if self.lookup_fat(i) != value:
+                self.set_fat(i, value)
+        self.free_extents = None
+        self.fat_cursor = 0
+
+        if self.curdir != (0, 0):
+            self.curdir = (new_cluster[self.curdir[0]],
+                       self.curdir[1])
+        self.flush()
+        return {"chains": len(chains),
+            "clusters": n,
+            "extents_before": extents_before,
+            "extents_after": len(chains),
+            "clusters_moved": len(moved),
+            "clusters_written": len(writes),
+            "lost_clusters": lost}
+
+    def _layout_walk(self, used, files, first_cluster, length, name):
+        """Add a description of a directory and of everything in it
+        to files."""
+
+        chain = self._chain_clusters(used, first_cluster, name)
+        files.append((name, length * PS2MC_DIRENT_LENGTH, chain))
+        ents = self._read_dirents(first_cluster, length)
+        for (i, ent) in enumerate(ents):
+            if i < 2 or not (ent[0] & DF_EXISTS):
+                continue
+            ent_name = name + ent[8].decode("ascii")
+            if ent[0] & DF_DIR:
+                self._layout_walk(used, files, ent[4], ent[2],
+                          ent_name + "/")
+            else:
+                files.append((ent_name, ent[2],
+                          self._chain_clusters(used, ent[4],
+                                   ent_name)))
+
+    def _layout_summary(self, files):
+        cluster_size = self.cluster_size
+        epc = self.entries_per_cluster
+        clusters = extents = slack = fragmented = 0
+        fat_clusters = set()
+        for (name, length, chain) in files:
+            n = 0
+            for (i, c) in enumerate(chain):
+                if i == 0 or c != chain[i - 1] + 1:
+                    n += 1
+                fat_clusters.add(c // epc)
+            if n > 1:
+                fragmented += 1
+            clusters += len(chain)
+            extents += n
+            slack += len(chain) * cluster_size - length
+        average = 0.0
+        if extents > 0:
+            average = clusters / extents
+        return {"files": len(files),
+            "clusters": clusters,
+            "extents": extents,
+            "average_extent_length": average,
+            "fragmented_files": fragmented,
+            "slack": slack,
+            "fat_clusters": len(fat_clusters)}
+
+    def layout_report(self):
+        """Describe how the files on the card are laid out.
+
+        Returns a dictionary with the fragmentation of each save
+        directory and of the whole card, the number of FAT clusters
+        that need to be read to follow every chain, the sizes of the
+        runs of free clusters and the space wasted in partially used
+        clusters."""
+
+        rootent = unpack_dirent(self.read_allocatable_cluster(0)
+                    [:PS2MC_DIRENT_LENGTH])
+        used = bytearray(self.allocatable_cluster_end)
+        files = []
+        self._layout_walk(used, files, 0, rootent[2], "/")
+
+        saves = []
+        i = 1
+        while i < len(files):
+            name = files[i][0]
+            j = i + 1
+            if name.endswith("/"):
+                while j < len(files) and files[j][0].startswith(name):
+                    j += 1
+            a = self._layout_summary(files[i : j])
+            a["name"] = name.strip("/")
+            a["file_list"] = [{"name": f[0],
+                       "length": f[1],
+                       "clusters": len(f[2]),
+                       "extents": len(_runs(f[2]))}
+                      for f in files[i : j]]
+            saves.append(a)
+            i = j
+
+        free_extents = self._free_extents()
+        histogram = {}
+        for (length, start) in free_extents:
+            bits = length.bit_length() - 1
+            key = "%d-%d" % (1 << bits, (2 << bits) - 1)
+            if bits == 0:
+                key = "1"
+            histogram[key] = histogram.get(key, 0) + 1
+        largest = 0
+        if len(free_extents) > 0:
+            largest = free_extents.extents[-1][0]
+        return {"cluster_size": self.cluster_size,
+            "allocatable_clusters": self.allocatable_cluster_limit,
+            "card": self._layout_summary(files),
+            "saves": saves,
+            "free": {"clusters": sum(l for (l, s) in free_extents),
+                 "extents": len(free_extents),
+                 "largest_extent": largest,
+                 "histogram": histogram}}
+
     def _glob(self, dirname, components):
         pattern = components[0]
         if len(components) == 1:
@@ -1811,11 +2840,99 @@ class ps2mc(object):
             dir.close()
         return length
             
+    def _read_file_head(self, first_cluster, length, size):
+        f = ps2mc_file(self, None, first_cluster, length, "rb")
+        try:
+            return f.read(size)
+        finally:
+            f.close()
+
+    def _read_dirents(self, first_cluster, length):
+        """Read all the entries of a directory at once."""
+        
+        l = length * PS2MC_DIRENT_LENGTH
+        s = self._read_file_head(first_cluster, l, l)
+        return [dirent(s[i : i + PS2MC_DIRENT_LENGTH])
+            for i in range(0, len(s) - PS2MC_DIRENT_LENGTH + 1,
+                       PS2MC_DIRENT_LENGTH)]
+
+    def _summarize_dir(self, first_cluster, length):
+        """Return the total size of a directory's contents, like
+        dir_size(), and the directory's entries."""
+        
+        cluster_size = self.cluster_size
+        ents = self._read_dirents(first_cluster, length)
+        size = round_up(len(ents) * PS2MC_DIRENT_LENGTH, cluster_size)
+        for ent in ents:
+            if mode_is_file(ent[0]):
+                size += round_up(ent[2], cluster_size)
+            elif (mode_is_dir(ent[0])
+                  and ent[8] not in [b".", b".."]):
+                size += self._summarize_dir(ent[4], ent[2])[0]
+        return (size, ents)
+
+    def summarize(self):
+        """Describe all the save directories in the root directory.
+
+        Returns a card_summary object.  Each directory is read only
+        once, unlike when using dir_size() and get_icon_sys()."""
+        
+        rootent = unpack_dirent(self.read_allocatable_cluster(0)
+                    [:PS2MC_DIRENT_LENGTH])
+        saves = []
+        for (i, ent) in enumerate(self._read_dirents(0, rootent[2])):
+            if i < 2 or not mode_is_dir(ent[0]):
+                continue
+            (size, ents) = self._summarize_dir(ent[4], ent[2])
+            icon_sys = None
+            psx_header = None
+            for e in ents:
+                if not mode_is_file(e[0]):
+                    continue
+                if e[8] == b"icon.sys":
+                    s = self._read_file_head(e[4], e[2], 964)
+                    if len(s) == 964 and s[0:4] == b"PS2D":
+                        icon_sys = s
+                elif e[8] == ent[8] and (ent[0] & DF_PSX):
+                    s = self._read_file_head(e[4], e[2], 128)
+                    if len(s) == 128:
+                        psx_header = s
+            saves.append(save_summary((0, i), ent, size, icon_sys,
+                          psx_header))
+        return card_summary(saves, self.get_free_space(),
+                    self.get_allocatable_space())
+
+    def _auto_flush(self):
+        if self._batch_depth == 0:
+            self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Return a context manager that defers flushing the caches
+        until the end of the with statement.
+
+        Batches may be nested, only the outermost one flushes."""
+        
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        self._auto_flush()
+
     def flush(self):
+        if self.open_files != None:
+            for (dir, files) in list(self.open_files.values()):
+                for f in list(files):
+                    f.flush()
         self.flush_alloc_cluster_cache()
+        if self.fat != None:
+            self._flush_fat()
         self.flush_fat_cache()
         if self.modified:
             self.write_superblock()
+        if self.mmap != None:
+            self.mmap.flush()
         self.f.flush()
         
     def close(self):
@@ -1850,8 +2967,12 @@ class ps2mc(object):
             if self.fat_cache != None:
                 self.flush()
         finally:
+            self._close_mmap()
             self.open_files = None
             self.fat_cache = None
+            self.fat_chain_cache = None
+            self.fat_chain_owners = None
+            self.dir_index = None
             self.f = None
             self.rootdir = None
 
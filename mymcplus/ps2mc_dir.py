@@ -59,7 +59,7 @@ def unpack_tod(s):
     return _tod_struct.unpack(s)
 
 def pack_tod(tod):
-    return _tod_struct.pack(tod)
+    return _tod_struct.pack(*tod)
 
 def unpack_dirent(s):
     ent = _dirent_struct.unpack(s)
@@ -70,12 +70,95 @@ def unpack_dirent(s):
     return ent
 
 def pack_dirent(ent):
+    if isinstance(ent, dirent):
+        return ent.pack()
     ent = list(ent)
     ent[3] = _tod_struct.pack(*ent[3])
     ent[6] = _tod_struct.pack(*ent[6])
     return _dirent_struct.pack(*ent)
 
 
+_u16_struct = struct.Struct("<H")
+_u32_struct = struct.Struct("<L")
+_name_struct = struct.Struct("448s")
+
+# The struct and offset of each field in a packed directory entry.
+_dirent_fields = [(_u16_struct, 0), (_u16_struct, 2), (_u32_struct, 4),
+          (_tod_struct, 8), (_u32_struct, 16), (_u32_struct, 20),
+          (_tod_struct, 24), (_u32_struct, 32), (_name_struct, 64)]
+
+class dirent(object):
+    """A directory entry that is decoded from its packed form as its
+    fields are used.
+
+    It can be indexed like the lists returned by unpack_dirent().
+    Packing it again only encodes the fields that were changed."""
+
+    __slots__ = ("_raw", "_fields", "_dirty")
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._fields = [None] * 9
+        self._dirty = 0
+
+    def _decode(self, i):
+        (st, off) = _dirent_fields[i]
+        if i == 8:
+            v = utils.zero_terminate(bytes(
+                self._raw[off : PS2MC_DIRENT_LENGTH]))
+        elif i == 3 or i == 6:
+            v = st.unpack_from(self._raw, off)
+        else:
+            v = st.unpack_from(self._raw, off)[0]
+        self._fields[i] = v
+        return v
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(9)[i]]
+        v = self._fields[i]
+        if v == None:
+            v = self._decode(i % 9)
+        return v
+
+    def __setitem__(self, i, value):
+        i = range(9)[i]
+        self._fields[i] = value
+        self._dirty |= 1 << i
+
+    def __len__(self):
+        return 9
+
+    def __iter__(self):
+        for i in range(9):
+            yield self[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, (dirent, list, tuple)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "dirent(%r)" % (list(self),)
+
+    def pack(self):
+        dirty = self._dirty
+        if dirty == 0:
+            return bytes(self._raw)
+        raw = bytearray(self._raw)
+        for i in range(9):
+            if dirty & (1 << i):
+                (st, off) = _dirent_fields[i]
+                v = self._fields[i]
+                if i == 3 or i == 6:
+                    st.pack_into(raw, off, *v)
+                else:
+                    st.pack_into(raw, off, v)
+        return bytes(raw)
+
+
 def time_to_tod(when):
     """Convert a Python time value to a ToD tuple"""
     
@@ -18,14 +18,28 @@
 """
 Routines for calculating the Hamming codes, a simple form of error
 correcting codes (ECC), as used on PS2 memory cards.  
+
+Besides the per chunk and per page functions there are bulk versions,
+ecc_calculate_pages(), ecc_encode_pages() and ecc_check_pages(), that
+handle any number of consecutive pages at once.  They use NumPy if it's
+available and otherwise fall back to table lookups and arithmetic on
+Python's arbitrary precision integers, both of which avoid looping over
+the data a byte at a time.
 """
 
 import array
+import functools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from .round import div_round_up
 
 __ALL__ = ["ECC_CHECK_OK", "ECC_CHECK_CORRECTED", "ECC_CHECK_FAILED",
-           "ecc_calculate", "ecc_check", "ecc_calculate_page", "ecc_check_page"]
+           "ecc_calculate", "ecc_check", "ecc_calculate_page", "ecc_check_page",
+           "ecc_calculate_pages", "ecc_encode_pages", "ecc_check_pages"]
 
 ECC_CHECK_OK = 0
 ECC_CHECK_CORRECTED = 1
@@ -63,6 +77,17 @@ def _make_ecc_tables():
 
 _parity_table, _column_parity_masks = _make_ecc_tables()
 
+# Translation tables used by the bulk routines.  The "odd" table maps
+# bytes with odd parity to 0xFF so it can be used as a mask, the "even"
+# table maps each XOR of column parity masks to the value the second
+# line parity byte differs from the third one by.
+_column_parity_trans = bytes(_column_parity_masks)
+_odd_parity_trans = bytes([0xFF * p for p in _parity_table])
+_xor_77_trans = bytes([b ^ 0x77 for b in range(256)])
+_xor_7f_trans = bytes([b ^ 0x7F for b in range(256)])
+_line_parity_diff_trans = bytes([0x7F * ((b ^ (b >> 4)) & 1)
+                                 for b in range(256)])
+
 
 def _ecc_calculate(s):
     """Calculate the Hamming code for a 128 byte long string or byte array."""
@@ -166,5 +191,173 @@ def ecc_check_page(page, spare):
     return ret, page, spare
 
 
+@functools.lru_cache(maxsize = 32)
+def _chunk_masks(chunks):
+    """Return the masks used to fold chunks of a little endian integer.
+
+    The first element is an integer with the index of each byte within
+    its 128 byte chunk stored in that byte, the rest select the first
+    64, 32, ..., 1 bytes of every chunk."""
+
+    masks = [int.from_bytes(bytes(range(128)) * chunks, "little")]
+    width = 64
+    while width >= 1:
+        chunk = b"\xFF" * width + b"\0" * (128 - width)
+        masks.append(int.from_bytes(chunk * chunks, "little"))
+        width //= 2
+    return masks
+
+
+def _xor_chunks(x, masks):
+    """XOR together all bytes of each 128 byte chunk of x.
+
+    The result for each chunk is left in the chunk's first byte."""
+
+    width = 64 * 8
+    for mask in masks[1:]:
+        x ^= x >> width
+        x &= mask
+        width //= 2
+    return x
+
+
+def _ecc_calculate_chunks_int(data, chunks):
+    nbytes = chunks * 128
+    masks = _chunk_masks(chunks)
+    columns = _xor_chunks(int.from_bytes(data.translate(_column_parity_trans),
+                                         "little"),
+                          masks)
+    odd = int.from_bytes(data.translate(_odd_parity_trans), "little")
+    lines = _xor_chunks(odd & masks[0], masks)
+    columns = columns.to_bytes(nbytes, "little")[::128]
+    lines = lines.to_bytes(nbytes, "little")[::128]
+
+    lp1 = lines.translate(_xor_7f_trans)
+    diff = columns.translate(_line_parity_diff_trans)
+    lp0 = (int.from_bytes(lp1, "little")
+           ^ int.from_bytes(diff, "little")).to_bytes(chunks, "little")
+    codes = bytearray(chunks * 3)
+    codes[0::3] = columns.translate(_xor_77_trans)
+    codes[1::3] = lp0
+    codes[2::3] = lp1
+    return bytes(codes)
+
+
+if numpy is not None:
+    _np_column_parity_masks = numpy.array(_column_parity_masks,
+                                          dtype = numpy.uint8)
+    _np_parity = numpy.array(_parity_table, dtype = numpy.uint8)
+    _np_index = numpy.arange(128, dtype = numpy.uint8)
+
+    def _ecc_calculate_chunks_numpy(data, chunks):
+        a = numpy.frombuffer(data, dtype = numpy.uint8).reshape(chunks, 128)
+        columns = numpy.bitwise_xor.reduce(_np_column_parity_masks[a],
+                                           axis = 1)
+        lines = numpy.bitwise_xor.reduce(_np_parity[a] * _np_index,
+                                         axis = 1)
+        odd = (columns ^ (columns >> 4)) & 1
+        codes = numpy.empty((chunks, 3), dtype = numpy.uint8)
+        codes[:, 0] = columns ^ 0x77
+        codes[:, 2] = lines ^ 0x7F
+        codes[:, 1] = codes[:, 2] ^ (odd * 0x7F)
+        return codes.tobytes()
+
+    _ecc_calculate_chunks = _ecc_calculate_chunks_numpy
+else:
+    _ecc_calculate_chunks = _ecc_calculate_chunks_int
+
+
+def ecc_calculate_pages(data, page_size):
+    """Return the ECC codes for any number of consecutive pages.
+
+    The codes for all the pages are returned concatenated together as
+    a single bytes object, three bytes for every 128 byte chunk."""
+
+    if len(data) % page_size != 0:
+        raise ValueError("data isn't a whole number of pages")
+    if page_size % 128 != 0:
+        return b"".join([bytes(code)
+                         for i in range(0, len(data), page_size)
+                         for code in ecc_calculate_page(data[i : i + page_size])])
+    if len(data) == 0:
+        return b""
+    return _ecc_calculate_chunks(bytes(data), len(data) // 128)
+
+
+def ecc_encode_pages(data, page_size, spare_size):
+    """Add spare areas containing ECC codes to consecutive pages.
+
+    Returns the pages laid out as they are stored in an image."""
+
+    pages = len(data) // page_size
+    codes = ecc_calculate_pages(data, page_size)
+    code_size = len(codes) // max(pages, 1)
+    if numpy is not None and pages > 1:
+        raw = numpy.zeros((pages, page_size + spare_size),
+                          dtype = numpy.uint8)
+        raw[:, :page_size] = numpy.frombuffer(bytes(data), dtype = numpy.uint8
+                                              ).reshape(pages, page_size)
+        raw[:, page_size : page_size + code_size] = numpy.frombuffer(
+            codes, dtype = numpy.uint8).reshape(pages, code_size)
+        return raw.tobytes()
+    pad = b"\0" * (spare_size - code_size)
+    return b"".join([bytes(data[i * page_size : (i + 1) * page_size])
+                     + codes[i * code_size : (i + 1) * code_size] + pad
+                     for i in range(pages)])
+
+
+def ecc_check_pages(raw, page_size, spare_size):
+    """Check and correct any single bit errors in consecutive pages.
+
+    The pages must be laid out as stored in an image, each followed by
+    its spare area.  Returns a tuple containing the overall status, the
+    (corrected) data of the pages without their spare areas and a list
+    of the indices of the pages that couldn't be corrected."""
+
+    raw_page_size = page_size + spare_size
+    pages = len(raw) // raw_page_size
+    code_size = div_round_up(page_size, 128) * 3
+    if pages == 1:
+        data = bytes(raw[:page_size])
+        stored = bytes(raw[page_size : page_size + code_size])
+    elif numpy is not None:
+        a = numpy.frombuffer(raw, dtype = numpy.uint8,
+                             count = pages * raw_page_size
+                             ).reshape(pages, raw_page_size)
+        data = a[:, :page_size].tobytes()
+        stored = a[:, page_size : page_size + code_size].tobytes()
+    else:
+        data = b"".join([raw[i : i + page_size]
+                         for i in range(0, pages * raw_page_size,
+                                        raw_page_size)])
+        stored = b"".join([raw[i : i + code_size]
+                           for i in range(page_size, pages * raw_page_size,
+                                          raw_page_size)])
+
+    computed = ecc_calculate_pages(data, page_size)
+    if computed == stored:
+        return ECC_CHECK_OK, data, []
+
+    # Some page doesn't match, fall back on checking the pages
+    # individually so errors can be corrected.
+    ret = ECC_CHECK_OK
+    failed = []
+    out = []
+    for i in range(pages):
+        page = data[i * page_size : (i + 1) * page_size]
+        codes = slice(i * code_size, (i + 1) * code_size)
+        if computed[codes] != stored[codes]:
+            spare = raw[i * raw_page_size + page_size
+                        : (i + 1) * raw_page_size]
+            (status, page, spare) = ecc_check_page(page, spare)
+            if status == ECC_CHECK_FAILED:
+                failed.append(i)
+                ret = ECC_CHECK_FAILED
+            elif ret == ECC_CHECK_OK:
+                ret = status
+        out.append(bytes(page))
+    return ret, b"".join(out), failed
+
+
 ecc_calculate = _ecc_calculate
 ecc_check = _ecc_check
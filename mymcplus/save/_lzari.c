@@ -0,0 +1,564 @@
+/*
+ * This file is part of mymc+, based on mymc by Ross Ridge.
+ *
+ * mymc+ is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * mymc+ is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/*
+ * Optional native implementation of the LZARI codec used by MAX Drive
+ * saves.  It produces exactly the same output as the pure-Python
+ * implementation in lzari.py, which is used when this module isn't
+ * available.  Like LZARI.C the model is updated with linear scans,
+ * while matches are found with hash chains searched in order from
+ * the most recent position, giving the longest match that lies
+ * entirely in the history and the most recent one if there's a tie.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <stdlib.h>
+#include <string.h>
+
+#define HIST_LEN 4096
+#define MIN_MATCH_LEN 3
+#define MAX_MATCH_LEN 60
+
+#define ARITH_BITS 15
+#define QUADRANT1 (1L << ARITH_BITS)
+#define QUADRANT2 (QUADRANT1 * 2)
+#define QUADRANT3 (QUADRANT1 * 3)
+#define QUADRANT4 (QUADRANT1 * 4)
+#define MAX_CUM (QUADRANT1 - 1)
+#define MAX_CHAR (256 + MAX_MATCH_LEN - MIN_MATCH_LEN + 1)
+
+#define HASH_BITS 15
+#define HASH_SIZE (1 << HASH_BITS)
+
+/* bytes of padding the decoder may read past the end of its input */
+#define IN_PADDING 16
+
+struct model {
+	int char_to_symbol[MAX_CHAR];
+	int symbol_to_char[MAX_CHAR + 1];
+	unsigned sym_freq[MAX_CHAR + 1];
+	/* sym_cum[i] is the sum of the frequencies of symbols above i */
+	unsigned sym_cum[MAX_CHAR + 1];
+	unsigned position_cum[HIST_LEN + 1];
+};
+
+static void
+init_model(struct model *m)
+{
+	int i;
+	unsigned a;
+
+	m->symbol_to_char[0] = 0;
+	m->sym_freq[0] = 0;
+	m->sym_cum[MAX_CHAR] = 0;
+	for (i = MAX_CHAR; i >= 1; i--) {
+		m->char_to_symbol[i - 1] = i;
+		m->symbol_to_char[i] = i - 1;
+		m->sym_freq[i] = 1;
+		m->sym_cum[i - 1] = m->sym_cum[i] + 1;
+	}
+
+	a = 0;
+	m->position_cum[HIST_LEN] = 0;
+	for (i = HIST_LEN; i > 0; i--) {
+		a += 10000 / (200 + i);
+		m->position_cum[i - 1] = a;
+	}
+}
+
+static void
+update_model(struct model *m, int symbol)
+{
+	int i, new_symbol;
+	unsigned c;
+
+	if (m->sym_cum[0] >= MAX_CUM) {
+		c = 0;
+		for (i = MAX_CHAR; i > 0; i--) {
+			m->sym_cum[i] = c;
+			m->sym_freq[i] = (m->sym_freq[i] + 1) / 2;
+			c += m->sym_freq[i];
+		}
+		m->sym_cum[0] = c;
+	}
+	for (new_symbol = symbol;
+	     m->sym_freq[new_symbol] == m->sym_freq[new_symbol - 1];
+	     new_symbol--)
+		;
+	if (new_symbol < symbol) {
+		int ch = m->symbol_to_char[symbol];
+		int swap_ch = m->symbol_to_char[new_symbol];
+		m->symbol_to_char[new_symbol] = ch;
+		m->symbol_to_char[symbol] = swap_ch;
+		m->char_to_symbol[ch] = new_symbol;
+		m->char_to_symbol[swap_ch] = symbol;
+	}
+	m->sym_freq[new_symbol]++;
+	for (i = 0; i < new_symbol; i++)
+		m->sym_cum[i]++;
+}
+
+/*
+ * Compression
+ */
+
+struct encoder {
+	struct model model;
+	long low;
+	long high;
+	long shifts;
+	unsigned char *out;
+	size_t out_len;
+	size_t out_size;
+	unsigned bits;
+	int nbits;
+};
+
+static int
+put_bit(struct encoder *e, int bit)
+{
+	e->bits = (e->bits << 1) | bit;
+	if (++e->nbits == 8) {
+		if (e->out_len == e->out_size) {
+			size_t size = e->out_size * 2 + 4096;
+			unsigned char *out = realloc(e->out, size);
+			if (out == NULL)
+				return -1;
+			e->out = out;
+			e->out_size = size;
+		}
+		e->out[e->out_len++] = (unsigned char) e->bits;
+		e->bits = 0;
+		e->nbits = 0;
+	}
+	return 0;
+}
+
+static int
+output_bit(struct encoder *e, int bit)
+{
+	if (put_bit(e, bit) == -1)
+		return -1;
+	for (; e->shifts > 0; e->shifts--)
+		if (put_bit(e, !bit) == -1)
+			return -1;
+	return 0;
+}
+
+static int
+encode_range(struct encoder *e, unsigned long long hi_cum,
+	     unsigned long long lo_cum,
+	     unsigned long long total)
+{
+	long range = e->high - e->low;
+	long low = e->low;
+	long high = low + (long) ((unsigned long long) range * hi_cum / total);
+
+	low += (long) ((unsigned long long) range * lo_cum / total);
+	for (;;) {
+		if (high <= QUADRANT2) {
+			if (output_bit(e, 0) == -1)
+				return -1;
+		} else if (low >= QUADRANT2) {
+			if (output_bit(e, 1) == -1)
+				return -1;
+			low -= QUADRANT2;
+			high -= QUADRANT2;
+		} else if (low >= QUADRANT1 && high <= QUADRANT3) {
+			e->shifts++;
+			low -= QUADRANT1;
+			high -= QUADRANT1;
+		} else {
+			break;
+		}
+		low *= 2;
+		high *= 2;
+	}
+	e->low = low;
+	e->high = high;
+	return 0;
+}
+
+static int
+encode_char(struct encoder *e, int ch)
+{
+	struct model *m = &e->model;
+	int symbol = m->char_to_symbol[ch];
+
+	if (encode_range(e, m->sym_cum[symbol - 1], m->sym_cum[symbol],
+			 m->sym_cum[0]) == -1)
+		return -1;
+	update_model(m, symbol);
+	return 0;
+}
+
+static int
+encode_position(struct encoder *e, int position)
+{
+	struct model *m = &e->model;
+
+	return encode_range(e, m->position_cum[position],
+			    m->position_cum[position + 1],
+			    m->position_cum[0]);
+}
+
+static unsigned
+hash3(const unsigned char *p)
+{
+	return ((p[0] << 10) ^ (p[1] << 5) ^ p[2]) & (HASH_SIZE - 1);
+}
+
+/* Returns the compressed length, or -1 if out of memory. */
+static Py_ssize_t
+lzari_encode(const unsigned char *in, Py_ssize_t in_length,
+	     unsigned char **outp)
+{
+	struct encoder *e;
+	unsigned char *src;
+	Py_ssize_t *head, *prev;
+	Py_ssize_t max_match, length, pos, inserted;
+	Py_ssize_t ret = -1;
+
+	*outp = NULL;
+	if (in_length == 0)
+		return 0;
+
+	e = calloc(1, sizeof *e);
+	head = malloc(HASH_SIZE * sizeof *head);
+	prev = malloc(HIST_LEN * sizeof *prev);
+	max_match = in_length < MAX_MATCH_LEN ? in_length : MAX_MATCH_LEN;
+	length = max_match + in_length;
+	src = malloc(length);
+	if (e == NULL || head == NULL || prev == NULL || src == NULL)
+		goto done;
+
+	init_model(&e->model);
+	e->low = 0;
+	e->high = QUADRANT4;
+	memset(src, 0x20, max_match);
+	memcpy(src + max_match, in, in_length);
+	for (pos = 0; pos < HASH_SIZE; pos++)
+		head[pos] = -1;
+
+	inserted = 0;
+	pos = max_match;
+	while (pos < length) {
+		Py_ssize_t limit = length - pos;
+		Py_ssize_t match_len = 0, match_pos = 0;
+		Py_ssize_t p;
+
+		if (limit > max_match)
+			limit = max_match;
+
+		/* add the positions before this one to the hash chains */
+		for (; inserted < pos && inserted + 2 < length; inserted++) {
+			unsigned h = hash3(src + inserted);
+			prev[inserted % HIST_LEN] = head[h];
+			head[h] = inserted;
+		}
+
+		if (limit >= MIN_MATCH_LEN) {
+			p = head[hash3(src + pos)];
+			while (p >= 0 && p >= pos - HIST_LEN) {
+				Py_ssize_t end = pos - p, n = 0;
+				if (end > limit)
+					end = limit;
+				while (n < end && src[p + n] == src[pos + n])
+					n++;
+				if (n > match_len) {
+					match_len = n;
+					match_pos = p;
+					if (n == limit)
+						break;
+				}
+				p = prev[p % HIST_LEN];
+			}
+		}
+
+		if (match_len < MIN_MATCH_LEN) {
+			if (encode_char(e, src[pos]) == -1)
+				goto done;
+			pos++;
+		} else {
+			if (encode_char(e, 256 - MIN_MATCH_LEN + match_len)
+			    == -1)
+				goto done;
+			if (encode_position(e, pos - match_pos - 1) == -1)
+				goto done;
+			pos += match_len;
+		}
+	}
+
+	e->shifts++;
+	if (output_bit(e, e->low >= QUADRANT1) == -1)
+		goto done;
+	while (e->nbits != 0)
+		if (put_bit(e, 0) == -1)
+			goto done;
+
+	*outp = e->out;
+	e->out = NULL;
+	ret = e->out_len;
+
+done:
+	if (e != NULL)
+		free(e->out);
+	free(e);
+	free(head);
+	free(prev);
+	free(src);
+	return ret;
+}
+
+/*
+ * Decompression
+ */
+
+struct decoder {
+	struct model model;
+	const unsigned char *in;
+	Py_ssize_t in_length;
+	Py_ssize_t bitpos;
+	long low;
+	long high;
+	/* unsigned so a corrupt input can't overflow it */
+	unsigned long long code;
+};
+
+static int
+get_bit(struct decoder *d)
+{
+	Py_ssize_t i = d->bitpos >> 3;
+	int bit = 0;
+
+	/* the input is treated as if padded with zeros, lzari_decode()
+	   stops once too much of the padding has been read */
+	if (i < d->in_length)
+		bit = (d->in[i] >> (7 - (d->bitpos & 7))) & 1;
+	d->bitpos++;
+	return bit;
+}
+
+static void
+decode_range(struct decoder *d, unsigned long long hi_cum,
+	     unsigned long long lo_cum,
+	     unsigned long long total, long range)
+{
+	long low = d->low;
+	long high = low + (long) ((unsigned long long) range * hi_cum / total);
+	unsigned long long code = d->code;
+
+	low += (long) ((unsigned long long) range * lo_cum / total);
+	for (;;) {
+		if (low >= QUADRANT2) {
+			low -= QUADRANT2;
+			code -= QUADRANT2;
+			high -= QUADRANT2;
+		} else if (low >= QUADRANT1 && high <= QUADRANT3) {
+			low -= QUADRANT1;
+			code -= QUADRANT1;
+			high -= QUADRANT1;
+		} else if (high > QUADRANT2) {
+			break;
+		}
+		low *= 2;
+		high *= 2;
+		code = code * 2 + get_bit(d);
+	}
+	d->low = low;
+	d->high = high;
+	d->code = code;
+}
+
+static int
+decode_char(struct decoder *d)
+{
+	struct model *m = &d->model;
+	long range = d->high - d->low;
+	unsigned long long x = ((unsigned long long) (d->code - d->low + 1)
+			   * m->sym_cum[0] - 1) / range;
+	int i = 1, j = MAX_CHAR, k, ch;
+
+	while (i < j) {
+		k = (i + j) / 2;
+		if (m->sym_cum[k] > x)
+			i = k + 1;
+		else
+			j = k;
+	}
+	decode_range(d, m->sym_cum[i - 1], m->sym_cum[i], m->sym_cum[0],
+		     range);
+	ch = m->symbol_to_char[i];
+	update_model(m, i);
+	return ch;
+}
+
+static int
+decode_position(struct decoder *d)
+{
+	struct model *m = &d->model;
+	long range = d->high - d->low;
+	unsigned long long x = ((unsigned long long) (d->code - d->low + 1)
+			   * m->position_cum[0] - 1) / range;
+	int i = 1, j = HIST_LEN, k;
+
+	while (i < j) {
+		k = (i + j) / 2;
+		if (m->position_cum[k] > x)
+			i = k + 1;
+		else
+			j = k;
+	}
+	i--;
+	decode_range(d, m->position_cum[i], m->position_cum[i + 1],
+		     m->position_cum[0], range);
+	return i;
+}
+
+/*
+ * out must have room for HIST_LEN + out_length + MAX_MATCH_LEN bytes.
+ * Returns -1 if the input runs out before out_length bytes are decoded.
+ * Like the pure-Python decoder, up to 16 bytes of zero padding past the
+ * end of the input are allowed to be read.
+ */
+static int
+lzari_decode(const unsigned char *in, Py_ssize_t in_length,
+	     unsigned char *out, Py_ssize_t out_length)
+{
+	struct decoder d;
+	Py_ssize_t pos, end;
+	Py_ssize_t bit_limit = (in_length + IN_PADDING) * 8;
+	int i;
+
+	init_model(&d.model);
+	d.in = in;
+	d.in_length = in_length;
+	d.bitpos = 0;
+	d.low = 0;
+	d.high = QUADRANT4;
+	d.code = 0;
+	for (i = 0; i < ARITH_BITS + 2; i++)
+		d.code = d.code * 2 + get_bit(&d);
+
+	/* the initial contents of the history */
+	memset(out, 0, MAX_MATCH_LEN);
+	memset(out + MAX_MATCH_LEN, 0x20, HIST_LEN - MAX_MATCH_LEN);
+
+	pos = HIST_LEN;
+	end = HIST_LEN + out_length;
+	while (pos < end) {
+		int ch;
+
+		if (d.bitpos > bit_limit)
+			return -1;
+		ch = decode_char(&d);
+		if (ch < 0x100) {
+			out[pos++] = ch;
+		} else {
+			int length = ch - 0x100 + MIN_MATCH_LEN;
+			Py_ssize_t start = pos - decode_position(&d) - 1;
+			for (i = 0; i < length; i++)
+				out[pos++] = out[start + i];
+		}
+	}
+	return 0;
+}
+
+/*
+ * Python interface
+ */
+
+static PyObject *
+py_encode(PyObject *self, PyObject *args)
+{
+	Py_buffer src;
+	unsigned char *out;
+	Py_ssize_t length;
+	PyObject *ret;
+
+	if (!PyArg_ParseTuple(args, "y*:encode", &src))
+		return NULL;
+	Py_BEGIN_ALLOW_THREADS
+	length = lzari_encode(src.buf, src.len, &out);
+	Py_END_ALLOW_THREADS
+	PyBuffer_Release(&src);
+	if (length == -1)
+		return PyErr_NoMemory();
+	ret = PyBytes_FromStringAndSize((char *) out, length);
+	free(out);
+	return ret;
+}
+
+static PyObject *
+py_decode(PyObject *self, PyObject *args)
+{
+	Py_buffer src;
+	Py_ssize_t out_length;
+	unsigned char *out;
+	PyObject *ret;
+	int err;
+
+	if (!PyArg_ParseTuple(args, "y*n:decode", &src, &out_length))
+		return NULL;
+	if (out_length < 0) {
+		PyBuffer_Release(&src);
+		PyErr_SetString(PyExc_ValueError, "negative output length");
+		return NULL;
+	}
+	out = malloc(HIST_LEN + out_length + MAX_MATCH_LEN);
+	if (out == NULL) {
+		PyBuffer_Release(&src);
+		return PyErr_NoMemory();
+	}
+	Py_BEGIN_ALLOW_THREADS
+	err = lzari_decode(src.buf, src.len, out, out_length);
+	Py_END_ALLOW_THREADS
+	PyBuffer_Release(&src);
+	if (err == -1) {
+		free(out);
+		PyErr_SetString(PyExc_ValueError,
+				"compressed input is corrupt");
+		return NULL;
+	}
+	ret = PyBytes_FromStringAndSize((char *) out + HIST_LEN, out_length);
+	free(out);
+	return ret;
+}
+
+static PyMethodDef lzari_methods[] = {
+	{"encode", py_encode, METH_VARARGS,
+	 "encode(src) -> bytes\n\nCompress a string."},
+	{"decode", py_decode, METH_VARARGS,
+	 "decode(src, out_length) -> bytes\n\nDecompress a string."},
+	{NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef lzari_module = {
+	PyModuleDef_HEAD_INIT,
+	"_lzari",
+	"Native implementation of the LZARI codec.",
+	-1,
+	lzari_methods
+};
+
+PyMODINIT_FUNC
+PyInit__lzari(void)
+{
+	return PyModule_Create(&lzari_module);
+}
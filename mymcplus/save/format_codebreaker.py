@@ -15,11 +15,12 @@
 # along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import array
+import threading
 import zlib
 
 from .. import ps2mc_dir
 from .. import utils
+from ..round import round_up
 from .utils import *
 
 
@@ -27,6 +28,11 @@ FORMAT_ID = "cbs"
 
 PS2SAVE_CBS_MAGIC = b"CFU\0"
 
+# The values Codebreaker itself uses for the second and third header
+# fields: the version of the format and the length of the header.
+_CBS_VERSION = 0x1F40
+_CBS_HEADER_LENGTH = 296
+
 # This is the initial permutation state ("S") for the RC4 stream cipher
 # algorithm used to encrpyt and decrypt Codebreaker saves.
 PS2SAVE_CBS_RC4S = [0x5f, 0x1f, 0x85, 0x6f, 0x31, 0xaa, 0x3b, 0x18,
@@ -63,20 +69,69 @@ PS2SAVE_CBS_RC4S = [0x5f, 0x1f, 0x85, 0x6f, 0x31, 0xaa, 0x3b, 0x18,
             0x6b, 0x93, 0x32, 0x48, 0xb6, 0x30, 0x43, 0xa5]
 
 
+_CHUNK_SIZE = 65536
+
+
+class _rc4_keystream(object):
+    """An RC4 keystream that's generated in chunks and kept.
+
+    Every Codebreaker save is encrypted with the same initial
+    permutation, so the keystream only ever needs to be generated once."""
+
+    def __init__(self, s):
+        self.s = list(s)
+        self.i = 0
+        self.j = 0
+        self.stream = bytearray()
+        self.lock = threading.Lock()
+
+    def _extend(self, n):
+        s = self.s
+        i = self.i
+        j = self.j
+        out = bytearray(n)
+        for k in range(n):
+            i = (i + 1) & 0xFF
+            si = s[i]
+            j = (j + si) & 0xFF
+            sj = s[j]
+            s[i] = sj
+            s[j] = si
+            out[k] = s[(si + sj) & 0xFF]
+        self.i = i
+        self.j = j
+        self.stream += out
+
+    def get(self, offset, length):
+        """Return length bytes of the keystream starting at offset."""
+        end = offset + length
+        with self.lock:
+            if len(self.stream) < end:
+                self._extend(round_up(end - len(self.stream),
+                              _CHUNK_SIZE))
+            return bytes(self.stream[offset : end])
+
+
+_cbs_keystream = _rc4_keystream(PS2SAVE_CBS_RC4S)
+
+
+def _xor(a, b):
+    """XOR two byte strings of the same length together."""
+    n = len(a)
+    return (int.from_bytes(a, "little")
+        ^ int.from_bytes(b, "little")).to_bytes(n, "little")
+
+
 def _rc4_crypt(s, t):
     """RC4 encrypt/decrypt the string t using the permutation s.
 
-    Returns a byte array."""
+    Returns a bytes object."""
 
-    s = array.array('B', s)
-    t = array.array('B', t)
-    j = 0
-    for ii in range(len(t)):
-        i = (ii + 1) % 256
-        j = (j + s[i]) % 256
-        (s[i], s[j]) = (s[j], s[i])
-        t[ii] ^= s[(s[i] + s[j]) % 256]
-    return t
+    if s is PS2SAVE_CBS_RC4S:
+        keystream = _cbs_keystream
+    else:
+        keystream = _rc4_keystream(s)
+    return _xor(t, keystream.get(0, len(t)))
 
 
 def poll(hdr):
@@ -106,25 +161,36 @@ def load(save, f):
         modified = ps2mc_dir.tod_now()
 
     # flen can either be the total length of the file,
-    # or the length of compressed body of the file
-    body = f.read(flen)
-    clen = len(body)
+    # or the length of compressed body of the file.  The body is
+    # decrypted and decompressed a chunk at a time as it's read.
+    dcobj = zlib.decompressobj()
+    body = bytearray()
+    clen = 0
+    while clen < flen:
+        chunk = f.read(min(_CHUNK_SIZE, flen - clen))
+        if chunk == b"":
+            break
+        chunk = _xor(chunk, _cbs_keystream.get(clen, len(chunk)))
+        clen += len(chunk)
+        if dlen == 0:
+            body += dcobj.decompress(chunk)
+        elif len(body) < dlen and not dcobj.eof:
+            body += dcobj.decompress(chunk, dlen - len(body))
     if clen != flen and clen != flen - hlen:
         raise ps2save.Eof(f)
-    body = _rc4_crypt(PS2SAVE_CBS_RC4S, body)
-    dcobj = zlib.decompressobj()
-    body = dcobj.decompress(body, dlen)
 
     files = []
-    while body != b"":
-        if len(body) < 64:
+    offset = 0
+    while offset < len(body):
+        if len(body) - offset < 64:
             raise ps2save.Eof(f)
-        header = struct.unpack("<8s8sLHHLL32s", body[:64])
+        header = struct.unpack_from("<8s8sLHHLL32s", body, offset)
         size = header[2]
-        data = body[64 : 64 + size]
+        offset += 64
+        data = bytes(body[offset : offset + size])
         if len(data) != size:
             raise ps2save.Eof(f)
-        body = body[64 + size:]
+        offset += size
         files.append((header, data))
 
     save.set_directory((dirmode, 0, len(files), created, 0, 0, modified, 0, dirname))
@@ -141,3 +207,56 @@ def load(save, f):
         if ps2mc_dir.tod_to_time(modified) == 0:
             modified = ps2mc_dir.tod_now()
         save.set_file(i, (mode, 0, size, created, 0, 0, modified, 0, name), data)
+
+
+def save(save, f, level = 9):
+    """Write a save file in the Codebreaker format.
+
+    The body is compressed with zlib at the given level."""
+
+    title = ""
+    icon_sys = save.get_icon_sys()
+    if icon_sys != None:
+        title = icon_sys.get_title("ascii")
+        if len(title[0]) > 0 and title[0][-1] != ' ':
+            title = title[0] + " " + title[1].strip()
+        else:
+            title = title[0] + title[1].rstrip()
+    title = title.encode("ascii")
+
+    dirent = save.get_directory()
+    cobj = zlib.compressobj(level)
+    compressed = []
+    dlen = 0
+    for i in range(dirent[2]):
+        (ent, data) = save.get_file(i)
+        if not ps2mc_dir.mode_is_file(ent[0]):
+            raise ps2mc_dir.Error("Non-file in save file.")
+        header = struct.pack("<8s8sLHHLL32s",
+                     ps2mc_dir.pack_tod(ent[3]),
+                     ps2mc_dir.pack_tod(ent[6]),
+                     len(data), ent[0] & 0xFFFF, 0, 0, 0, ent[8])
+        compressed.append(cobj.compress(header))
+        compressed.append(cobj.compress(data))
+        dlen += 64 + len(data)
+    compressed.append(cobj.flush())
+
+    body = []
+    clen = 0
+    for s in compressed:
+        if s != b"":
+            body.append(_xor(s, _cbs_keystream.get(clen, len(s))))
+            clen += len(s)
+
+    hlen = 92 + len(title) + 1
+    hlen = max(hlen, _CBS_HEADER_LENGTH)
+    f.write(PS2SAVE_CBS_MAGIC)
+    f.write(struct.pack("<LL", _CBS_VERSION, hlen))
+    f.write(struct.pack("<LL32s8s8sLLLLLL%ds" % (hlen - 92),
+                dlen, hlen + clen, dirent[8],
+                ps2mc_dir.pack_tod(dirent[3]),
+                ps2mc_dir.pack_tod(dirent[6]),
+                0, 0, dirent[0] & 0xFFFF, 0, 0, 0, title))
+    for s in body:
+        f.write(s)
+    f.flush()
@@ -16,6 +16,7 @@
 #
 
 import binascii
+import io
 
 from .. import ps2mc_dir
 from .. import utils
@@ -29,6 +30,9 @@ FORMAT_ID = "max"
 
 PS2SAVE_MAX_MAGIC = b"Ps2PowerSave"
 
+# size of the pieces compressed data is passed to the decoder in
+CHUNK_SIZE = 65536
+
 
 def poll(hdr):
     return hdr.startswith(PS2SAVE_MAX_MAGIC)
@@ -40,18 +44,45 @@ def load2(save, f):
 
     if lzari is None:
         raise ps2mc_dir.Error("The lzari module is needed to decompress MAX Drive saves.")
-    s = lzari.decode(s, length, "decompressing " + save.dirent[8].decode("ascii") + ": ")
+
+    progress = "decompressing " + save.dirent[8].decode("ascii") + ": "
+    if lzari.backend != "python":
+        # the compiled codec is fast enough to do it all at once
+        try:
+            read = io.BytesIO(lzari.decode(s, length, progress)).read
+        except ValueError:
+            raise ps2save.Eof(f)
+    else:
+        # Files are decompressed one at a time, with the compressed
+        # data given to the decoder as needed.
+        decoder = lzari.LzariDecoder(length, progress)
+        src = memoryview(s)
+        in_pos = 0
+
+        def read(n):
+            nonlocal in_pos
+            data = decoder.read(n)
+            while len(data) < n and not decoder.eof and in_pos <= len(src):
+                decoder.feed(src[in_pos: in_pos + CHUNK_SIZE])
+                in_pos += CHUNK_SIZE
+                if in_pos >= len(src):
+                    decoder.feed_eof()
+                    in_pos = len(src) + 1
+                data += decoder.read(n - len(data))
+            return data
+
     dirlen = save.dirent[2]
     timestamp = save.dirent[3]
     off = 0
     for i in range(dirlen):
-        if len(s) - off < 36:
+        s = read(36)
+        if len(s) < 36:
             raise ps2save.Eof(f)
-        (l, name) = struct.unpack("<L32s", s[off: off + 36])
+        (l, name) = struct.unpack("<L32s", s)
         name = utils.zero_terminate(name)
         # print "%08x %08x %s" % (off, l, name)
         off += 36
-        data = s[off: off + l]
+        data = read(l)
         if len(data) != l:
             raise ps2save.Eof(f)
         save.set_file(i,
@@ -60,7 +91,9 @@ def load2(save, f):
                        name),
                       data)
         off += l
-        off = round_up(off + 8, 16) - 8
+        padding = round_up(off + 8, 16) - 8 - off
+        read(padding)
+        off += padding
 
 
 def load(save, f, timestamp=None):
@@ -99,25 +132,47 @@ def save(save, f):
             iconsysname = title[0] + " " + title[1].strip()
         else:
             iconsysname = title[0] + title[1].rstrip()
-    s = b""
     dirent = save.dirent
+    length = 0
     for i in range(dirent[2]):
         (ent, data) = save.get_file(i)
         if not ps2mc_dir.mode_is_file(ent[0]):
             raise ps2mc_dir.Error("Non-file in save file.")
-        s += struct.pack("<L32s", ent[2], ent[8])
-        s += data
-        s += b"\0" * (round_up(len(s) + 8, 16) - 8 - len(s))
-    length = len(s)
+        length = round_up(length + 36 + len(data) + 8, 16) - 8
+
+    # With the pure-Python codec each file is passed to the encoder
+    # separately, so only the compressed data is held in memory.
     progress = "compressing " + dirent[8].decode("ascii") + ": "
-    compressed = lzari.encode(s, progress)
+    encoder = None
+    if lzari.backend == "python":
+        encoder = lzari.LzariEncoder(length, progress)
+    pieces = []
+    off = 0
+    for i in range(dirent[2]):
+        (ent, data) = save.get_file(i)
+        off += 36 + len(data)
+        padding = round_up(off + 8, 16) - 8 - off
+        off += padding
+        for s in [struct.pack("<L32s", ent[2], ent[8]), data, b"\0" * padding]:
+            if encoder != None:
+                s = encoder.write(s)
+            pieces.append(s)
+    if encoder != None:
+        compressed = pieces
+        compressed.append(encoder.finish())
+    else:
+        compressed = [lzari.encode(b"".join(pieces), progress)]
+    clen = sum(map(len, compressed))
+
     hdr = struct.pack("<12sL32s32sLLL", PS2SAVE_MAX_MAGIC,
                       0, dirent[8], iconsysname.encode("ascii"),
-                      len(compressed) + 4, dirent[2], length)
+                      clen + 4, dirent[2], length)
     crc = binascii.crc32(hdr)
-    crc = binascii.crc32(compressed, crc)
+    for s in compressed:
+        crc = binascii.crc32(s, crc)
     f.write(struct.pack("<12sL32s32sLLL", PS2SAVE_MAX_MAGIC,
                         crc & 0xFFFFFFFF, dirent[8], iconsysname.encode("ascii"),
-                        len(compressed) + 4, dirent[2], length))
-    f.write(compressed)
+                        clen + 4, dirent[2], length))
+    for s in compressed:
+        f.write(s)
     f.flush()
@@ -17,28 +17,26 @@
 
 """
 Implementation of Haruhiko Okumura's LZARI data compression algorithm
-in Python.  Largely based on LZARI.C, one key difference is the use of
-a two level dicitionary look up during compression rather than
-LZARI.C's binary search tree.
+in Python.  Largely based on LZARI.C, one key difference is that
+matches are found during compression by searching the history with
+bytes.rfind() rather than with LZARI.C's binary search tree.
 """
 
 import sys
 import array
 import binascii
-import string
 import time
-from bisect import bisect_right
-from math import log
+from bisect import bisect_left, bisect_right
 
 try:
-    import ctypes
-    import mymcsup
+    from . import _lzari
 except ImportError:
-    mymcsup = None
+    _lzari = None
 
 hexlify = binascii.hexlify
 
-__ALL__ = ['lzari_codec', 'string_to_bit_array', 'bit_array_to_string']
+__ALL__ = ['lzari_codec', 'LzariEncoder', 'LzariDecoder',
+           'string_to_bit_array', 'bit_array_to_string']
 
 #
 # Fundamental constants of the LZARI compression alogorithm.
@@ -58,16 +56,6 @@ QUADRANT4 = QUADRANT1 * 4
 MAX_CUM = QUADRANT1 - 1
 MAX_CHAR = (256 + MAX_MATCH_LEN - MIN_MATCH_LEN + 1)
 
-#
-# Other constants specific to this implementation
-#
-
-MAX_SUFFIX_CHAIN = 50    # limit on how many identical suffixes to try to match
-
-#def debug(value, msg):
-#    print "@@@ %s %04x" % (msg, value)
-debug = lambda value, msg: None
-
 _tr_16 = bytes.maketrans(b"0123456789abcdef",
               b"\x00\x01\x02\x03"
               b"\x10\x11\x12\x13"
@@ -103,690 +91,614 @@ def bit_array_to_string(a):
     s = binascii.unhexlify(s.translate(_tr_rev_4))
     return binascii.unhexlify(s.translate(_tr_rev_16))
 
-def _match(src, pos, hpos, mlen, end):
-    mlen += 1
-    if not src.startswith(src[hpos : hpos + mlen], pos):
-        return None
-    for i in range(mlen, end):
-        if src[pos + i] != src[hpos + i]:
-            return i
-    return end
-
-def _rehash_table2(src, chars, head, next, next2, hist_invalid):
-    p = head
-    table2 = {}
-    l = []
-    while p > hist_invalid:
-        l.append(p)
-        p = next[p % HIST_LEN]
-    l.reverse()
-    for p in l:
-        p2 = p + MIN_MATCH_LEN
-        key2 = src[p2 : p2 + chars]
-        head2 = table2.get(key2, hist_invalid)
-        next2[p % HIST_LEN] = head2
-        table2[key2] = p
-    return table2
+def _make_position_cum():
+    cum = [0] * (HIST_LEN + 1)
+    a = 0
+    for i in range(HIST_LEN, 0, -1):
+        a = a + 10000 // (200 + i)
+        cum[i - 1] = a
+    return cum
+
+_position_cum = _make_position_cum()
+# ascending copy for bisect_right()
+_position_cum_rev = _position_cum[::-1]
+
+# The symbol frequencies are kept in a Fenwick tree indexed
+# by MAX_CHAR + 1 - symbol, so the cumulative frequency used by the
+# arithmetic coder is a prefix sum.  The tree is padded to a power of
+# two with entries too large to ever be selected.
+_FENWICK_SIZE = 512
+
+def _fenwick_build(freq):
+    tree = [0] * _FENWICK_SIZE
+    for i in range(1, MAX_CHAR + 1):
+        tree[i] += freq[MAX_CHAR + 1 - i]
+        j = i + (i & -i)
+        if j <= MAX_CHAR:
+            tree[j] += tree[i]
+    for i in range(MAX_CHAR + 1, _FENWICK_SIZE):
+        tree[i] = QUADRANT4
+    return tree
+
+# Input and output are processed in chunks of this size, the progress
+# is reported between them.
+_CHUNK_SIZE = 65536
+
+class LzariEncoder(object):
+    """Compress a stream of data incrementally.
+
+    Data passed to write() is compressed as soon as enough of it is
+    available to find matches.  Both write() and finish() return
+    whatever compressed data is ready."""
+
+    def __init__(self, length = None, progress = None):
+        self.length = length
+        self.progress = progress
+        self._last_percent = -1
+        self._consumed = 0
+        self._finished = False
+        self._buf = bytearray()
+        self._max_match = None
+        self._in_pos = 0
+
+        self._char_to_symbol = list(range(1, MAX_CHAR + 1))
+        self._symbol_to_char = [0] + list(range(MAX_CHAR))
+        self._sym_freq = [0] + [1] * MAX_CHAR
+        # negated so the sorted order can be searched with bisect
+        self._sym_neg_freq = [0] + [-1] * MAX_CHAR
+        self._tree = _fenwick_build(self._sym_freq)
+        self._total = MAX_CHAR
+
+        # Output bits are collected in an integer and moved to out
+        # a few bytes at a time.
+        self._out = bytearray()
+        self._bits = 0
+        self._nbits = 0
+        self._shifts = 0
+        self._low = 0
+        self._high = QUADRANT4
+
+    def write(self, data):
+        """Add data to be compressed."""
+
+        if self._finished:
+            raise ValueError("write after finish")
+        self._buf += data
+        while (self._max_match != None
+               or len(self._buf) >= MAX_MATCH_LEN):
+            if self._max_match == None:
+                self._start()
+            end = len(self._buf) - self._max_match
+            if end - self._in_pos > _CHUNK_SIZE:
+                end = self._in_pos + _CHUNK_SIZE
+            if end <= self._in_pos:
+                break
+            self._encode(end)
+        return self._take_output()
 
-class lzari_codec(object):
-    # despite the name this does not implement a codec compatible
-    # with Python's codec system
-    
-    def init(self, decode):
-        self.high = QUADRANT4
-        self.low = 0
-        if decode:
-            self.code = 0
-            # reverse the order of sym_cum so bisect_right() can
-            # be used for faster searching
-            self.sym_cum = list(range(0, MAX_CHAR + 1))
+    def finish(self):
+        """Compress any remaining data and end the stream."""
+
+        if self._finished:
+            return b""
+        self._finished = True
+        if self._max_match == None:
+            if len(self._buf) == 0:
+                return b""
+            self._start()
+        while self._in_pos < len(self._buf):
+            self._encode(min(self._in_pos + _CHUNK_SIZE,
+                     len(self._buf)))
+
+        bits = self._bits
+        nbits = self._nbits
+        shifts = self._shifts + 1
+        if self._low < QUADRANT1:
+            bits = (bits << (shifts + 1)) | ((1 << shifts) - 1)
         else:
-            self.shifts = 0
-            self.char_to_symbol = list(range(1, MAX_CHAR + 1))
-            self.sym_cum = list(range(MAX_CHAR, -1, -1))
-            self.next_table = [None] * HIST_LEN
-            self.next2_table = [None] * HIST_LEN
-            self.suffix_table = {}
-
-        self.symbol_to_char = [0] + list(range(MAX_CHAR))
-        self.sym_freq = [0] + [1] * MAX_CHAR
-        self.position_cum = [0] * (HIST_LEN + 1)
-        a = 0
-        for i in range(HIST_LEN, 0, -1):
-            a =  a + 10000 // (200 + i)
-            self.position_cum[i - 1] = a
-        
-    def search(self, table, x):
-        c = 1
-        s = len(table) - 1
-        while True:
-            a = (s + c) // 2
-            if table[a] <= x:
-                s = a
+            bits = (bits << (shifts + 1)) | (1 << shifts)
+        nbits += shifts + 1
+        # pad the last byte with zeros
+        i = -nbits % 8
+        self._out += (bits << i).to_bytes((nbits + i) >> 3, "big")
+        self._bits = self._nbits = self._shifts = 0
+
+        if self.progress:
+            sys.stderr.write("%s100%%\n" % self.progress)
+        return self._take_output()
+
+    def _take_output(self):
+        out = bytes(self._out)
+        del self._out[:]
+        return out
+
+    def _start(self):
+        # The maximum match length is limited by the length of the
+        # data for short inputs, so compression can't start until
+        # either MAX_MATCH_LEN bytes are available or the end is
+        # known.
+        self._max_match = min(MAX_MATCH_LEN, len(self._buf))
+        self._buf[0:0] = b"\x20" * self._max_match
+        self._in_pos = self._max_match
+
+    def _report_progress(self):
+        if not self.progress or not self.length:
+            return
+        percent = self._consumed * 100 // self.length
+        if percent != self._last_percent:
+            sys.stderr.write("%s%3d%%\r" % (self.progress, percent))
+            self._last_percent = percent
+
+    def _encode(self, end):
+        """Compress the buffered data up to position end."""
+
+        src = self._buf
+        in_pos = self._in_pos
+        start_pos = in_pos
+        if in_pos > HIST_LEN + _CHUNK_SIZE:
+            # discard history that can no longer be matched
+            del src[:in_pos - HIST_LEN]
+            end -= in_pos - HIST_LEN
+            in_pos = HIST_LEN
+            start_pos = in_pos
+        in_length = len(src)
+        rfind = src.rfind
+        max_match = self._max_match
+
+        char_to_symbol = self._char_to_symbol
+        symbol_to_char = self._symbol_to_char
+        sym_freq = self._sym_freq
+        sym_neg_freq = self._sym_neg_freq
+        tree = self._tree
+        total = self._total
+        position_cum = _position_cum
+        max_position_cum = position_cum[0]
+        out = self._out
+        bits = self._bits
+        nbits = self._nbits
+        shifts = self._shifts
+        low = self._low
+        high = self._high
+
+        while in_pos < end:
+            # Find the longest match that lies entirely in the
+            # history, the most recent one if there's a tie.
+            # Each search looks for a string one byte longer than
+            # the last match found, which is then extended as far
+            # as it goes.
+            match_len = 0
+            limit = min(max_match, in_length - in_pos)
+            mlen = MIN_MATCH_LEN
+            hist_start = max(in_pos - HIST_LEN, 0)
+            while mlen <= limit:
+                p = rfind(src[in_pos : in_pos + mlen], hist_start,
+                      in_pos)
+                if p == -1:
+                    break
+                m = min(limit, in_pos - p)
+                while mlen < m and src[p + mlen] == src[in_pos + mlen]:
+                    mlen += 1
+                match_pos = p
+                match_len = mlen
+                mlen += 1
+
+            if match_len < MIN_MATCH_LEN:
+                char = src[in_pos]
+                in_pos += 1
             else:
-                c = a + 1
-            if c >= s:
-                break
-        return c
-
-    def update_model_decode(self, symbol):
-        # A compatible implemention to the one used while compressing.
-        
-        sym_freq = self.sym_freq
-        sym_cum = self.sym_cum
-        
-        if self.sym_cum[MAX_CHAR] >= MAX_CUM:
-            c = 0
-            for i in range(MAX_CHAR, 0, -1):
-                self.sym_cum[MAX_CHAR - i] = c
-                a = (self.sym_freq[i] + 1) // 2
-                self.sym_freq[i] = a
-                c += a
-            self.sym_cum[MAX_CHAR] = c
-        freq = sym_freq[symbol]
-        new_symbol = symbol
-        while self.sym_freq[new_symbol - 1] == freq:
-            new_symbol -= 1
-        # new_symbol = sym_freq.index(freq)
-        if new_symbol != symbol:
-            symbol_to_char = self.symbol_to_char
-            swap_char = symbol_to_char[new_symbol]
-            char = symbol_to_char[symbol]
-            symbol_to_char[new_symbol] = char
-            symbol_to_char[symbol] = swap_char
-        sym_freq[new_symbol] = freq + 1
-        for i in range(MAX_CHAR - new_symbol + 1, MAX_CHAR + 1):
-            sym_cum[i] += 1
-            
-    def update_model_encode(self, symbol):
-        sym_freq = self.sym_freq
-        sym_cum = self.sym_cum
-        
-        if sym_cum[0] >= MAX_CUM:
-            c = 0
-            for i in range(MAX_CHAR, 0, -1):
-                sym_cum[i] = c
-                a = (sym_freq[i] + 1) // 2
-                sym_freq[i] = a
-                c += a
-            sym_cum[0] = c
-        freq = sym_freq[symbol]
-        new_symbol = symbol
-        while sym_freq[new_symbol - 1] == freq:
-            new_symbol -= 1
-        if new_symbol != symbol:
-            debug(new_symbol, "a")
-            swap_char = self.symbol_to_char[new_symbol]
-            char = self.symbol_to_char[symbol]
-            self.symbol_to_char[new_symbol] = char
-            self.symbol_to_char[symbol] = swap_char
-            self.char_to_symbol[char] = new_symbol
-            self.char_to_symbol[swap_char] = symbol
-        sym_freq[new_symbol] += 1
-        for i in range(new_symbol):
-            sym_cum[i] += 1
-
-    def decode_char(self):
-        high = self.high
-        low = self.low
-        code = self.code
-        sym_cum = self.sym_cum
-        
-        _range = high - low
-        max_cum_freq = sym_cum[MAX_CHAR]
-        n = ((code - low + 1) * max_cum_freq - 1) // _range
-        i = bisect_right(sym_cum, n, 1)
-        high = low + sym_cum[i] * _range // max_cum_freq
-        low += sym_cum[i - 1] * _range // max_cum_freq
-        symbol = MAX_CHAR + 1 - i
-
-        while True:
-            if low < QUADRANT2:
-                if low < QUADRANT1 or high > QUADRANT3:
-                    if high > QUADRANT2:
-                        break
-                else:
+                char = 256 - MIN_MATCH_LEN + match_len
+                in_pos += match_len
+
+            symbol = char_to_symbol[char]
+            freq = sym_freq[symbol]
+            cum = 0
+            i = MAX_CHAR - symbol
+            while i:
+                cum += tree[i]
+                i &= i - 1
+            _range = high - low
+            high = low + _range * (cum + freq) // total
+            low += _range * cum // total
+            while True:
+                if high <= QUADRANT2:
+                    bits = (bits << (shifts + 1)) | ((1 << shifts) - 1)
+                    nbits += shifts + 1
+                    shifts = 0
+                elif low >= QUADRANT2:
+                    bits = (bits << (shifts + 1)) | (1 << shifts)
+                    nbits += shifts + 1
+                    shifts = 0
+                    low -= QUADRANT2
+                    high -= QUADRANT2
+                elif low >= QUADRANT1 and high <= QUADRANT3:
+                    shifts += 1
                     low -= QUADRANT1
-                    code -= QUADRANT1
                     high -= QUADRANT1
-            else:
-                low -= QUADRANT2
-                code -= QUADRANT2
-                high -= QUADRANT2
-            low *= 2
-            high *= 2
-            code = code * 2 + self.in_iter()
-
-        ret = self.symbol_to_char[symbol]
-        self.high = high
-        self.low = low
-        self.code = code
-        self.update_model_decode(symbol)
-        return ret
-    
-    def decode_position(self):
-        _range = self.high - self.low
-        max_cum = self.position_cum[0]
-        pos = self.search(self.position_cum, ((self.code - self.low + 1) * max_cum - 1) // _range) - 1
-        self.high = (self.low + self.position_cum[pos] * _range // max_cum)
-        self.low += self.position_cum[pos + 1] * _range // max_cum
-        while True:
-            if self.low < QUADRANT2:
-                if (self.low < QUADRANT1
-                    or self.high > QUADRANT3):
-                    if self.high > QUADRANT2:
-                        return pos
                 else:
-                    self.low -= QUADRANT1
-                    self.code -= QUADRANT1
-                    self.high -= QUADRANT1
-            else:
-                self.low -= QUADRANT2
-                self.code -= QUADRANT2
-                self.high -= QUADRANT2
-            self.low *= 2
-            self.high *= 2
-            self.code = self.in_iter() + self.code * 2
-
-    def add_suffix_1(self, pos, find):
-        # naive implemention used for testing
-        
-        if not find:
-            return (None, 0)
-        src = self.src
-        mlen = min(1000, self.max_match, len(src) - pos)
-        hist_start = max(pos - HIST_LEN, 0)
-        while mlen >= MIN_MATCH_LEN:
-            i = src.rfind(src[pos : pos + mlen], hist_start, pos)
-            if i != -1:
-                assert (src[pos : pos + mlen]
-                    == src[i: i + mlen])
-                return (i, mlen)
-            mlen -= 1
-        return (None, -1)
-            
-    def add_suffix_2(self, pos, find):
-        # a two level dictionary look up that leverages Python's
-        # built-in dicts to get something that's hopefully faster
-        # than implementing binary trees in completely in Python.
-        
-        src = self.src
-        suffix_table = self.suffix_table
-        max_match = min(self.max_match, len(src) - pos)
-
-        mlen = -1
-        mpos = None
-        
-        hist_invalid = pos - HIST_LEN - 1
-        modpos = pos % HIST_LEN
-        pos2 = pos + MIN_MATCH_LEN
-        
-        key = src[pos : pos2]
-        a = suffix_table.get(key)
-        if a != None:
-            next = self.next_table
-            next2 = self.next2_table
-            
-            [count, head, table2, chars] = a
-            
-            pos3 = pos2 + chars
-            key2 = src[pos2 : pos3]
-            min_match2 = MIN_MATCH_LEN + chars
-            if find:
-                p = table2.get(key2, hist_invalid)
-                maxmlen = max_match - min_match2
-                while p > hist_invalid and mlen != maxmlen:
-                    p3 = p + min_match2
-                    if mpos == None and p3 <= pos:
-                        mpos = p
-                        mlen = 0
-                    if p3 >= pos:
-                        p = next2[p % HIST_LEN]
-                        continue
-                    rlen = _match(src, pos3, p3, mlen,
-                              min(maxmlen, pos - p3))
-                    if rlen != None:
-                        mpos = p
-                        mlen = rlen
-                    p = next2[p % HIST_LEN]
-            if mpos != None:
-                mlen += min_match2
-            elif find:
-                p = head
-                maxmlen = min(chars, max_match - MIN_MATCH_LEN)
-                i = 0
-                while (p > hist_invalid and i < 50000
-                       and mlen < maxmlen):
-                    assert i < count
-                    i += 1
-                    p2 = p + MIN_MATCH_LEN
-                    l2 = pos - p2
-                    if mpos == None and l2 >= 0:
-                        mpos = p
-                        mlen = 0
-                    if l2 <= 0:
-                        p = next[p % HIST_LEN]
-                        continue
-                    if l2 > maxmlen:
-                        l2 = maxmlen
-                    m = mlen + 1
-                    if src.startswith(src[p2 : p2 + m],
-                              pos2):
-                        mpos = p
-                        for j in range(m, l2):
-                            if (src[pos2 + j]
-                                != src[p2 + j]):
-                                mlen = j
-                                break
-                        else:
-                            mlen = l2
-                    #rlen = _match(src, pos2, p2, mlen, l2)
-                    #if rlen != None:
-                    #    mpos = p
-                    #    mlen = rlen
-                    p = next[p % HIST_LEN]
-                    
-                if mpos != None:
-                    mlen += MIN_MATCH_LEN
-                    
-            count += 1
-            new_chars = int(log(count, 2))
-            # new_chars = 50
-            new_chars = min(new_chars, max_match - MIN_MATCH_LEN)
-            if new_chars > chars:
-                chars = new_chars
-                table2 = _rehash_table2(src, chars, head,
-                            next, next2,
-                            hist_invalid)
-
-            next[modpos] = head
-            head = pos
-            
-            key2 = src[pos2 : pos2 + chars]
-            head2 = table2.get(key2, hist_invalid)
-            next2[modpos] = head2
-            table2[key2] = pos
-
-            a[0] = count
-            a[1] = head
-            a[2] = table2
-            a[3] = chars
+                    break
+                low *= 2
+                high *= 2
+
+            # update the model
+            if total >= MAX_CUM:
+                total = 0
+                for i in range(1, MAX_CHAR + 1):
+                    a = (sym_freq[i] + 1) // 2
+                    sym_freq[i] = a
+                    sym_neg_freq[i] = -a
+                    total += a
+                tree = _fenwick_build(sym_freq)
+                freq = sym_freq[symbol]
+            new_symbol = bisect_left(sym_neg_freq, -freq, 1, symbol)
+            if new_symbol != symbol:
+                swap_char = symbol_to_char[new_symbol]
+                symbol_to_char[new_symbol] = char
+                symbol_to_char[symbol] = swap_char
+                char_to_symbol[char] = new_symbol
+                char_to_symbol[swap_char] = symbol
+            sym_freq[new_symbol] = freq + 1
+            sym_neg_freq[new_symbol] = -freq - 1
+            total += 1
+            i = MAX_CHAR + 1 - new_symbol
+            while i <= MAX_CHAR:
+                tree[i] += 1
+                i += i & -i
+
+            if char >= 0x100:
+                position = in_pos - match_len - match_pos - 1
+                _range = high - low
+                high = (low + _range * position_cum[position]
+                    // max_position_cum)
+                low += (_range * position_cum[position + 1]
+                    // max_position_cum)
+                while True:
+                    if high <= QUADRANT2:
+                        bits = ((bits << (shifts + 1))
+                            | ((1 << shifts) - 1))
+                        nbits += shifts + 1
+                        shifts = 0
+                    elif low >= QUADRANT2:
+                        bits = (bits << (shifts + 1)) | (1 << shifts)
+                        nbits += shifts + 1
+                        shifts = 0
+                        low -= QUADRANT2
+                        high -= QUADRANT2
+                    elif low >= QUADRANT1 and high <= QUADRANT3:
+                        shifts += 1
+                        low -= QUADRANT1
+                        high -= QUADRANT1
+                    else:
+                        break
+                    low *= 2
+                    high *= 2
+
+            if nbits >= 64:
+                i = nbits & 7
+                out += (bits >> i).to_bytes(nbits >> 3, "big")
+                bits &= (1 << i) - 1
+                nbits = i
+
+        self._tree = tree
+        self._total = total
+        self._bits = bits
+        self._nbits = nbits
+        self._shifts = shifts
+        self._low = low
+        self._high = high
+        self._consumed += in_pos - start_pos
+        self._in_pos = in_pos
+        self._report_progress()
+
+class LzariDecoder(object):
+    """Decompress a stream of data incrementally.
+
+    Compressed data is passed to feed() and feed_eof() is called
+    once all of it has been given.  Since the compressed data doesn't
+    mark its own end, the length of the decompressed data must be
+    known in advance."""
+
+    def __init__(self, out_length, progress = None):
+        self.out_length = out_length
+        self.progress = progress
+        self.eof = out_length == 0
+        self._last_percent = -1
+        self._last_time = time.time()
+
+        self._in = bytearray()
+        self._in_eof = False
+        self._bitpos = None
+        self._low = 0
+        self._high = QUADRANT4
+        self._diff = 0
+
+        self._symbol_to_char = [0] + list(range(MAX_CHAR))
+        self._sym_freq = [0] + [1] * MAX_CHAR
+        # negated so the sorted order can be searched with bisect
+        self._sym_neg_freq = [0] + [-1] * MAX_CHAR
+        self._tree = _fenwick_build(self._sym_freq)
+        self._total = MAX_CHAR
+
+        # The output doubles as the history buffer, with its
+        # initial contents placed in front of it.
+        self._out = bytearray(b"\0" * MAX_MATCH_LEN
+                      + b"\x20" * (HIST_LEN - MAX_MATCH_LEN))
+        self._read_pos = HIST_LEN
+        self._left = out_length
+
+    def feed(self, data):
+        """Add compressed data."""
+
+        if self._in_eof:
+            raise ValueError("feed after feed_eof")
+        if self._bitpos != None and self._bitpos >= _CHUNK_SIZE * 8:
+            # discard input that's been used
+            n = self._bitpos >> 3
+            del self._in[:n]
+            self._bitpos -= n * 8
+        self._in += data
+
+    def feed_eof(self):
+        """Mark the end of the compressed data."""
+
+        if not self._in_eof:
+            self._in_eof = True
+            # the decoder may read a little past the end
+            self._in += bytes(16)
+
+    def read(self, size = -1):
+        """Return up to size bytes of decompressed data.
+
+        If size is negative all of the data that can be decompressed
+        from the input given so far is returned.  Less data than
+        asked for is returned only if more input is needed or the
+        end has been reached."""
+
+        out = self._out
+        while self._left > 0:
+            avail = len(out) - self._read_pos
+            if size >= 0 and avail >= size:
+                break
+            want = avail + _CHUNK_SIZE
+            if size >= 0:
+                want = min(want, size)
+            left = self._left
+            self._decode(want)
+            self._report_progress()
+            if self._left == left:
+                break
+
+        start = self._read_pos
+        end = len(out)
+        if size >= 0:
+            end = min(end, start + size)
+        ret = bytes(out[start:end])
+        self._read_pos = end
+        if end > HIST_LEN + _CHUNK_SIZE:
+            # discard output that's been read and is no longer
+            # needed as history
+            del out[:end - HIST_LEN]
+            self._read_pos = HIST_LEN
+        if self._left == 0 and self._read_pos == len(out):
+            self.eof = True
+        return ret
+
+    def _report_progress(self):
+        if not self.progress:
+            return
+        if self._left == 0:
+            if self._last_percent != 100:
+                sys.stderr.write("%s100%%\n" % self.progress)
+                self._last_percent = 100
+            return
+        percent = ((self.out_length - self._left) * 100
+               // self.out_length)
+        if percent != self._last_percent:
+            now = time.time()
+            if now - self._last_time >= 1:
+                sys.stderr.write("%s%3d%%\r" % (self.progress, percent))
+                self._last_percent = percent
+                self._last_time = now
+
+    def _decode(self, want):
+        """Decompress until want bytes are waiting to be read."""
+
+        src = self._in
+        if self._in_eof:
+            in_limit = len(src)
         else:
-            self.next_table[modpos] = hist_invalid
-            self.next2_table[modpos] = hist_invalid
-            key2 = b""
-            # key2 = src[pos2 : pos2 + 1]
-            suffix_table[key] = [1, pos, {key2: pos}, len(key2)]
-
-        p = pos - HIST_LEN
-        if p >= 0:
-            p2 = p + MIN_MATCH_LEN
-            key = src[p : p2]
-            a = suffix_table[key]
-            (count, head, table2, chars) = a
-            count -= 1
-            if count == 0:
-                assert head == p
-                del suffix_table[key]
+            # enough input to decode at least one more symbol
+            in_limit = len(src) - 16
+        if self._bitpos == None:
+            if in_limit < 0:
+                return
+            # Rather than the code value itself the difference
+            # between it and low is tracked, as it's unaffected by
+            # the quadrant adjustments made while renormalizing.
+            self._diff = (int.from_bytes(src[:4], "big")
+                      >> (32 - ARITH_BITS - 2))
+            self._bitpos = ARITH_BITS + 2
+        in_limit *= 8
+
+        from_bytes = int.from_bytes
+        low = self._low
+        high = self._high
+        diff = self._diff
+        bitpos = self._bitpos
+        symbol_to_char = self._symbol_to_char
+        sym_freq = self._sym_freq
+        sym_neg_freq = self._sym_neg_freq
+        tree = self._tree
+        total = self._total
+        position_cum = _position_cum
+        position_cum_rev = _position_cum_rev
+        max_position_cum = position_cum[0]
+        out = self._out
+        append = out.append
+        out_start = len(out)
+        # number of bytes to decompress
+        count = min(self._left, self._read_pos + want - out_start)
+
+        while count > 0 and bitpos <= in_limit:
+            _range = high - low
+            n = ((diff + 1) * total - 1) // _range
+            i = 0
+            rem = n
+            bit = _FENWICK_SIZE // 2
+            while bit:
+                a = tree[i + bit]
+                if a <= rem:
+                    i += bit
+                    rem -= a
+                bit >>= 1
+            symbol = MAX_CHAR - i
+            freq = sym_freq[symbol]
+            cum = n - rem
+            high = low + (cum + freq) * _range // total
+            a = cum * _range // total
+            low += a
+            diff -= a
+            shift = 0
+            while True:
+                if low >= QUADRANT2:
+                    low -= QUADRANT2
+                    high -= QUADRANT2
+                elif low >= QUADRANT1 and high <= QUADRANT3:
+                    low -= QUADRANT1
+                    high -= QUADRANT1
+                elif high > QUADRANT2:
+                    break
+                low *= 2
+                high *= 2
+                shift += 1
+            if shift:
+                a = from_bytes(src[bitpos >> 3 : (bitpos >> 3) + 8],
+                           "big")
+                diff = ((diff << shift)
+                    | (a >> (64 - (bitpos & 7) - shift)
+                       & ((1 << shift) - 1)))
+                bitpos += shift
+            char = symbol_to_char[symbol]
+
+            # update the model
+            if total >= MAX_CUM:
+                total = 0
+                for i in range(1, MAX_CHAR + 1):
+                    a = (sym_freq[i] + 1) // 2
+                    sym_freq[i] = a
+                    sym_neg_freq[i] = -a
+                    total += a
+                tree = _fenwick_build(sym_freq)
+                freq = sym_freq[symbol]
+            new_symbol = bisect_left(sym_neg_freq, -freq, 1, symbol)
+            if new_symbol != symbol:
+                symbol_to_char[symbol] = symbol_to_char[new_symbol]
+                symbol_to_char[new_symbol] = char
+            sym_freq[new_symbol] = freq + 1
+            sym_neg_freq[new_symbol] = -freq - 1
+            total += 1
+            i = MAX_CHAR + 1 - new_symbol
+            while i <= MAX_CHAR:
+                tree[i] += 1
+                i += i & -i
+
+            if char < 0x100:
+                append(char)
+                count -= 1
+                continue
+
+            _range = high - low
+            n = ((diff + 1) * max_position_cum - 1) // _range
+            pos = HIST_LEN - bisect_right(position_cum_rev, n)
+            high = low + position_cum[pos] * _range // max_position_cum
+            a = position_cum[pos + 1] * _range // max_position_cum
+            low += a
+            diff -= a
+            shift = 0
+            while True:
+                if low >= QUADRANT2:
+                    low -= QUADRANT2
+                    high -= QUADRANT2
+                elif low >= QUADRANT1 and high <= QUADRANT3:
+                    low -= QUADRANT1
+                    high -= QUADRANT1
+                elif high > QUADRANT2:
+                    break
+                low *= 2
+                high *= 2
+                shift += 1
+            if shift:
+                a = from_bytes(src[bitpos >> 3 : (bitpos >> 3) + 8],
+                           "big")
+                diff = ((diff << shift)
+                    | (a >> (64 - (bitpos & 7) - shift)
+                       & ((1 << shift) - 1)))
+                bitpos += shift
+
+            length = char - 0x100 + MIN_MATCH_LEN
+            start = len(out) - pos - 1
+            if pos + 1 >= length:
+                out += out[start : start + length]
             else:
-                key2 = src[p2 : p2 + chars]
-                if table2[key2] == p:
-                    del table2[key2]
-                a[0] = count
-        assert (mpos == None
-            or src[pos : pos + mlen] == src[mpos : mpos + mlen])
-        return (mpos, mlen)
-
-    def _add_suffix(self, pos, find):
-        r = self.add_suffix_2(pos, find)
-        start_pos = self.start_pos
-        if find and r[0] != None:
-            print ("%4d %02x %4d %2d"
-                   % (pos - start_pos, ord(self.src[pos]),
-                  r[0] - start_pos, r[1]))
-        else:
-            print ("%4d %02x"
-                       % (pos - start_pos, ord(self.src[pos])))
-        return r
-    
-    add_suffix = add_suffix_2
-    
-    def output_bit(self, bit):
-        self.append_bit(bit)
-        bit ^= 1
-        for i in range(self.shifts):
-            self.append_bit(bit)
-        self.shifts = 0
-        
-    def encode_char(self, char):
-        low = self.low
-        high = self.high
-        sym_cum = self.sym_cum
-        
-        symbol = self.char_to_symbol[char]
-        range = high - low
+                # overlapping match
+                for i in range(start, start + length):
+                    append(out[i])
+            count -= length
+
+        left = self._left - (len(out) - out_start)
+        if left < 0:
+            # a corrupt final match went past the end
+            del out[left:]
+            left = 0
+        self._tree = tree
+        self._total = total
+        self._low = low
+        self._high = high
+        self._diff = diff
+        self._bitpos = bitpos
+        self._left = left
+
+class lzari_codec(object):
+    # despite the name this does not implement a codec compatible
+    # with Python's codec system
     
-        high = low + range * sym_cum[symbol - 1] // sym_cum[0]
-        low += range * sym_cum[symbol] // sym_cum[0]
-        debug(high, "high");
-        debug(low, "low");
-        while True:
-            if high <= QUADRANT2:
-                self.output_bit(0)
-            elif low >= QUADRANT2:
-                self.output_bit(1)
-                low -= QUADRANT2
-                high -= QUADRANT2
-            elif low >= QUADRANT1 and high <= QUADRANT3:
-                self.shifts += 1
-                low -= QUADRANT1
-                high -= QUADRANT1
-            else:
-                break
-            low *= 2
-            high *= 2
-        self.low = low
-        self.high = high
-        self.update_model_encode(symbol)
-
-    def encode_position(self, position):
-        position_cum = self.position_cum
-        low = self.low
-        high = self.high
-
-        range = high - low
-        high = low + range * position_cum[position] // position_cum[0]
-        low += range * position_cum[position + 1] // position_cum[0]
-
-        debug(high, "high");
-        debug(low, "low");
-        while True:
-            if high <= QUADRANT2:
-                self.output_bit(0)
-            elif low >= QUADRANT2:
-                self.output_bit(1)
-                low -= QUADRANT2
-                high -= QUADRANT2
-            elif low >= QUADRANT1 and high <= QUADRANT3:
-                self.shifts += 1
-                low -= QUADRANT1
-                high -= QUADRANT1
-            else:
-                break
-            low *= 2
-            high *= 2
-            
-        self.low = low
-        self.high = high
-            
     def encode(self, src, progress = None):
         """Compress a string."""
-        
-        length = len(src)
-        if length == 0:
-            return b""
-
-        out_array = array.array('B')
-        self.out_array = out_array
-        self.append_bit = out_array.append
-        
-        self.init(False)
 
-        max_match = min(MAX_MATCH_LEN, length)
-        self.max_match = max_match
-        self.src = src = b"\x20" * max_match + src
-            
-        in_length = len(src)
-        
-        self.start_pos = max_match
-        
-        for in_pos in range(max_match):
-            self.add_suffix(in_pos, False)
-        in_pos += 1
-        last_percent = -1
-        while in_pos < in_length:
-            if progress:
-                percent = (in_pos - max_match) * 100 // length
-                if percent != last_percent:
-                    sys.stderr.write("%s%3d%%\r"
-                             % (progress, percent))
-                    last_percent = percent
-            debug(src[in_pos], "src")
-            (match_pos, match_len) = self.add_suffix(in_pos, True)
-            if match_len < MIN_MATCH_LEN:
-                self.encode_char(src[in_pos])
-            else:
-                debug(in_pos - match_pos - 1, "match_pos")
-                debug(match_len, "match_len")
-                self.encode_char(256 - MIN_MATCH_LEN + match_len)
-                self.encode_position(in_pos - match_pos - 1)
-                for i in range(match_len - 1):
-                    in_pos += 1
-                    self.add_suffix(in_pos, False)
-            in_pos += 1
-                
-        self.shifts += 1
-        if self.low < QUADRANT1:
-            self.output_bit(0)
-        else:
-            self.output_bit(1)
+        encoder = LzariEncoder(len(src), progress)
+        out = [encoder.write(memoryview(src)[i : i + _CHUNK_SIZE])
+               for i in range(0, len(src), _CHUNK_SIZE)]
+        out.append(encoder.finish())
+        return b"".join(out)
 
-        #for k, v in sorted(self.suffix_table.items()):
-        #    count, head, table2, chars = v
-        #    print hexlify(k), count, head, len(table2), chars
-            
-        if progress:
-            sys.stderr.write("%s100%%\n" % progress)
-        
-        return bit_array_to_string(out_array)
-        
     def decode(self, src, out_length, progress = None):
         """Decompress a string."""
-        
-        a = string_to_bit_array(src)
-        a.fromlist([0] * 32)     # add some extra bits 
-        self.in_iter = iter(a).__next__
-
-        out = array.array('B', b"\0") * out_length
-        outpos = 0
-        
-        self.init(True)
-
-        self.code = 0
-        for i in range(ARITH_BITS + 2):
-            self.code += self.code + self.in_iter()
-
-        hist_pos = HIST_LEN - MAX_MATCH_LEN
-        history = [0x20] * hist_pos + [0] * MAX_MATCH_LEN
-
-        decode_char = self.decode_char
-        last_percent = -1
-        last_time = time.time()
-        while outpos < out_length:
-            if progress:
-                percent = outpos * 100 // out_length
-                if percent != last_percent:
-                    now = time.time()
-                    if now - last_time >= 1:
-                        sys.stderr.write("%s%3d%%\r"
-                            % (progress, percent))
-                        last_percent = percent
-                        last_time = now
-            char = decode_char()
-            if char >= 0x100:
-                pos = self.decode_position()
-                length = char - 0x100 + MIN_MATCH_LEN
-                base = (hist_pos - pos - 1) % HIST_LEN
-                for off in range(length):
-                    a = history[(base + off) % HIST_LEN]
-                    out[outpos] = a
-                    outpos += 1
-                    history[hist_pos] = a
-                    hist_pos = (hist_pos + 1) % HIST_LEN
-            else:
-                out[outpos] = char
-                outpos += 1
-                history[hist_pos] = char
-                hist_pos = (hist_pos + 1) % HIST_LEN
-        
-        self.in_iter = None
-        if progress:
-            sys.stderr.write("%s100%%\n" % progress)
-        return out.tobytes()
 
-if mymcsup == None:
+        decoder = LzariDecoder(out_length, progress)
+        decoder.feed(src)
+        decoder.feed_eof()
+        return decoder.read()
+
+# The compiled extension is used for whole strings when it was built,
+# the streaming classes above are always pure Python.
+if _lzari == None:
+    backend = "python"
+
     def decode(src, out_length, progress = None):
         return lzari_codec().decode(src, out_length, progress)
     
     def encode(src, progress = None):
         return lzari_codec().encode(src, progress)
 else:
-    mylzari_decode = mymcsup.mylzari_decode
-    mylzari_encode = mymcsup.mylzari_encode
-    mylzari_free_encoded = mymcsup.mylzari_free_encoded
-    
+    backend = "c"
+
     def decode(src, out_length, progress = None):
-        out = ctypes.create_string_buffer(out_length)
-        if (mylzari_decode(src, len(src), out, out_length, progress)
-            == -1):
-            raise ValueError("compressed input is corrupt")
-        return ctypes.string_at(out, out_length)
+        out = _lzari.decode(src, out_length)
+        if progress:
+            sys.stderr.write("%s100%%\n" % progress)
+        return out
 
     def encode(src, progress = None):
-        (r, compressed, comp_len) = mylzari_encode(src, len(src),
-                               progress)
-        # print r, compressed.value, comp_len
-        if r == -1:
-            raise MemoryError("out of memory during compression")
-        if compressed.value == None:
-            return b""
-        ret = ctypes.string_at(compressed.value, comp_len.value)
-        mylzari_free_encoded(compressed)
-        return ret;
-
-def main2(args):
-    import struct
-    import os
-    
-    src = open(args[2], "rb").read()
-    lzari = lzari_codec()
-    out = open(args[3], "wb")
-    start = os.times()
-    if args[1] == "c":
-        dest = lzari.encode(src)
-        now = os.times()
-        out.write(struct.pack("L", len(src)))
-    else:
-        dest = lzari.decode(src[4:],
-                    struct.unpack("L", src[:4])[0])
-        now = os.times()
-    out.write(dest)
-    out.close()
-    print("time:", now[0] - start[0], now[1] - start[1], now[4] - start[4])
-
-
-def _get_hotshot_lineinfo(filename):
-    import hotshot.log
-    log = hotshot.log.LogReader(filename)
-    timings = {}
-    for what, loc, tdelta in log:
-        if what == hotshot.log.LINE:
-            a = timings.get(loc)
-            if a == None:
-                timings[loc] = [1, tdelta]
-            else:
-                a[0] += 1
-                a[1] += tdelta
-    return list(timings.items())
-
-def _dump_hotshot_lineinfo(log):
-    a = sorted(_get_hotshot_lineinfo(log))
-    total_count = sum((time[0]
-               for (loc, time) in a))
-    total_time = sum((time[1]
-              for (loc, time) in a))
-    for (loc, [count, time]) in a:
-        print(("%8d %6.3f%%  %8d %6.3f%%"
-               % (time, time * 100.0 / total_time,
-              count, count * 100.0 / total_count)), end=' ')
-        print("%s:%d(%s)" % loc)
-
-def _dump_hotshot_lineinfo2(log):
-    cur = None
-    a = sorted(_get_hotshot_lineinfo(log))
-    total_count = sum((time[0]
-               for (loc, time) in a))
-    total_time = sum((time[1]
-              for (loc, time) in a))
-    for ((filename, lineno, fn), [count, time]) in a:
-        if cur != filename:
-            if cur != None and f != None:
-                for line in f:
-                    print(line[:-1])
-                f.close()
-            try:
-                f = open(filename, "r")
-            except OSError:
-                f = None
-            cur = filename
-            l = 0
-            print("#", filename)
-        if f != None:
-            while l < lineno:
-                print(f.readline()[:-1])
-                l += 1
-        print ("# %8d %6.3f%%  %8d %6.3f%%"
-               % (time, time * 100.0 / total_time,
-              count, count * 100.0 / total_count))
-    if cur != None and f != None:
-        for line in f:
-            print(line[:-1])
-        f.close()
-    
-def main(args):
-    import os
-    
-    if args[1] == "pc":
-        import profile
-        pr = profile.Profile()
-        for i in range(5):
-            print(pr.calibrate(100000))
-        return
-    elif args[1] == "p":
-        import profile
-        ret = 0
-        # profile.Profile.bias = 5.26e-6
-        profile.runctx("ret = main2(args[1:])",
-                   globals(), locals())
-        return ret
-    elif args[1].startswith("h"):
-        import hotshot, hotshot.stats
-        import warnings
-
-        warnings.filterwarnings("ignore")
-        tmp = os.tempnam()
-        try:
-            l = args[1].startswith("hl")
-            p = hotshot.Profile(tmp, l)
-            ret = p.runcall(main2, args[1:])
-            p.close()
-            p = None
-            if l:
-                if args[1] == "hl2":
-                    _dump_hotshot_lineinfo2(tmp)
-                else:
-                    _dump_hotshot_lineinfo(tmp)
-            else:
-                hotshot.stats.load(tmp).print_stats()
-        finally:
-            try:
-                os.remove(tmp)
-            except OSError:
-                pass
-        return ret
-            
-    return main2(args)
-
-if __name__ == '__main__':
-    sys.exit(main(sys.argv))
-    
+        out = _lzari.encode(src)
+        if progress:
+            sys.stderr.write("%s100%%\n" % progress)
+        return out
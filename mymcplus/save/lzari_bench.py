@@ -0,0 +1,193 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Benchmark the LZARI codec.
+
+Run as "python -m mymcplus.save.lzari_bench [savefile ...]" to report
+the speed, peak memory use and compression ratio for a few classes of
+input, plus the contents of any save files given."""
+
+import sys
+import os
+import json
+import time
+import random
+import optparse
+import tracemalloc
+
+from . import lzari
+from . import ps2save
+
+_words = (b"the memory card save game file data slot block cluster "
+      b"directory icon title system configuration player level "
+      b"stage score options a of to and in is it").split()
+
+def make_text(size, seed = 1):
+    """Return pseudo-random English-like text."""
+    rand = random.Random(seed)
+    words = []
+    n = 0
+    while n <= size:
+        word = rand.choice(_words)
+        words.append(word)
+        n += len(word) + 1
+    return b" ".join(words)[:size]
+
+def make_random(size, seed = 1):
+    rand = random.Random(seed)
+    return rand.getrandbits(size * 8).to_bytes(size, "little")
+
+def load_save_payload(filename):
+    """Return the contents of all the files in a save file."""
+    
+    sf = ps2save.PS2SaveFile()
+    f = open(filename, "rb")
+    try:
+        format = ps2save.poll_format(f)
+        f.seek(0)
+        if format is None:
+            raise ValueError(filename + ": save file format not recognized")
+        format.load(sf, f)
+    finally:
+        f.close()
+    return b"".join(sf.get_file(i)[1] for i in range(len(sf)))
+
+def make_inputs(size, savefiles = ()):
+    """Return a list of (name, data) tuples to benchmark."""
+
+    inputs = [("zeros", bytes(size)),
+          ("text", make_text(size)),
+          ("random", make_random(size))]
+    for filename in savefiles:
+        inputs.append((os.path.basename(filename),
+                   load_save_payload(filename)))
+    return inputs
+
+def get_codec(backend):
+    """Return the encode and decode functions of a backend."""
+    
+    if backend == "python":
+        codec = lzari.lzari_codec()
+        return (codec.encode, codec.decode)
+    if backend == "c":
+        if lzari._lzari == None:
+            raise ValueError("the LZARI extension isn't available")
+        return (lzari._lzari.encode, lzari._lzari.decode)
+    return (lzari.encode, lzari.decode)
+
+def _measure(fn, args, repeat, memory):
+    """Return the result, fastest time and peak traced memory."""
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        ret = fn(*args)
+        t = time.perf_counter() - start
+        if best == None or t < best:
+            best = t
+    if not memory:
+        return (ret, best, None)
+    # memory is traced separately so it doesn't affect the timings
+    tracemalloc.start()
+    try:
+        fn(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (ret, best, peak)
+
+def run(inputs, backend = None, repeat = 3, memory = True):
+    """Benchmark encoding and decoding each input.
+
+    Returns a list of dicts, one for each input.  Peak memory is what
+    tracemalloc sees, so it doesn't include memory allocated by the
+    compiled extension.  Tracing is slow, so it's done in an extra
+    run and can be turned off by setting memory to false."""
+
+    (encode, decode) = get_codec(backend)
+    results = []
+    for (name, data) in inputs:
+        (compressed, encode_time, encode_peak) = _measure(
+            encode, (data,), repeat, memory)
+        (out, decode_time, decode_peak) = _measure(
+            decode, (compressed, len(data)), repeat, memory)
+        if out != data:
+            raise ValueError(name + ": decoded data doesn't match")
+        mb = len(data) / 1e6
+        results.append({
+            "name": name,
+            "backend": backend or lzari.backend,
+            "size": len(data),
+            "compressed": len(compressed),
+            "ratio": len(compressed) / max(len(data), 1),
+            "encode_mbps": mb / max(encode_time, 1e-9),
+            "decode_mbps": mb / max(decode_time, 1e-9),
+            "encode_peak": encode_peak,
+            "decode_peak": decode_peak})
+    return results
+
+def write_results(out, results):
+    out.write("%-20s %7s %9s %9s %6s %10s %10s %10s %10s\n"
+          % ("input", "backend", "size", "compr", "ratio",
+             "enc MB/s", "dec MB/s", "enc peak", "dec peak"))
+    for r in results:
+        peaks = [r["encode_peak"], r["decode_peak"]]
+        peaks = ["-" if peak == None else str(peak) for peak in peaks]
+        out.write("%-20s %7s %9d %9d %6.3f %10.3f %10.3f %10s %10s\n"
+              % (r["name"][:20], r["backend"], r["size"],
+             r["compressed"], r["ratio"], r["encode_mbps"],
+             r["decode_mbps"], peaks[0], peaks[1]))
+
+def main(argv = sys.argv):
+    optparser = optparse.OptionParser(
+        prog = argv[0],
+        usage = "usage: %prog [options] [savefile ...]",
+        description = "Benchmark the LZARI codec on generated"
+        " data and the contents of any save files given.")
+    optparser.add_option("-b", "--backend", choices = ["python", "c"],
+                 help = 'Use the "python" or "c" codec'
+                 " instead of the default.")
+    optparser.add_option("-s", "--size", type = "int", default = 65536,
+                 help = "Size of the generated inputs."
+                 " [default: %default]")
+    optparser.add_option("-r", "--repeat", type = "int", default = 3,
+                 help = "Take the best of N runs."
+                 " [default: %default]", metavar = "N")
+    optparser.add_option("-M", "--no-memory", action = "store_false",
+                 dest = "memory", default = True,
+                 help = "Don't measure peak memory use, which"
+                 " is slow with the pure-Python codec.")
+    optparser.add_option("-j", "--json", action = "store_true",
+                 default = False,
+                 help = "Write the results as JSON.")
+    (opts, args) = optparser.parse_args(argv[1:])
+
+    try:
+        results = run(make_inputs(opts.size, args), opts.backend,
+                  max(opts.repeat, 1), opts.memory)
+    except (ValueError, EnvironmentError, ps2save.Error) as value:
+        sys.stderr.write(str(value) + "\n")
+        return 1
+    if opts.json:
+        json.dump(results, sys.stdout, indent = 1, sort_keys = True)
+        sys.stdout.write("\n")
+    else:
+        write_results(sys.stdout, results)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -52,6 +52,12 @@ class Corrupt(Error):
         self.filename = fn
         Error.__init__(self, "Corrupt save file: " + msg)
 
+    def __reduce__(self):
+        # Don't call __init__ again when unpickled, so the exception
+        # survives being passed back from a worker process.
+        return (self.__class__.__new__, (self.__class__,) + self.args,
+                self.__dict__)
+
 
 class Eof(Corrupt):
     """Save file is truncated."""
@@ -84,6 +90,8 @@ def format_for_filename(filename):
     filename = filename.lower()
     if filename.endswith(".max"):
         return format_max_drive
+    elif filename.endswith(".cbs"):
+        return format_codebreaker
     #elif filename.endswith(".psv"):
     #    return format_psv
     else:
@@ -172,11 +180,20 @@ class PS2SaveFile(object):
         return self.dirent
 
 
-    def get_file(self, i):
+    def load_deferred(self):
+        """Finish loading any file data whose decoding was deferred.
+
+        Afterwards the save file no longer refers to the file it
+        was loaded from and can be pickled."""
+
         if self._defer_load_max_file is not None:
             f = self._defer_load_max_file
             self._defer_load_max_file = None
             format_max_drive.load2(self, f)
+
+
+    def get_file(self, i):
+        self.load_deferred()
         return self.file_ents[i], self.file_data[i]
 
 
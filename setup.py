@@ -15,7 +15,7 @@
 # along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from setuptools import setup
+from setuptools import setup, Extension
 
 long_description = \
 """mymc+ is a PlayStation 2 memory card manager for to be used with .ps2 images as created by the PCSX2 emulator for example.
@@ -60,9 +60,16 @@ setup(
     ],
     keywords="playstation ps2 mymc memory card save emulator",
     packages=["mymcplus", "mymcplus.gui", "mymcplus.save"],
+    # The LZARI extension only speeds things up, if it can't be
+    # built the pure-Python implementation is used instead.
+    ext_modules=[
+        Extension("mymcplus.save._lzari", ["mymcplus/save/_lzari.c"],
+                  optional=True)
+    ],
     entry_points={
         "console_scripts": [
-            "mymcplus = mymcplus.mymc:main"
+            "mymcplus = mymcplus.mymc:main",
+            "mymcplus-batch = mymcplus.batch:main"
         ]
     },
     python_requires=">=3.4",
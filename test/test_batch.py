@@ -0,0 +1,94 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+
+from mymcplus import batch
+
+
+def read_results(output):
+    results = [json.loads(line) for line in output.splitlines()]
+    return {r["card"]: r for r in results}
+
+
+def test_batch_check(capsys, data):
+    pattern = data.join("mc0*.ps2").strpath
+
+    ret = batch.main(["mymcplus-batch", "-j", "2", "check", pattern])
+
+    output = capsys.readouterr()
+    results = read_results(output.out)
+    assert ret == 0
+    assert sorted(results) == [data.join("mc01.ps2").strpath,
+                               data.join("mc02.ps2").strpath]
+    for r in results.values():
+        assert r["command"] == "check"
+        assert r["returncode"] == 0
+        assert r["stdout"] == "No errors found.\n"
+        assert r["stderr"] == ""
+        assert r["seconds"] >= 0
+
+
+def test_batch_errors(capsys, data):
+    mc_file = data.join("mc01.ps2").strpath
+    missing = data.join("missing.ps2").strpath
+
+    ret = batch.main(["mymcplus-batch", "-j", "1",
+                      "df", mc_file, missing])
+
+    results = read_results(capsys.readouterr().out)
+    assert ret == 1
+    assert results[mc_file]["stdout"] == mc_file + ": 8268800 bytes free.\n"
+    assert results[missing]["returncode"] == 1
+    assert results[missing]["stderr"] == (missing
+                                          + ": No such file or directory\n")
+
+
+def test_batch_export(capsys, data, tmpdir):
+    mc_file = data.join("mc01.ps2").strpath
+    tmpdir.mkdir("mc01")
+
+    ret = batch.main(["mymcplus-batch", "-j", "1", "export", mc_file,
+                      "--", "-d", tmpdir.join("{card}").strpath,
+                      "BEDATA-SYSTEM"])
+
+    result = read_results(capsys.readouterr().out)[mc_file]
+    assert ret == 0
+    assert result["stdout"] == "Exporing BEDATA-SYSTEM to BEDATA-SYSTEM.psu\n"
+    assert tmpdir.join("mc01", "BEDATA-SYSTEM.psu").check()
+
+
+def test_batch_export_relative(capsys, monkeypatch, data, tmpdir):
+    import shutil
+
+    tmpdir.mkdir("cards")
+    for card in ["a", "b"]:
+        shutil.copy(data.join("mc01.ps2").strpath,
+                    tmpdir.join("cards", card + ".ps2").strpath)
+        tmpdir.mkdir(card)
+    monkeypatch.chdir(tmpdir)
+
+    ret = batch.main(["mymcplus-batch", "-j", "1", "export",
+                      "cards/a.ps2", "cards/b.ps2",
+                      "--", "-d", "{card}", "BEDATA-SYSTEM"])
+
+    results = read_results(capsys.readouterr().out)
+    assert ret == 0
+    assert os.getcwd() == tmpdir.strpath
+    for card in ["a", "b"]:
+        assert results["cards/%s.ps2" % card]["returncode"] == 0
+        assert tmpdir.join(card, "BEDATA-SYSTEM.psu").check()
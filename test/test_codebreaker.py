@@ -0,0 +1,114 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import io
+import random
+import struct
+import zlib
+
+import pytest
+
+from mymcplus import ps2mc_dir
+from mymcplus.save import format_codebreaker, format_ems, ps2save
+
+
+def rc4_reference(s, t):
+    s = list(s)
+    t = bytearray(t)
+    j = 0
+    for ii in range(len(t)):
+        i = (ii + 1) % 256
+        j = (j + s[i]) % 256
+        (s[i], s[j]) = (s[j], s[i])
+        t[ii] ^= s[(s[i] + s[j]) % 256]
+    return bytes(t)
+
+
+def make_cbs(files, dlen = None):
+    tod = ps2mc_dir.pack_tod(ps2mc_dir.tod_now())
+    body = b""
+    for (name, data) in files:
+        body += struct.pack("<8s8sLHHLL32s", tod, tod, len(data),
+                    0x8497, 0, 0, 0, name) + data
+    if dlen == None:
+        dlen = len(body)
+    body = rc4_reference(format_codebreaker.PS2SAVE_CBS_RC4S,
+                 zlib.compress(body))
+    hlen = 92 + 32
+    return (b"CFU\0" + struct.pack("<LL", 0x1f40, hlen)
+        + struct.pack("<LL32s8s8sLLLLLL32s", dlen, len(body) + hlen,
+                  b"BESCES-00000TEST", tod, tod, 0, 0, 0x8427,
+                  0, 0, 0, b"Test")
+        + body)
+
+
+@pytest.mark.parametrize("length", [0, 1, 255, 65535, 65536, 65537, 150000])
+def test_rc4(length):
+    rng = random.Random(length)
+    t = bytes(rng.getrandbits(8) for i in range(length))
+    s = format_codebreaker.PS2SAVE_CBS_RC4S
+    assert format_codebreaker._rc4_crypt(s, t) == rc4_reference(s, t)
+    s = list(range(256))
+    rng.shuffle(s)
+    assert format_codebreaker._rc4_crypt(s, t) == rc4_reference(s, t)
+
+
+def test_load_many_files():
+    rng = random.Random(0)
+    files = []
+    for i in range(200):
+        data = bytes(rng.getrandbits(8) for j in range(rng.randrange(600)))
+        files.append((b"file%d" % i, data + b"x" * rng.randrange(1000)))
+    save = ps2save.PS2SaveFile()
+    format_codebreaker.load(save, io.BytesIO(make_cbs(files)))
+    assert save.get_directory()[2] == len(files)
+    for (i, (name, data)) in enumerate(files):
+        (ent, loaded) = save.get_file(i)
+        assert ent[8] == name
+        assert loaded == data
+
+
+def test_load_truncated():
+    f = io.BytesIO(make_cbs([(b"a", b"abc" * 1000)])[:-10])
+    with pytest.raises(ps2save.Eof):
+        format_codebreaker.load(ps2save.PS2SaveFile(), f)
+    f = io.BytesIO(make_cbs([(b"a", b"abc" * 1000)], dlen = 100))
+    with pytest.raises(ps2save.Eof):
+        format_codebreaker.load(ps2save.PS2SaveFile(), f)
+
+
+@pytest.mark.parametrize("level", [0, 1, 9])
+def test_save(data, level):
+    sf = ps2save.PS2SaveFile()
+    with open(data.join("BESCES-50501REZ.psu").strpath, "rb") as f:
+        format_ems.load(sf, f)
+    out = io.BytesIO()
+    format_codebreaker.save(sf, out, level)
+
+    out.seek(0)
+    assert ps2save.poll_format(out) == format_codebreaker
+    out.seek(0)
+    loaded = ps2save.PS2SaveFile()
+    format_codebreaker.load(loaded, out)
+    assert loaded.get_icon_sys().get_title("ascii") == ("Rez", "")
+    assert len(loaded) == len(sf)
+    for i in range(len(sf)):
+        (ent, data) = sf.get_file(i)
+        (loaded_ent, loaded_data) = loaded.get_file(i)
+        assert loaded_data == data
+        assert ([loaded_ent[j] for j in (0, 2, 3, 6, 8)]
+            == [ent[j] for j in (0, 2, 3, 6, 8)])
@@ -93,3 +93,44 @@ def test_ecc_check_fail():
     res = ps2mc_ecc.ecc_check(s, ecc)
 
     assert res == ps2mc_ecc.ECC_CHECK_FAILED
+
+
+def _page():
+    return bytes(_data) * 4
+
+
+def test_ecc_calculate_pages():
+    data = _page() + bytes(512) + _page()[::-1]
+    ecc = b"".join(bytes(code)
+                   for i in range(0, len(data), 512)
+                   for code in ps2mc_ecc.ecc_calculate_page(data[i : i + 512]))
+    assert ps2mc_ecc.ecc_calculate_pages(data, 512) == ecc
+    assert ps2mc_ecc.ecc_calculate_pages(data[:512], 512) == bytes(_ecc) * 4
+
+
+def test_ecc_check_pages_ok():
+    data = _page() * 3
+    raw = ps2mc_ecc.ecc_encode_pages(data, 512, 16)
+    assert len(raw) == 3 * 528
+    assert raw[512 : 528] == bytes(_ecc) * 4 + b"\0" * 4
+
+    res, checked, failed = ps2mc_ecc.ecc_check_pages(raw, 512, 16)
+    assert res == ps2mc_ecc.ECC_CHECK_OK
+    assert checked == data
+    assert failed == []
+
+
+def test_ecc_check_pages_correct_and_fail():
+    data = _page() * 3
+    raw = bytearray(ps2mc_ecc.ecc_encode_pages(data, 512, 16))
+    raw[528 + 42] ^= 1
+
+    res, checked, failed = ps2mc_ecc.ecc_check_pages(bytes(raw), 512, 16)
+    assert res == ps2mc_ecc.ECC_CHECK_CORRECTED
+    assert checked == data
+    assert failed == []
+
+    raw[2 * 528 + 42] ^= 3
+    res, checked, failed = ps2mc_ecc.ecc_check_pages(bytes(raw), 512, 16)
+    assert res == ps2mc_ecc.ECC_CHECK_FAILED
+    assert failed == [2]
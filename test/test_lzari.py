@@ -16,8 +16,20 @@
 #
 
 import array
+import hashlib
+import random
+
+import pytest
+
 from mymcplus.save import lzari
 
+try:
+    from mymcplus.save import _lzari
+except ImportError:
+    _lzari = None
+
+native = pytest.mark.skipif(_lzari is None, reason="LZARI extension not built")
+
 
 def bits_to_str(bits):
     return "".join([{0: "0", 1: "1"}[b] for b in bits])
@@ -65,3 +77,186 @@ def test_encode_save():
     compressed = lzari.encode(data)
     assert len(compressed) == 3964
     assert compressed == compressed_correct
+
+
+def test_decode_save():
+    from data_lzari import max_data_raw as data
+    from data_lzari import max_data_compressed as compressed
+    assert lzari.decode(compressed, len(data)) == data
+
+
+def test_decode_overlapping_match():
+    s = b"ab" * 100 + b"a" * 300 + b"xyz"
+    assert lzari.decode(lzari.encode(s), len(s)) == s
+
+
+def test_decode_random():
+    rand = random.Random(19)
+    s = bytes(rand.getrandbits(8) for i in range(5000))
+    s += bytes(rand.choice(b"ab ") for i in range(5000))
+    assert lzari.decode(lzari.encode(s), len(s)) == s
+
+
+def encode_cases():
+    rand = random.Random(20)
+    yield "ab", bytes(rand.choice(b"ab") for i in range(20000))
+    yield "text", bytes(rand.choice(b"the quick brown fox ") for i in range(20000))
+    yield "random", bytes(rand.getrandbits(8) for i in range(8000))
+    yield "zeros", bytes(10000)
+    yield "short", b"ab"
+    yield "short2", b"aaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
+    yield "runs", b"".join(bytes([rand.getrandbits(8)]) * rand.randrange(1, 200)
+                           for i in range(300))
+
+
+# MD5 hashes of the output of the original encoder
+encode_md5 = {
+    "ab": "f98304b1413133af04183b224e3363fd",
+    "text": "2eed633c60823bbc5709f3a6e2bd51d9",
+    "random": "acb26bd4b0f8f2fe17063ee929c372fd",
+    "zeros": "a0b80d27593d4a06326c9907f36f0b0e",
+    "short": "52f8fe0365247df71495e21384a224d4",
+    "short2": "0856b5bf91f424759bbc8293e2823d8a",
+    "runs": "552fc7001c2a8a5bf9410e57cfc38782",
+}
+
+
+@pytest.mark.parametrize("name,s", list(encode_cases()))
+def test_encode_compatible(name, s):
+    compressed = lzari.encode(s)
+    assert hashlib.md5(compressed).hexdigest() == encode_md5[name]
+    assert lzari.decode(compressed, len(s)) == s
+
+
+def test_encoder_stream():
+    from data_lzari import max_data_raw as data
+    from data_lzari import max_data_compressed as compressed
+    rand = random.Random(21)
+    encoder = lzari.LzariEncoder()
+    out = []
+    pos = 0
+    while pos < len(data):
+        n = rand.choice([1, 2, 59, 60, 61, 1000, 10000])
+        out.append(encoder.write(data[pos:pos + n]))
+        pos += n
+    out.append(encoder.finish())
+    assert b"".join(out) == compressed
+
+
+def test_encoder_stream_short():
+    encoder = lzari.LzariEncoder()
+    assert encoder.write(b"You'll never ") == b""
+    assert encoder.write(b"see it coming.") == b""
+    assert encoder.finish() == lzari.encode(b"You'll never see it coming.")
+    assert lzari.LzariEncoder().finish() == b""
+
+
+def test_decoder_stream():
+    from data_lzari import max_data_raw as data
+    from data_lzari import max_data_compressed as compressed
+    rand = random.Random(22)
+    decoder = lzari.LzariDecoder(len(data))
+    out = []
+    pos = 0
+    while pos < len(compressed):
+        n = rand.choice([1, 3, 16, 17, 500])
+        decoder.feed(compressed[pos:pos + n])
+        pos += n
+        out.append(decoder.read(rand.choice([-1, 0, 1, 100, 5000])))
+    decoder.feed_eof()
+    assert not decoder.eof
+    out.append(decoder.read())
+    assert decoder.eof
+    assert b"".join(out) == data
+    assert decoder.read() == b""
+
+
+def test_backend():
+    assert lzari.backend == ("python" if _lzari is None else "c")
+
+
+@pytest.mark.parametrize("name,s", list(encode_cases()))
+def test_python_compatible(name, s):
+    compressed = lzari.lzari_codec().encode(s)
+    assert hashlib.md5(compressed).hexdigest() == encode_md5[name]
+    assert lzari.lzari_codec().decode(compressed, len(s)) == s
+
+
+@native
+def test_native_save():
+    from data_lzari import max_data_raw as data
+    from data_lzari import max_data_compressed as compressed
+    assert _lzari.encode(data) == compressed
+    assert _lzari.decode(compressed, len(data)) == data
+
+
+@native
+def test_native_parity():
+    rand = random.Random(22)
+    for i in range(100):
+        alphabet = rand.choice([b"a", b"ab", b"abc ", bytes(range(256))])
+        s = bytes(rand.choice(alphabet) for j in range(rand.randrange(200)))
+        s *= rand.randrange(1, 30)
+        compressed = lzari.lzari_codec().encode(s)
+        assert _lzari.encode(s) == compressed
+        assert _lzari.decode(compressed, len(s)) == s
+
+
+def native_decode(s, out_length):
+    try:
+        return _lzari.decode(s, out_length)
+    except ValueError:
+        return None
+
+
+def python_decode(s, out_length):
+    out = lzari.lzari_codec().decode(s, out_length)
+    if len(out) < out_length:
+        # the input ran out
+        return None
+    return out
+
+
+@native
+def test_native_corrupt():
+    # garbage input shouldn't crash, and should fail the same way
+    # with both decoders
+    rand = random.Random(23)
+    for i in range(100):
+        s = bytes(rand.getrandbits(8) for j in range(rand.randrange(100)))
+        assert native_decode(s, 1000) == python_decode(s, 1000)
+
+
+@native
+def test_native_truncated():
+    s = bytes(range(256)) * 4 + bytes(random.Random(5).getrandbits(8)
+                                      for i in range(2000))
+    encoded = _lzari.encode(s)
+    assert native_decode(encoded, len(s)) == s
+    failed = 0
+    for n in range(0, len(encoded), 37):
+        out = native_decode(encoded[:n], len(s))
+        assert out == python_decode(encoded[:n], len(s))
+        if out == None:
+            failed += 1
+    assert failed > 0
+
+
+@pytest.mark.parametrize("backend", ["python",
+                                     pytest.param("c", marks = native)])
+def test_max_drive_truncated(monkeypatch, data, backend):
+    import io
+    import struct
+    from mymcplus.save import format_max_drive, ps2save
+
+    monkeypatch.setattr(lzari, "backend", backend)
+    with open(data.join("BESCES-50501REZ.max").strpath, "rb") as f:
+        s = bytearray(f.read())
+    # some saves have the uncompressed length in place of the
+    # compressed length, so the body is read to the end of the file
+    struct.pack_into("<L", s, 0x50, struct.unpack_from("<L", s, 0x58)[0])
+    f = io.BytesIO(bytes(s[:-1000]))
+    sf = ps2save.PS2SaveFile()
+    format_max_drive.load(sf, f)
+    with pytest.raises(ps2save.Eof):
+        format_max_drive.load2(sf, f)
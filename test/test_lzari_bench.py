@@ -0,0 +1,120 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+
+import pytest
+
+from mymcplus.save import lzari, lzari_bench
+
+
+# Speeds in MB/s (encode, decode) measured for the 16 KiB inputs
+# below with Python 3.11 on an x86-64 Linux machine.  They depend on
+# the machine and anything slowing down the interpreter, like a
+# tracer, so they're only checked when MYMC_BENCH_BASELINE is set
+# in the environment.  A result more than speed_margin times slower
+# fails.
+baseline_speed = {
+    "python": {
+        "zeros": (0.94, 5.9),
+        "text": (0.37, 0.84),
+        "random": (0.083, 0.14),
+        "BESCES-50501REZ.psu": (0.94, 2.3),
+    },
+    "c": {
+        "zeros": (16.0, 175.0),
+        "text": (10.6, 16.2),
+        "random": (4.0, 3.4),
+        "BESCES-50501REZ.psu": (21.0, 54.0),
+    },
+}
+
+speed_margin = 3
+
+# How much faster than the pure-Python codec the compiled one must be
+# in the same run.  It's measured at 17 to 50 times faster.
+min_speedup = 5
+
+max_ratio = {
+    "zeros": 0.03,
+    "text": 0.25,
+    "random": 1.01,
+    "BESCES-50501REZ.psu": 0.08,
+}
+
+native = pytest.mark.skipif(lzari.backend != "c",
+                            reason = "LZARI extension not built")
+
+
+@pytest.fixture(scope = "module")
+def benchmark(data):
+    """Return a function that benchmarks a backend, running it only
+    once for the module."""
+
+    psu_file = data.join("BESCES-50501REZ.psu").strpath
+    inputs = lzari_bench.make_inputs(16384, [psu_file])
+    results = {}
+
+    def run(backend):
+        if backend not in results:
+            results[backend] = lzari_bench.run(inputs, backend,
+                                               repeat = 3,
+                                               memory = False)
+        return results[backend]
+    return run
+
+
+@pytest.mark.parametrize("backend", ["python",
+                                     pytest.param("c", marks = native)])
+def test_benchmark(benchmark, backend):
+    results = benchmark(backend)
+
+    assert [r["name"] for r in results] == list(max_ratio.keys())
+    for r in results:
+        assert r["backend"] == backend
+        assert r["ratio"] <= max_ratio[r["name"]]
+
+
+@pytest.mark.skipif(not os.environ.get("MYMC_BENCH_BASELINE"),
+                    reason = "MYMC_BENCH_BASELINE not set")
+@pytest.mark.parametrize("backend", ["python",
+                                     pytest.param("c", marks = native)])
+def test_benchmark_baseline(benchmark, backend):
+    for r in benchmark(backend):
+        (encode, decode) = baseline_speed[backend][r["name"]]
+        assert r["encode_mbps"] >= encode / speed_margin, r["name"]
+        assert r["decode_mbps"] >= decode / speed_margin, r["name"]
+
+
+@native
+def test_native_speedup(benchmark):
+    for (p, c) in zip(benchmark("python"), benchmark("c")):
+        assert p["name"] == c["name"]
+        assert c["encode_mbps"] >= p["encode_mbps"] * min_speedup, p["name"]
+        assert c["decode_mbps"] >= p["decode_mbps"] * min_speedup, p["name"]
+
+
+def test_benchmark_cli(capsys):
+    ret = lzari_bench.main(["lzari_bench", "-r", "1", "-s", "1000", "-j",
+                            "-b", "python"])
+
+    assert ret == 0
+    results = json.loads(capsys.readouterr().out)
+    assert [r["size"] for r in results] == [1000, 1000, 1000]
+    for r in results:
+        assert r["encode_peak"] > 0
+        assert r["decode_peak"] >= 1000
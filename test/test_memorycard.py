@@ -15,7 +15,9 @@
 # along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from mymcplus import mymc
+import pytest
+
+from mymcplus import mymc, ps2mc_dir
 
 
 def md5(fn):
@@ -286,6 +288,37 @@ def test_export_max(capsys, data, tmpdir):
     assert md5(tmpdir.join("BESCES-50501REZ.max").strpath) == "3f63d38668a0a5a5fa508ab8c3bb469a"
 
 
+def test_export_cbs(capsys, data, tmpdir):
+    mc_file = data.join("mc01.ps2").strpath
+
+    mymc.main(["mymcplus",
+               "-i", mc_file,
+               "export", "-d", tmpdir.strpath, "-c", "BESCES-50501REZ"])
+
+    output = capsys.readouterr()
+    assert output.out == "Exporing BESCES-50501REZ to BESCES-50501REZ.cbs\n"
+
+    assert md5(tmpdir.join("BESCES-50501REZ.cbs").strpath) == "622ebaad7bd267837874a958b7985bd6"
+
+
+def test_export_parallel(capsys, data, tmpdir):
+    mc_file = data.join("mc01.ps2").strpath
+
+    ret = mymc.main(["mymcplus",
+                     "-i", mc_file,
+                     "export", "-d", tmpdir.strpath, "-m", "-j", "2",
+                     "BEDATA-SYSTEM", "BESCES-50501REZ"])
+
+    output = capsys.readouterr()
+    assert ret == 0
+    assert output.out == ("Exporing BEDATA-SYSTEM to BEDATA-SYSTEM.max\n"
+                          "Exporing BESCES-50501REZ to BESCES-50501REZ.max\n")
+    assert output.err == ""
+
+    assert md5(tmpdir.join("BESCES-50501REZ.max").strpath) == "3f63d38668a0a5a5fa508ab8c3bb469a"
+    assert tmpdir.join("BEDATA-SYSTEM.max").check()
+
+
 def test_import_psu(monkeypatch, capsys, data, mc02_copy):
     from mymcplus import ps2mc
     patch_fixed_time(monkeypatch, ps2mc)
@@ -304,6 +337,27 @@ def test_import_psu(monkeypatch, capsys, data, mc02_copy):
     assert md5(mc_file) == "4085992c23fc38d6c4ece5303dc77e74"
 
 
+def test_import_parallel(monkeypatch, capsys, data, mc02_copy):
+    from mymcplus import ps2mc
+    patch_fixed_time(monkeypatch, ps2mc)
+
+    mc_file = mc02_copy.join("mc02.ps2").strpath
+    psu_file = data.join("BESCES-50501REZ.psu").strpath
+    cbs_file = data.join("BESCES-50501REZ.cbs").strpath
+
+    ret = mymc.main(["mymcplus",
+                     "-i", mc_file,
+                     "import", "-j", "2", "-i", psu_file, cbs_file])
+
+    output = capsys.readouterr()
+    assert ret == 0
+    assert output.out == ("[1/2] Importing " + psu_file + " to BESCES-50501REZ\n"
+                          "[2/2] Importing " + cbs_file + " to BESCES-50501REZ\n"
+                          + cbs_file + ": already in memory card image, ignored.\n")
+
+    assert md5(mc_file) == "4085992c23fc38d6c4ece5303dc77e74"
+
+
 def test_import_max(monkeypatch, capsys, data, mc02_copy):
     from mymcplus import ps2mc
     from mymcplus import ps2mc_dir
@@ -421,3 +475,541 @@ def test_import_psv_ps1(monkeypatch, capsys, data, mc02_copy):
     assert output.err == ""
 
     assert md5(mc_file) == "c9f26130a5de7548248a5fec80593a4d"
+
+
+def test_dir_mmap(capsys, data):
+    mc_file = data.join("mc01.ps2").strpath
+
+    mymc.main(["mymcplus",
+               "-i", "--mmap", mc_file,
+               "dir", "-a"])
+
+    output = capsys.readouterr()
+    assert output.out == ("BEDATA-SYSTEM                    Your System\n"
+                          "   5KB Not Protected             Configuration\n"
+                          "\n"
+                          "BESCES-50501REZ                  Rez\n"
+                          "  53KB Not Protected             \n"
+                          "\n"
+                          "8,075 KB Free\n")
+    assert output.err == ""
+
+
+def test_import_psu_mmap(monkeypatch, capsys, data, mc02_copy):
+    from mymcplus import ps2mc
+    patch_fixed_time(monkeypatch, ps2mc)
+
+    mc_file = mc02_copy.join("mc02.ps2").strpath
+    psu_file = data.join("BESCES-50501REZ.psu").strpath
+
+    mymc.main(["mymcplus",
+               "--mmap", mc_file,
+               "import", psu_file])
+
+    output = capsys.readouterr()
+    assert output.out == "Importing " + psu_file + " to BESCES-50501REZ\n"
+    assert output.err == ""
+
+    assert md5(mc_file) == "4085992c23fc38d6c4ece5303dc77e74"
+
+
+def test_read_clusters(data):
+    import hashlib
+    from mymcplus import ps2mc
+
+    with open(data.join("mc01.ps2").strpath, "rb") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            start = mc.allocatable_cluster_offset
+            buf = mc.read_clusters(start, 8)
+            assert buf == b"".join(mc.read_cluster(start + i) for i in range(8))
+            assert mc.read_allocatable_clusters(0, 8) == buf
+
+            f2 = mc.open("BESCES-50501REZ/BESCES-50501REZ", "rb")
+            try:
+                f2.seek(100)
+                s = f2.read()
+                f2.seek(0)
+                s = f2.read(100) + s
+            finally:
+                f2.close()
+            assert hashlib.md5(s).hexdigest() == "5388344a2d4bb429b9a18ff683a8a691"
+        finally:
+            mc.close()
+
+
+def test_fat_in_memory(mc01_copy):
+    from mymcplus import ps2mc
+
+    with open(mc01_copy.join("mc01.ps2").strpath, "r+b") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            free = mc.get_free_space()
+            fat = [mc.lookup_fat(i) for i in range(mc.allocatable_cluster_end)]
+            allocated = [mc.allocate_cluster() for i in range(3)]
+        finally:
+            mc.close()
+
+    with open(mc01_copy.join("mc01.ps2").strpath, "r+b") as f:
+        mc = ps2mc.ps2mc(f, fat_in_memory=True)
+        try:
+            assert mc.get_free_space() == free - 3 * mc.cluster_size
+            for n in allocated:
+                assert mc.lookup_fat(n) == ps2mc.PS2MC_FAT_CHAIN_END
+                mc.set_fat(n, fat[n])
+            assert mc.get_free_space() == free
+            assert [mc.allocate_cluster() for i in range(3)] == allocated
+            for n in allocated:
+                mc.set_fat(n, fat[n])
+        finally:
+            mc.close()
+
+    with open(mc01_copy.join("mc01.ps2").strpath, "rb") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            assert [mc.lookup_fat(i) for i in range(mc.allocatable_cluster_end)] == fat
+        finally:
+            mc.close()
+
+
+def test_fat_chain(mc01_copy):
+    import random
+    from mymcplus import ps2mc
+
+    with open(mc01_copy.join("mc01.ps2").strpath, "r+b") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            f2 = mc.open("BESCES-50501REZ/rez.ico", "rb")
+            first = f2.first_cluster
+            f2.close()
+
+            clusters = [first]
+            while True:
+                n = mc.lookup_fat(clusters[-1])
+                if n == ps2mc.PS2MC_FAT_CHAIN_END:
+                    break
+                clusters.append(n & ~ps2mc.PS2MC_FAT_ALLOCATED_BIT)
+
+            chain = mc.fat_chain(first)
+            assert chain is mc.fat_chain(first)
+            order = list(range(len(clusters) + 2))
+            random.Random(1).shuffle(order)
+            for i in order:
+                if i < len(clusters):
+                    assert chain[i] == clusters[i]
+                else:
+                    assert chain[i] == ps2mc.PS2MC_FAT_CHAIN_END
+            assert len(chain) == len(clusters)
+            assert sum(l for (s, l) in chain.extents()) == len(clusters)
+
+            assert mc.fat_chain_owners[clusters[-1]] == set([first])
+            mc.set_fat(clusters[2], ps2mc.PS2MC_FAT_CHAIN_END)
+            assert len(chain) == 3
+            assert clusters[3] not in mc.fat_chain_owners
+            assert chain[3] == ps2mc.PS2MC_FAT_CHAIN_END
+            mc.set_fat(clusters[2], clusters[3] | ps2mc.PS2MC_FAT_ALLOCATED_BIT)
+            assert len(chain) == len(clusters)
+            assert chain[len(clusters) - 1] == clusters[-1]
+        finally:
+            mc.close()
+
+
+def test_fat_chain_evicted(mc01_copy):
+    from mymcplus import ps2mc
+
+    with open(mc01_copy.join("mc01.ps2").strpath, "r+b") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            mc.fat_chain_cache = ps2mc.lru_cache(1)
+            firsts = []
+            for name in ["BESCES-50501REZ/rez.ico",
+                     "BESCES-50501REZ/BESCES-50501REZ"]:
+                f2 = mc.open(name, "rb")
+                firsts.append(f2.first_cluster)
+                f2.close()
+
+            chain = mc.fat_chain(firsts[0])
+            clusters = chain.extents()
+            mc.fat_chain(firsts[1])
+            assert chain.detached
+            assert not mc.fat_chain(firsts[0]).detached
+            mc.fat_chain(firsts[1])
+            for (start, length) in clusters:
+                for n in range(start, start + length):
+                    assert n not in mc.fat_chain_owners
+        finally:
+            mc.close()
+
+
+def test_lru_cache():
+    from mymcplus import ps2mc
+
+    cache = ps2mc.lru_cache(2)
+    assert cache.add(1, "a") == None
+    assert cache.add(2, "b") == None
+    assert cache.get(1) == "a"
+    assert cache.add(3, "c") == (2, "b")
+    assert cache.get(2) == None
+    assert cache.peek(3) == "c"
+    st = cache.stats()
+    assert (st["hits"], st["misses"], st["evictions"]) == (1, 1, 1)
+
+    cache = ps2mc.lru_cache(None)
+    for i in range(1000):
+        assert cache.add(i, i) == None
+    assert len(cache) == 1000
+
+    with pytest.raises(ValueError):
+        ps2mc.lru_cache(0)
+
+
+def test_negative_cache_size(capsys, data):
+    with pytest.raises(SystemExit):
+        mymc.main(["programname", "--fat-cache-size", "-1",
+                   data.join("mc01.ps2").strpath, "dir"])
+    output = capsys.readouterr()
+    assert "Cache sizes can't be negative." in output.err
+
+
+def test_stats(capsys, data):
+    cmd = ["programname", "--stats", "--cluster-cache-size", "0",
+           data.join("mc01.ps2").strpath, "dir"]
+    mymc.main(cmd)
+
+    output = capsys.readouterr()
+    assert "alloc_cluster cache: " in output.err
+    assert "/unlimited entries" in output.err
+    assert "8,075 KB Free" in output.out
+
+
+def test_stats_error(capsys, data):
+    cmd = ["programname", "--stats", data.join("mc01.ps2").strpath,
+           "extract", "nosuchfile"]
+    assert mymc.main(cmd) == 1
+
+    output = capsys.readouterr()
+    assert output.err == "nosuchfile: file not found\n"
+
+
+def test_import_batch(monkeypatch, data, mc02_copy):
+    from mymcplus import ps2mc
+    from mymcplus.save import ps2save
+
+    patch_fixed_time(monkeypatch, ps2mc)
+
+    sf = ps2save.PS2SaveFile()
+    with open(data.join("BESCES-50501REZ.psu").strpath, "rb") as f:
+        format = ps2save.poll_format(f)
+        f.seek(0)
+        format.load(sf, f)
+
+    with open(mc02_copy.join("mc02.ps2").strpath, "r+b") as f:
+        mc = ps2mc.ps2mc(f)
+        flushes = []
+        orig_flush = mc.flush
+        def flush():
+            flushes.append(True)
+            orig_flush()
+        mc.flush = flush
+        try:
+            assert mc.import_save_file(sf, False)
+            assert len(flushes) == 1
+            with mc.batch():
+                mc.mkdir("foo")
+                mc.mkdir("bar")
+                assert len(flushes) == 1
+            assert len(flushes) == 2
+        finally:
+            mc.close()
+
+
+def test_dir_index(mc01_copy):
+    from mymcplus import ps2mc
+
+    with open(mc01_copy.join("mc01.ps2").strpath, "r+b") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            assert mc.get_mode("BESCES-50501REZ/icon.sys") != None
+            mc.mkdir("foo")
+            mc.open("foo/bar", "wb").close()
+            assert mc.get_mode("foo/bar") & ps2mc.DF_FILE
+            mc.remove("foo/bar")
+            assert mc.get_mode("foo/bar") == None
+            mc.remove("foo")
+            assert mc.get_mode("foo") == None
+            mc.mkdir("baz")
+            assert mc.get_mode("baz") & ps2mc.DF_DIR
+            assert mc.get_mode("baz/bar") == None
+
+            # stale entries are detected
+            (names, index) = mc.dir_index[0]
+            index[b"BESCES-50501REZ"], index[b"baz"] = index[b"baz"], index[b"BESCES-50501REZ"]
+            assert mc.get_mode("BESCES-50501REZ/icon.sys") != None
+            assert mc.get_mode("baz") & ps2mc.DF_DIR
+        finally:
+            mc.close()
+
+
+def test_summarize(data):
+    from mymcplus import ps2mc
+
+    with open(data.join("mc01.ps2").strpath, "rb") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            summary = mc.summarize()
+            assert [save.name for save in summary.saves] == ["BEDATA-SYSTEM", "BESCES-50501REZ"]
+            for save in summary.saves:
+                assert save.size == mc.dir_size("/" + save.name)
+                assert save.icon_sys == mc.get_icon_sys("/" + save.name)
+                assert save.mode == mc.get_mode("/" + save.name)
+            assert summary.free_space == mc.get_free_space()
+            assert summary.allocatable_space == mc.get_allocatable_space()
+        finally:
+            mc.close()
+
+
+def test_file_readinto(data):
+    import io
+    from mymcplus import ps2mc
+
+    with open(data.join("mc01.ps2").strpath, "rb") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            with mc.open("BESCES-50501REZ/rez.ico", "rb") as f2:
+                s = f2.read()
+                assert len(s) == 46360
+
+                buf = bytearray(10000)
+                f2.seek(1000)
+                assert f2.readinto(buf) == 10000
+                assert buf == s[1000:11000]
+                f2.seek(-100, 2)
+                assert f2.readinto(buf) == 100
+                assert buf[:100] == s[-100:]
+                assert f2.readinto(buf) == 0
+
+            assert f2.closed
+
+            f2 = io.BufferedReader(mc.open("BESCES-50501REZ/rez.ico", "rb"), 4096)
+            try:
+                assert f2.read(3) == s[:3]
+                assert f2.read() == s[3:]
+            finally:
+                f2.close()
+        finally:
+            mc.close()
+
+
+def test_file_write(mc01_copy):
+    import errno
+    from mymcplus import ps2mc
+
+    with open(mc01_copy.join("mc01.ps2").strpath, "r+b") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            cluster_size = mc.cluster_size
+            data = bytes(range(256)) * 20
+
+            f2 = mc.open("BESCES-50501REZ/test", "wb")
+            f2.write(data[:100])
+            f2.write(data[100:3000])
+            assert mc.get_dirent("BESCES-50501REZ/test")[2] == 3000
+            f2.seek(3 * cluster_size + 10)
+            f2.write(data[3000:])
+            f2.close()
+
+            expected = data[:3000] + b"\0" * (3 * cluster_size + 10 - 3000) + data[3000:]
+            assert mc.get_dirent("BESCES-50501REZ/test")[2] == len(expected)
+            f2 = mc.open("BESCES-50501REZ/test", "rb")
+            assert f2.read() == expected
+            f2.close()
+
+            f2 = mc.open("BESCES-50501REZ/big", "wb")
+            free = mc.get_free_space()
+            try:
+                f2.write(b"x" * (free + cluster_size))
+                assert False
+            except EnvironmentError as e:
+                assert e.errno == errno.ENOSPC
+            f2.close()
+            assert mc.get_free_space() == 0
+            assert mc.get_dirent("BESCES-50501REZ/big")[2] == free
+        finally:
+            mc.close()
+
+
+def test_file_write_shared(mc01_copy):
+    from mymcplus import ps2mc
+
+    with open(mc01_copy.join("mc01.ps2").strpath, "r+b") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            data = bytes(range(256)) * 20
+            f2 = mc.open("BESCES-50501REZ/test", "wb")
+            f3 = mc.open("BESCES-50501REZ/test", "rb")
+            f2.write(data)
+            assert f3.read() == data
+            assert mc.get_dirent("BESCES-50501REZ/test")[2] == len(data)
+            f4 = mc.open("BESCES-50501REZ/test", "rb")
+            assert f4.read() == data
+            f2.write(data)
+            f3.seek(0)
+            assert f3.read() == data * 2
+            f4.close()
+            f3.close()
+            f2.close()
+            assert mc.get_dirent("BESCES-50501REZ/test")[2] == len(data) * 2
+        finally:
+            mc.close()
+
+
+@pytest.mark.parametrize("fat_in_memory", [False, True])
+def test_allocate_extent(mc01_copy, fat_in_memory):
+    from mymcplus import ps2mc
+
+    with open(mc01_copy.join("mc01.ps2").strpath, "r+b") as f:
+        mc = ps2mc.ps2mc(f, fat_in_memory=fat_in_memory)
+        try:
+            # make a hole of 3 clusters
+            a = mc.allocate_clusters(5)
+            mc.set_fat(a[0], ps2mc.PS2MC_FAT_CHAIN_END)
+            for n in a[1:4]:
+                mc.set_fat(n, ps2mc.PS2MC_FAT_CLUSTER_MASK)
+
+            assert mc.allocate_extent(2) == a[1:3]
+            big = mc.allocate_extent(10)
+            assert big == list(range(big[0], big[0] + 10))
+            assert mc.lookup_fat(big[-1]) == ps2mc.PS2MC_FAT_CHAIN_END
+            assert mc.allocate_extent(1) == a[3:4]
+            assert mc.allocate_extent(1) != a[3:4]
+        finally:
+            mc.close()
+
+
+@pytest.mark.parametrize("fat_in_memory", [False, True])
+def test_free_extent_index(mc01_copy, fat_in_memory):
+    import random
+    from mymcplus import ps2mc
+
+    with open(mc01_copy.join("mc01.ps2").strpath, "r+b") as f:
+        mc = ps2mc.ps2mc(f, fat_in_memory=fat_in_memory)
+        try:
+            index = mc._free_extents()
+            rng = random.Random(2)
+            allocated = []
+            for i in range(200):
+                if allocated and rng.random() < 0.4:
+                    n = allocated.pop(rng.randrange(len(allocated)))
+                    mc.set_fat(n, ps2mc.PS2MC_FAT_CLUSTER_MASK)
+                elif rng.random() < 0.5:
+                    allocated += mc.allocate_extent(rng.randrange(1, 6))
+                else:
+                    allocated.append(mc.allocate_cluster())
+
+            # updated in place rather than rebuilt
+            assert mc._free_extents() is index
+            mc.free_extents = None
+            assert mc._free_extents().extents == index.extents
+            for n in allocated:
+                mc.set_fat(n, ps2mc.PS2MC_FAT_CLUSTER_MASK)
+        finally:
+            mc.close()
+
+
+def _read_tree(mc, dirname):
+    files = {}
+    for name in mc.glob(dirname + "*"):
+        mode = mc.get_mode(name)
+        if mode & ps2mc_dir.DF_DIR:
+            files.update(_read_tree(mc, name + "/"))
+        else:
+            f = mc.open(name, "rb")
+            files[name] = f.read()
+            f.close()
+    return files
+
+
+def test_defrag(capsys, mc01_copy):
+    from mymcplus import ps2mc
+
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+    with open(mc_file, "r+b") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            mc.mkdir("TEST")
+            files = [mc.open("TEST/%d" % i, "wb") for i in range(3)]
+            for j in range(5):
+                for (i, f2) in enumerate(files):
+                    f2.write(bytes([i * 16 + j]) * 1500)
+            for f2 in files:
+                f2.close()
+            mc.remove("TEST/1")
+
+            before = _read_tree(mc, "/")
+            free = mc.get_free_space()
+        finally:
+            mc.close()
+
+    mymc.main(["mymcplus", mc_file, "defrag"])
+    output = capsys.readouterr()
+    assert "Extents before: 22, after: 11." in output.out
+
+    with open(mc_file, "rb") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            assert mc.check()
+            assert _read_tree(mc, "/") == before
+            assert mc.get_free_space() == free
+            assert mc.defragment()["clusters_written"] == 0
+        finally:
+            mc.close()
+
+
+def test_defrag_lost(capsys, mc01_copy):
+    from mymcplus import ps2mc
+
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+    with open(mc_file, "r+b") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            before = _read_tree(mc, "/")
+            free = mc.get_free_space()
+            mc.allocate_clusters(2)
+        finally:
+            mc.close()
+
+    assert mymc.main(["mymcplus", mc_file, "defrag"]) == 1
+    output = capsys.readouterr()
+    assert output.err == mc_file + ": 2 lost clusters found, run check\n"
+
+    mymc.main(["mymcplus", mc_file, "defrag", "-r"])
+    output = capsys.readouterr()
+    assert output.out.startswith("2 lost clusters freed.\n")
+
+    with open(mc_file, "rb") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            assert mc.check()
+            assert _read_tree(mc, "/") == before
+            assert mc.get_free_space() == free
+        finally:
+            mc.close()
+
+
+def test_layout(capsys, data):
+    import json
+
+    mymc.main(["mymcplus", data.join("mc01.ps2").strpath, "layout", "-j"])
+    report = json.loads(capsys.readouterr().out)
+
+    assert report["card"]["files"] == 8
+    assert report["card"]["clusters"] == 60
+    assert report["card"]["extents"] == 9
+    assert report["free"]["clusters"] == 8075
+    assert report["free"]["histogram"] == {"4096-8191": 1}
+    assert [save["name"] for save in report["saves"]] == ["BEDATA-SYSTEM", "BESCES-50501REZ"]
+    assert report["saves"][1]["fragmented_files"] == 1
+
+    mymc.main(["mymcplus", data.join("mc01.ps2").strpath, "layout"])
+    output = capsys.readouterr().out
+    assert output.startswith("Card: 8 files, 60 clusters in 9 extents")
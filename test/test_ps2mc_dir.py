@@ -0,0 +1,49 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from mymcplus import ps2mc_dir
+
+
+_ent = [ps2mc_dir.DF_EXISTS | ps2mc_dir.DF_DIR | ps2mc_dir.DF_RWX,
+        0, 3, (1, 2, 3, 4, 5, 2018),
+        7, 0, (6, 7, 8, 9, 10, 2019), 0, b"BESCES-50501REZ"]
+
+
+def test_dirent_view():
+    raw = ps2mc_dir.pack_dirent(_ent)
+    ent = ps2mc_dir.dirent(raw)
+    assert ent == ps2mc_dir.unpack_dirent(raw)
+    assert list(ent) == _ent
+    assert ent[0] & ps2mc_dir.DF_DIR
+    assert ent[-1] == b"BESCES-50501REZ"
+    assert ent[2:5] == _ent[2:5]
+    assert ps2mc_dir.pack_dirent(ent) == raw
+
+
+def test_dirent_pack_changed():
+    raw = bytearray(ps2mc_dir.pack_dirent(_ent))
+    raw[40] = 0x55
+    raw[100] = 0xAA
+    ent = ps2mc_dir.dirent(bytes(raw))
+    ent[2] = 5
+    ent[6] = (0, 0, 0, 1, 1, 2020)
+
+    packed = ps2mc_dir.pack_dirent(ent)
+    assert ps2mc_dir.unpack_dirent(packed) == _ent[:2] + [5] + _ent[3:6] + [(0, 0, 0, 1, 1, 2020)] + _ent[7:]
+    # fields that weren't changed aren't re-encoded
+    assert packed[40] == 0x55
+    assert packed[100] == 0xAA